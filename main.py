@@ -1,11 +1,11 @@
 import yaml
-import comet_ml
 import torch
 import random
 import argparse
 import numpy as np
 
 from src.utils import read_config, set_device, set_debug
+from src.distributed import init_distributed, cleanup
 
 def parse_args():
 
@@ -18,6 +18,8 @@ def parse_args():
     parser.add_argument('--test', action='store_true')
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--seed', default = -1, type=int)
+    # Distributed training is enabled by torchrun env vars (WORLD_SIZE, RANK, LOCAL_RANK)
+    parser.add_argument('--dist_backend', type=str, default=None, help='gloo or nccl')
 
     return parser.parse_args()
 
@@ -26,6 +28,10 @@ if __name__ == '__main__':
     args = parse_args()
 
     use_cuda = not args.cpu
+    backend = args.dist_backend
+    if backend is None and args.cpu:
+        backend = 'gloo'
+    init_distributed(backend)
     set_device(use_cuda)
     set_debug(args.debug)
 
@@ -61,6 +67,9 @@ if __name__ == '__main__':
         from src.train_augm import Trainer as Solver
     elif mode == 'limit':
         from src.train_limit import Trainer as Solver
+    elif mode == 'sweep':
+        # evaluate many checkpoints in one data pass
+        from src.test_sweep import Tester as Solver
     elif mode == 'dacluster':
         if not args.test:
             print('Not imp')
@@ -73,3 +82,4 @@ if __name__ == '__main__':
 
     s = Solver(config)
     s.exec()
+    cleanup()
@@ -0,0 +1,46 @@
+"""
+Read checkpoints by section.
+
+Checkpoints are written by Saver with torch.save (zip format), every tensor
+is its own record in the archive. Loaded with mmap=True the records are only
+mapped, so a section which is never touched (optim, D_state_dict, teacher ...)
+costs no disk IO nor RAM. Testers read 'state_dict' + metadata only.
+Sections: state_dict, optim, g_optim, d_optim, D_state_dict, teacher, amp
+Metadata: epoch, step, valid_score, config
+"""
+
+import torch
+
+def load_meta(path):
+    """
+    torch.load with mmap, tensors are not read from disk until touched,
+    so reading score/epoch of a checkpoint costs almost no IO
+    """
+    try:
+        return torch.load(path, map_location = 'cpu', mmap = True)
+    except (TypeError, RuntimeError):
+        # old torch or legacy (non zip) format
+        return torch.load(path, map_location = 'cpu')
+
+def load_sections(path, sections = ( 'state_dict', )):
+    """
+    Args:
+        sections: keys to keep, other tensor sections are dropped unread
+    Returns:
+        dict of the sections found + metadata
+    """
+    info_dict = load_meta(path)
+    keep = {}
+    for k, v in info_dict.items():
+        if k in sections or not isinstance(v, dict) or k in [ 'valid_score', 'config' ]:
+            keep[k] = v
+    return keep
+
+def load_state_dict(path):
+    """
+    Returns:
+        state_dict (mmap backed, load_state_dict copies it into the model), metadata dict
+    """
+    info_dict = load_sections(path, ( 'state_dict', ))
+    state_dict = info_dict.pop('state_dict')
+    return state_dict, info_dict
@@ -4,6 +4,8 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.autograd import Function
+from torch.utils.checkpoint import checkpoint
 
 from src.sep_utils import overlap_and_add
 
@@ -25,6 +27,10 @@ class ConvTasNet(nn.Module):
             norm_type: BN, gLN, cLN
             causal: causal or non-causal
             mask_nonlinear: use which non-linear function to generate mask
+            checkpoint_blocks: False, 'repeat' or 'block', recompute TemporalBlock
+                               activations in backward instead of storing them
+            block_type: residual or reversible
+            decoder_type: conv_transpose (default) or linear
         """
         super(ConvTasNet, self).__init__()
         # Hyper-parameter
@@ -39,12 +45,15 @@ class ConvTasNet(nn.Module):
         self.C = config['C']
 
         self.norm_type = config['norm_type']
+        self.block_type = config.get('block_type', 'residual')
         self.causal = config['causal']
         self.mask_nonlinear = config['mask_nonlinear']
         self.dropout = config.get('dropout', 0.0)
         self.enc_dropout = config.get('enc_dropout', 0.0)
         self.sep_in_dropout = config.get('sep_in_dropout', 0.0)
         self.sep_out_dropout = config.get('sep_out_dropout', 0.0)
+        self.checkpoint_blocks = parse_checkpoint_blocks(config.get('checkpoint_blocks', False))
+        self.decoder_type = config.get('decoder_type', 'conv_transpose')
 
         print(f'Dropout: {self.dropout}')
         print(f'Enc Dropout: {self.enc_dropout}')
@@ -54,8 +63,9 @@ class ConvTasNet(nn.Module):
         # Components
         self.encoder = Encoder(self.L, self.N, dropout = self.enc_dropout)
         self.separator = TemporalConvNet(self.N, self.B, self.H, self.P, self.X, self.R, self.C,
-                self.norm_type, self.causal, self.mask_nonlinear, self.dropout, self.sep_in_dropout, self.sep_out_dropout)
-        self.decoder = Decoder(self.N, self.L)
+                self.norm_type, self.causal, self.mask_nonlinear, self.dropout, self.sep_in_dropout, self.sep_out_dropout,
+                checkpoint_blocks = self.checkpoint_blocks, block_type = self.block_type)
+        self.decoder = Decoder(self.N, self.L, self.decoder_type)
         # init
         for p in self.parameters():
             if p.dim() > 1:
@@ -122,10 +132,19 @@ class Encoder(nn.Module):
 
 
 class Decoder(nn.Module):
-    def __init__(self, N, L):
+    def __init__(self, N, L, decoder_type = 'conv_transpose'):
+        """
+        Args:
+            decoder_type: 'conv_transpose' -> basis and overlap-add as one
+                          stride L/2 transposed conv, no [M, C, K, L] frames
+                          'linear' -> Linear(N, L) + overlap_and_add (original)
+        Both use the weight of basis_signals [L, N], checkpoints are compatible.
+        """
         super(Decoder, self).__init__()
         # Hyper-parameter
         self.N, self.L = N, L
+        assert decoder_type in [ 'conv_transpose', 'linear' ], f'Unsupported decoder_type {decoder_type}'
+        self.decoder_type = decoder_type
         # Components
         self.basis_signals = nn.Linear(N, L, bias=False)
 
@@ -139,6 +158,13 @@ class Decoder(nn.Module):
         """
         # D = W * M
         source_w = torch.unsqueeze(mixture_w, 1) * est_mask  # [M, C, N, K]
+        if self.decoder_type == 'conv_transpose':
+            M, C, N, K = source_w.size()
+            # Linear weight [L, N] -> ConvTranspose1d weight [N, 1, L]
+            weight = self.basis_signals.weight.t().unsqueeze(1)
+            est_source = F.conv_transpose1d(source_w.reshape(M * C, N, K), weight, stride = self.L // 2)
+            return est_source.view(M, C, -1) # M x C x T
+
         source_w = torch.transpose(source_w, 2, 3) # [M, C, K, N]
         # S = DV
         est_source = self.basis_signals(source_w)  # [M, C, K, L]
@@ -149,7 +175,8 @@ class Decoder(nn.Module):
 class TemporalConvNet(nn.Module):
     def __init__(self, N, B, H, P, X, R, C, norm_type="gLN", causal=False,
             mask_nonlinear='relu', dropout = 0.0,
-            sep_in_dropout = 0.0, sep_out_dropout = 0.0):
+            sep_in_dropout = 0.0, sep_out_dropout = 0.0, checkpoint_blocks = False,
+            block_type = 'residual'):
         """
         Args:
             N: Number of filters in autoencoder
@@ -162,6 +189,8 @@ class TemporalConvNet(nn.Module):
             norm_type: BN, gLN, cLN
             causal: causal or non-causal
             mask_nonlinear: use which non-linear function to generate mask
+            checkpoint_blocks: False, 'repeat' or 'block'
+            block_type: residual (TemporalBlock) or reversible (ReversibleBlock)
         """
         super(TemporalConvNet, self).__init__()
         # Hyper-parameter
@@ -169,6 +198,13 @@ class TemporalConvNet(nn.Module):
         self.R = R
         self.C = C
         self.mask_nonlinear = mask_nonlinear
+        self.block_type = block_type
+        if block_type == 'residual':
+            block_cls = TemporalBlock
+        elif block_type == 'reversible':
+            block_cls = ReversibleBlock
+        else:
+            raise ValueError("Unsupported block type")
         # Components
         # [M, N, K] -> [M, N, K]
         layer_norm = ChannelwiseLayerNorm(N)
@@ -181,7 +217,7 @@ class TemporalConvNet(nn.Module):
             for x in range(X):
                 dilation = 2**x
                 padding = (P - 1) * dilation if causal else (P - 1) * dilation // 2
-                blocks += [TemporalBlock(B, H, P, stride=1,
+                blocks += [block_cls(B, H, P, stride=1,
                                          padding=padding,
                                          dilation=dilation,
                                          norm_type=norm_type,
@@ -205,90 +241,190 @@ class TemporalConvNet(nn.Module):
         if self.sep_out_d > 0:
             self.sep_out_dropout = nn.Dropout(self.sep_out_d)
 
-    def forward(self, mixture_w):
+        self.checkpoint_blocks = parse_checkpoint_blocks(checkpoint_blocks)
+
+    def use_checkpoint(self):
+        # recompute only matters when autograd would store activations
+        return self.checkpoint_blocks and self.training and torch.is_grad_enabled()
+
+    def tcn_forward(self, score):
         """
-        Keep this API same with TasNet
+        Run self.network[2] (R repeats of X TemporalBlock)
         Args:
-            mixture_w: [M, N, K], M is batch size
+            score: [M, B, K]
         returns:
-            est_mask: [M, C, N, K]
+            score: [M, B, K]
         """
-        if self.sep_out_d > 0:
-            return self.d_forward(mixture_w)
-
-        M, N, K = mixture_w.size()
+        tcn = self.network[2]
+        if self.block_type == 'reversible' and self.training and torch.is_grad_enabled():
+            # reconstruct activations in backward, no need to checkpoint
+            blocks = [ block for repeat in tcn for block in repeat ]
+            return ReversibleFunction.apply(score, blocks)
+
+        if not self.use_checkpoint():
+            return tcn(score)
+
+        for repeat in tcn:
+            if self.checkpoint_blocks == 'repeat':
+                score = checkpoint(repeat, score, use_reentrant = False)
+            else:
+                for block in repeat:
+                    score = checkpoint(block, score, use_reentrant = False)
+        return score
 
-        if self.sep_in_d > 0:
-            mixture_w = self.sep_in_dropout(mixture_w)
+    def taps(self, locs):
+        """
+        Compile tap locations for tap_forward, negative indices are resolved
+        Args:
+            locs: dict of label -> path (tuple or 'a|b|c|d' str, see parse_tap)
+        Returns:
+            Taps
+        """
+        sizes = [ len(self.network), self.R, self.X ]
+        if self.block_type == 'residual':
+            block = self.network[2][0][0]
+            sizes += [ len(block.net), len(block.net[3].net) ]
+
+        paths = {}
+        for label, path in locs.items():
+            if isinstance(path, str):
+                path = parse_tap(path)
+            if len(path) > len(sizes):
+                raise ValueError(f'Tap {path} inside {self.block_type} block is not supported')
+            paths[label] = tuple(i % size for i, size in zip(path, sizes))
+        return Taps(paths)
+
+    def block_tap_forward(self, block, score, tree):
+        if self.checkpoint_blocks == 'block' and self.use_checkpoint():
+            return checkpoint(block.tap_forward, score, tree, use_reentrant = False)
+        return block.tap_forward(score, tree)
+
+    def repeat_tap_forward(self, r, score, tree):
+        """
+        Run rth repeat, tree: taps under network[2][r]
+        returns:
+            score: [M, B, K]
+            feat: { label: tensor }
+        """
+        feat = {}
+        for x, block in enumerate(self.network[2][r]):
+            sub = tree.get(x)
+            if Taps.inner(sub):
+                score, f = self.block_tap_forward(block, score, sub)
+                feat.update(f)
+            elif self.checkpoint_blocks == 'block' and self.use_checkpoint():
+                score = checkpoint(block, score, use_reentrant = False)
+            else:
+                score = block(score)
+            Taps.store(sub, score, feat)
+        return score, feat
 
-        score = self.network(mixture_w)  # [M, N, K] -> [M, C*N, K]
-        score = score.view(M, self.C, N, K) # [M, C*N, K] -> [M, C, N, K]
-        if self.mask_nonlinear == 'softmax':
-            est_mask = F.softmax(score, dim=1)
-        elif self.mask_nonlinear == 'relu':
-            est_mask = F.relu(score)
-        else:
-            raise ValueError("Unsupported mask non-linear function")
-        return est_mask
+    def tcn_tap_forward(self, score, tree):
+        """
+        Same as tcn_forward, only repeats with taps inside run with repeat_tap_forward
+        """
+        if not Taps.inner(tree):
+            return self.tcn_forward(score), {}
+
+        feat = {}
+        for r, repeat in enumerate(self.network[2]):
+            sub = tree.get(r)
+            if Taps.inner(sub):
+                if self.checkpoint_blocks == 'repeat' and self.use_checkpoint():
+                    score, f = checkpoint(self.repeat_tap_forward, r, score, sub, use_reentrant = False)
+                else:
+                    score, f = self.repeat_tap_forward(r, score, sub)
+                feat.update(f)
+            elif self.checkpoint_blocks == 'repeat' and self.use_checkpoint():
+                score = checkpoint(repeat, score, use_reentrant = False)
+            else:
+                score = repeat(score)
+            Taps.store(sub, score, feat)
+        return score, feat
 
-    def bn_forward(self, mixture_w):
+    def tap_forward(self, mixture_w, taps = None):
         """
-        Keep this API same with TasNet
+        Run separator network, keep only the tapped intermediates (no hooks)
         Args:
             mixture_w: [M, N, K], M is batch size
+            taps: Taps from self.taps(), None -> no taps
         returns:
-            est_mask: [M, C, N, K]
+            score: [M, C*N, K], output of mask_conv1x1
+            feat: { label: tensor }
         """
-        if self.sep_out_d > 0:
-            return self.d_forward(mixture_w)
-
-        M, N, K = mixture_w.size()
+        tree = taps.tree if taps is not None else {}
+        feat = {}
 
         if self.sep_in_d > 0:
             mixture_w = self.sep_in_dropout(mixture_w)
 
-        feature = {}
         score = mixture_w
         for i, layer in enumerate(self.network):
+            sub = tree.get(i, {})
             if i == 2:
-                for r in range(self.R):
-                    for x in range(self.X):
-                        score, f = layer[r][x].bn_forward(score)
-
-                        l = r * self. X + x
-                        feature[l] = f
+                score, f = self.tcn_tap_forward(score, sub)
+                feat.update(f)
             else:
                 score = layer(score)
+            Taps.store(sub, score, feat)
+            if i == 2 and self.sep_out_d > 0:
+                score = self.sep_out_dropout(score)
+        return score, feat
 
-        score = score.view(M, self.C, N, K) # [M, C*N, K] -> [M, C, N, K]
+    def score_to_mask(self, score):
         if self.mask_nonlinear == 'softmax':
             est_mask = F.softmax(score, dim=1)
         elif self.mask_nonlinear == 'relu':
             est_mask = F.relu(score)
         else:
             raise ValueError("Unsupported mask non-linear function")
-        return est_mask, feature
+        return est_mask
 
-    def d_forward(self, mixture_w):
+    def forward(self, mixture_w):
+        """
+        Keep this API same with TasNet
+        Args:
+            mixture_w: [M, N, K], M is batch size
+        returns:
+            est_mask: [M, C, N, K]
+        """
         M, N, K = mixture_w.size()
+        score, _ = self.tap_forward(mixture_w)
+        score = score.view(M, self.C, N, K) # [M, C*N, K] -> [M, C, N, K]
+        return self.score_to_mask(score)
 
-        if self.sep_in_d > 0:
-            mixture_w = self.sep_in_dropout(mixture_w)
+    def bn_forward(self, mixture_w):
+        """
+        Keep this API same with TasNet
+        Args:
+            mixture_w: [M, N, K], M is batch size
+        returns:
+            est_mask: [M, C, N, K]
+            feature: { r * X + x: { 'res_pre', 'res_post', 'ds_pre', 'ds_post' } }
+        """
+        if self.block_type == 'reversible':
+            raise ValueError("bn_forward does not support reversible block")
+
+        if not hasattr(self, 'bn_taps'):
+            # input/output of the norm layers in every TemporalBlock
+            locs = {}
+            for r in range(self.R):
+                for x in range(self.X):
+                    idx = r * self.X + x
+                    locs[(idx, 'res_pre')] = (2, r, x, 1)
+                    locs[(idx, 'res_post')] = (2, r, x, 2)
+                    locs[(idx, 'ds_pre')] = (2, r, x, 3, 1)
+                    locs[(idx, 'ds_post')] = (2, r, x, 3, 2)
+            self.bn_taps = self.taps(locs)
 
-        score = mixture_w
-        for i, l in enumerate(self.network):
-            score = l(score)
-            if i == 2:
-                score = self.sep_out_dropout(score)
+        M, N, K = mixture_w.size()
+        score, feat = self.tap_forward(mixture_w, self.bn_taps)
+        feature = {}
+        for (idx, name), f in feat.items():
+            feature.setdefault(idx, {})[name] = f
 
         score = score.view(M, self.C, N, K) # [M, C*N, K] -> [M, C, N, K]
-        if self.mask_nonlinear == 'softmax':
-            est_mask = F.softmax(score, dim=1)
-        elif self.mask_nonlinear == 'relu':
-            est_mask = F.relu(score)
-        else:
-            raise ValueError("Unsupported mask non-linear function")
-        return est_mask
+        return self.score_to_mask(score), feature
 
 class TemporalBlock(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size,
@@ -307,50 +443,180 @@ class TemporalBlock(nn.Module):
         self.dropout = dropout
         self.net = nn.Sequential(conv1x1, prelu, norm, dsconv)
 
-    def forward(self, x):
+    def branch(self, x):
         """
+        Residual branch without skip connection
         Args:
             x: [M, B, K]
         Returns:
             [M, B, K]
         """
-        residual = x
         for i, layer in enumerate(self.net):
             if i == self.drop_loc and self.dropout > 0:
                 x = F.dropout(x, p=self.dropout, training = self.training)
             x = layer(x)
-        return x + residual
+        return x
 
-    def bn_forward(self, x):
+    def forward(self, x):
         """
         Args:
             x: [M, B, K]
         Returns:
             [M, B, K]
         """
+        return self.branch(x) + x
+
+    def tap_forward(self, x, tree):
+        """
+        forward with taps inside the block (see TemporalConvNet.tap_forward)
+        Args:
+            x: [M, B, K]
+            tree: taps under this block, key i -> output of self.net[i]
+        Returns:
+            [M, B, K], { label: tensor }
+        """
         residual = x
-        feature = {}
+        feat = {}
         for i, layer in enumerate(self.net):
             if i == self.drop_loc and self.dropout > 0:
                 x = F.dropout(x, p=self.dropout, training = self.training)
-
-            if i == 2:
-                feature['res_pre'] = x
-
-            if i != 3:
-                x = layer(x)
-            else:
+            sub = tree.get(i)
+            if i == 3 and sub is not None:
                 # dsconv
                 for j, ds_layer in enumerate(layer.net):
-                    if j == 2:
-                        feature['ds_pre'] = x
                     x = ds_layer(x)
-                    if j == 2:
-                        feature['ds_post'] = x
+                    Taps.store(sub.get(j), x, feat)
+            else:
+                x = layer(x)
+            Taps.store(sub, x, feat)
+        return x + residual, feat
+
+class ReversibleBlock(nn.Module):
+    """RevNet-style TemporalBlock, x is split into two halves along B
+        y1 = x1 + F(x2)
+        y2 = x2 + G(y1)
+    so x can be reconstructed from y in backward (see ReversibleFunction).
+    F and G are TemporalBlock branches with B/2 in/out channels and H hidden channels.
+    """
+    def __init__(self, in_channels, out_channels, kernel_size,
+                 stride, padding, dilation, norm_type="gLN", causal=False, dropout=0.0):
+        super(ReversibleBlock, self).__init__()
+        assert in_channels % 2 == 0, 'reversible block need even B'
+        half = in_channels // 2
+        self.f = TemporalBlock(half, out_channels, kernel_size, stride, padding, dilation,
+                               norm_type, causal, dropout)
+        self.g = TemporalBlock(half, out_channels, kernel_size, stride, padding, dilation,
+                               norm_type, causal, dropout)
+        self.dropout = dropout
 
-            if i == 2:
-                feature['res_post'] = x
-        return x + residual, feature
+    def record_rng(self, x):
+        """
+        Dropout in branch must draw same mask in forward and reconstruction,
+        so rng state before the branch is recorded and restored in backward_pass
+        """
+        devices = [ x.device ] if x.is_cuda else []
+        return torch.get_rng_state(), [ torch.cuda.get_rng_state(d) for d in devices ]
+
+    def run_branch(self, name, x, rng_state = None):
+        branch = self.f if name == 'f' else self.g
+        if rng_state is None:
+            return branch.branch(x)
+
+        devices = [ x.device ] if x.is_cuda else []
+        cpu_state, cuda_state = rng_state
+        with torch.random.fork_rng(devices = devices):
+            torch.set_rng_state(cpu_state)
+            for d, state in zip(devices, cuda_state):
+                torch.cuda.set_rng_state(state, d)
+            return branch.branch(x)
+
+    def forward(self, x, rng_states = None):
+        """
+        Args:
+            x: [M, B, K]
+            rng_states: dict, filled with rng state of each branch for backward_pass
+        Returns:
+            [M, B, K]
+        """
+        record = rng_states is not None and self.training and self.dropout > 0
+        x1, x2 = torch.chunk(x, 2, dim = 1)
+        if record:
+            rng_states['f'] = self.record_rng(x2)
+        y1 = x1 + self.run_branch('f', x2)
+        if record:
+            rng_states['g'] = self.record_rng(y1)
+        y2 = x2 + self.run_branch('g', y1)
+        return torch.cat([y1, y2], dim = 1)
+
+    def backward_pass(self, y, dy, rng_states):
+        """
+        Reconstruct input from output and backprop through the block.
+        Parameter gradients are accumulated into .grad here.
+        Args:
+            y: [M, B, K], output of this block
+            dy: [M, B, K], gradient w.r.t. y
+            rng_states: recorded by forward of this call
+        Returns:
+            x: [M, B, K], input of this block
+            dx: [M, B, K], gradient w.r.t. x
+        """
+        y1, y2 = torch.chunk(y, 2, dim = 1)
+        dy1, dy2 = torch.chunk(dy, 2, dim = 1)
+
+        with torch.enable_grad():
+            y1 = y1.detach().requires_grad_()
+            gy1 = self.run_branch('g', y1, rng_states.get('g'))
+            torch.autograd.backward(gy1, dy2)
+
+        with torch.no_grad():
+            x2 = y2 - gy1
+            dx1 = dy1 + y1.grad
+            del gy1
+
+        with torch.enable_grad():
+            x2 = x2.detach().requires_grad_()
+            fx2 = self.run_branch('f', x2, rng_states.get('f'))
+            torch.autograd.backward(fx2, dx1)
+
+        with torch.no_grad():
+            x1 = y1 - fx2
+            dx2 = dy2 + x2.grad
+            del fx2
+            x = torch.cat([x1, x2.detach()], dim = 1)
+            dx = torch.cat([dx1, dx2], dim = 1)
+        return x, dx
+
+class ReversibleFunction(Function):
+    """Run a list of ReversibleBlock without storing intermediate activations.
+    Only the final output is kept, inputs of every block are reconstructed in backward.
+    Rng states of dropout and the autocast state are kept per call in ctx, so
+    several forwards before one backward reconstruct their own inputs.
+    NOTE: BN running statistics are updated again while reconstructing.
+    """
+    @staticmethod
+    def forward(ctx, x, blocks):
+        device_type = x.device.type
+        ctx.autocast = (device_type, torch.is_autocast_enabled(device_type), torch.get_autocast_dtype(device_type))
+        ctx.rng_states = []
+        with torch.no_grad():
+            for block in blocks:
+                rng_states = {}
+                x = block(x, rng_states)
+                ctx.rng_states.append(rng_states)
+        ctx.y = x.detach()
+        ctx.blocks = blocks
+        return x
+
+    @staticmethod
+    def backward(ctx, dy):
+        # recompute with the numerics of forward
+        device_type, enabled, dtype = ctx.autocast
+        y = ctx.y
+        with torch.autocast(device_type, dtype = dtype, enabled = enabled):
+            for block, rng_states in zip(ctx.blocks[::-1], ctx.rng_states[::-1]):
+                y, dy = block.backward_pass(y, dy, rng_states)
+        del ctx.y, ctx.rng_states
+        return dy, None
 
 class DepthwiseSeparableConv(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size,
@@ -403,6 +669,63 @@ class Chomp1d(nn.Module):
         return x[:, :, :-self.chomp_size].contiguous()
 
 
+def parse_checkpoint_blocks(checkpoint_blocks):
+    """
+    checkpoint_blocks in model config:
+        False/None -> store all activations (default)
+        True       -> same as 'repeat'
+        'repeat'   -> checkpoint each of the R repeats
+        'block'    -> checkpoint each TemporalBlock
+    """
+    if checkpoint_blocks in [ False, None, '', 'none' ]:
+        return False
+    if checkpoint_blocks is True:
+        return 'repeat'
+    assert checkpoint_blocks in [ 'repeat', 'block' ], f'Unsupported checkpoint_blocks {checkpoint_blocks}'
+    return checkpoint_blocks
+
+def parse_tap(loc):
+    """
+    'a|b|c|d' -> (a, b, c, d), path into TemporalConvNet.network
+        a: 0 to 3 (layer_norm, bottleneck_conv1x1, temporal_conv_net, mask_conv1x1)
+        b: 0 to R - 1 ( repeats in temporal_conv_net )
+        c: 0 to X - 1 ( TemporalBlock in repeat )
+        d: 0 to 3 ( conv1x1, prelu, norm, dsconv in TemporalBlock )
+        e: layers in dsconv
+    Tap is the output of that module, e.g. '2|3|7' is the output of the last
+    block when R = 4, X = 8. Negative index counts from the end.
+    """
+    return tuple(int(l) for l in str(loc).split('|'))
+
+class Taps():
+    """Precompiled tap locations of TemporalConvNet.tap_forward
+    Paths are stored as a tree of dicts, Taps.OUT of a node lists the labels
+    tapping the output of that module.
+    Args:
+        paths: dict of label -> path (tuple of int)
+    """
+    OUT = 'out'
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.tree = {}
+        for label, path in paths.items():
+            node = self.tree
+            for i in path:
+                node = node.setdefault(i, {})
+            node.setdefault(Taps.OUT, []).append(label)
+
+    @staticmethod
+    def inner(node):
+        # any tap below this module
+        return node is not None and any(k != Taps.OUT for k in node)
+
+    @staticmethod
+    def store(node, x, feat):
+        if node is not None:
+            for label in node.get(Taps.OUT, []):
+                feat[label] = x
+
 def chose_norm(norm_type, channel_size):
     """The input of normlization will be (M, C, K), where M is batch size,
        C is channel size and K is sequence length.
@@ -3,11 +3,10 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Function
-from operator import itemgetter
 
 from src.misc import apply_norm
-from src.conv_tasnet import Encoder, Decoder, ChannelwiseLayerNorm
-from src.conv_tasnet import DepthwiseSeparableConv, chose_norm
+from src.conv_tasnet import Encoder, Decoder, parse_checkpoint_blocks
+from src.conv_tasnet import TemporalConvNet as BaseTemporalConvNet
 
 class ReverseLayerF(Function):
 
@@ -38,6 +37,8 @@ class DAConvTasNet(nn.Module):
             norm_type: BN, gLN, cLN
             causal: causal or non-causal
             mask_nonlinear: use which non-linear function to generate mask
+            checkpoint_blocks: False, 'repeat' or 'block'
+            decoder_type: conv_transpose (default) or linear
         """
         super(DAConvTasNet, self).__init__()
         # Hyper-parameter
@@ -56,6 +57,8 @@ class DAConvTasNet(nn.Module):
         self.mask_nonlinear = config['mask_nonlinear']
         self.locs = config.get('locs', [(self.R-1, self.X-1)])
         self.consider_enc = config.get('consider_enc', False)
+        self.checkpoint_blocks = parse_checkpoint_blocks(config.get('checkpoint_blocks', False))
+        self.decoder_type = config.get('decoder_type', 'conv_transpose')
 
         self.feat_loc = config.get('feat_loc', 'residual')
         assert self.feat_loc in [ 'residual', 'conv1x1', 'dsconv' ]
@@ -68,8 +71,9 @@ class DAConvTasNet(nn.Module):
         # Components
         self.encoder = Encoder(self.L, self.N)
         self.separator = TemporalConvNet(self.N, self.B, self.H, self.P, self.X, self.R, self.C,
-                self.norm_type, self.causal, self.mask_nonlinear, locs = self.locs, feat_loc = self.feat_loc)
-        self.decoder = Decoder(self.N, self.L)
+                self.norm_type, self.causal, self.mask_nonlinear, locs = self.locs, feat_loc = self.feat_loc,
+                checkpoint_blocks = self.checkpoint_blocks)
+        self.decoder = Decoder(self.N, self.L, self.decoder_type)
 
         # init
         for p in self.parameters():
@@ -163,9 +167,9 @@ class DAConvTasNet(nn.Module):
 
         return est_source, feature, idm
 
-class TemporalConvNet(nn.Module):
+class TemporalConvNet(BaseTemporalConvNet):
     def __init__(self, N, B, H, P, X, R, C, norm_type="gLN", causal=False,
-                 mask_nonlinear='relu', locs = None, feat_loc = 'residual'):
+                 mask_nonlinear='relu', locs = None, feat_loc = 'residual', checkpoint_blocks = False):
         """
         Args:
             N: Number of filters in autoencoder
@@ -178,40 +182,12 @@ class TemporalConvNet(nn.Module):
             norm_type: BN, gLN, cLN
             causal: causal or non-causal
             mask_nonlinear: use which non-linear function to generate mask
+            locs: [ [ r, x ], ... ] blocks for feature
+            feat_loc: 'residual' (block output), 'conv1x1' or 'dsconv' (in the residual branch)
+            checkpoint_blocks: False, 'repeat' or 'block'
         """
-        super(TemporalConvNet, self).__init__()
-        # Hyper-parameter
-        self.C = C
-        self.X = X
-        self.R = R
-        self.mask_nonlinear = mask_nonlinear
-        # Components
-        # [M, N, K] -> [M, N, K]
-        layer_norm = ChannelwiseLayerNorm(N)
-        # [M, N, K] -> [M, B, K]
-        bottleneck_conv1x1 = nn.Conv1d(N, B, 1, bias=False)
-        # [M, B, K] -> [M, B, K]
-        repeats = []
-        for r in range(R):
-            blocks = []
-            for x in range(X):
-                dilation = 2**x
-                padding = (P - 1) * dilation if causal else (P - 1) * dilation // 2
-                blocks += [TemporalBlock(B, H, P, stride=1,
-                                         padding=padding,
-                                         dilation=dilation,
-                                         norm_type=norm_type,
-                                         causal=causal,
-                                         feat_loc=feat_loc)]
-            repeats += [nn.Sequential(*blocks)]
-        temporal_conv_net = nn.Sequential(*repeats)
-        # [M, B, K] -> [M, C*N, K]
-        mask_conv1x1 = nn.Conv1d(B, C*N, 1, bias=False)
-        # Put together
-        self.network = nn.Sequential(layer_norm,
-                                     bottleneck_conv1x1,
-                                     temporal_conv_net,
-                                     mask_conv1x1)
+        super(TemporalConvNet, self).__init__(N, B, H, P, X, R, C, norm_type, causal,
+                mask_nonlinear, checkpoint_blocks = checkpoint_blocks)
 
         self.locs = []
         for loc in locs:
@@ -221,6 +197,14 @@ class TemporalConvNet(nn.Module):
             self.locs.append(idx)
         self.locs.sort()
 
+        # path of the feature inside TemporalBlock
+        block_path = { 'residual': (), 'conv1x1': (0,), 'dsconv': (3,) }[feat_loc]
+        def block_taps(idxs):
+            return self.taps({ idx: (2, idx // X, idx % X) + block_path for idx in idxs })
+        # only requested blocks are kept
+        self.feat_taps = block_taps(self.locs)
+        self.dict_taps = block_taps(range(R * X))
+
     def forward(self, mixture_w):
         """
         Keep this API same with TasNet
@@ -228,32 +212,19 @@ class TemporalConvNet(nn.Module):
             mixture_w: [M, N, K], M is batch size
         returns:
             est_mask: [M, C, N, K]
+            feature: [M, len(locs) * feature dim, K]
         """
         M, N, K = mixture_w.size()
+        score, feat = self.tap_forward(mixture_w, self.feat_taps)
 
-        feature = []
-        score = mixture_w
-        for i, layer in enumerate(self.network):
-            if i == len(self.network) - 2:
-                for r, repeat in enumerate(layer):
-                    for x, block in enumerate(repeat):
-                        score, feat = block(score)
-                        feature.append(feat)
-            else:
-                score = layer(score)
-
-        feature = itemgetter(*self.locs)(feature)
-        if len(self.locs) > 1:
+        feature = [ feat[idx] for idx in self.locs ]
+        if len(feature) > 1:
             feature = torch.cat(feature, dim = 1)
+        else:
+            feature = feature[0]
 
         score = score.view(M, self.C, N, K) # [M, C*N, K] -> [M, C, N, K]
-        if self.mask_nonlinear == 'softmax':
-            est_mask = F.softmax(score, dim=1)
-        elif self.mask_nonlinear == 'relu':
-            est_mask = F.relu(score)
-        else:
-            raise ValueError("Unsupported mask non-linear function")
-        return est_mask, feature
+        return self.score_to_mask(score), feature
 
     def dict_forward(self, mixture_w):
         """
@@ -262,75 +233,13 @@ class TemporalConvNet(nn.Module):
             mixture_w: [M, N, K], M is batch size
         returns:
             est_mask: [M, C, N, K]
+            feature: { r * X + x: feature of every block }
         """
         M, N, K = mixture_w.size()
-
-        feature = {}
-        score = mixture_w
-        for i, layer in enumerate(self.network):
-            if i == len(self.network) - 2:
-                for r, repeat in enumerate(layer):
-                    for x, block in enumerate(repeat):
-                        score, feat = block(score)
-                        idx = r * self.X + x
-                        feature[idx] = feat
-            else:
-                score = layer(score)
+        score, feature = self.tap_forward(mixture_w, self.dict_taps)
 
         score = score.view(M, self.C, N, K) # [M, C*N, K] -> [M, C, N, K]
-        if self.mask_nonlinear == 'softmax':
-            est_mask = F.softmax(score, dim=1)
-        elif self.mask_nonlinear == 'relu':
-            est_mask = F.relu(score)
-        else:
-            raise ValueError("Unsupported mask non-linear function")
-        return est_mask, feature
-
-class TemporalBlock(nn.Module):
-    def __init__(self, in_channels, out_channels, kernel_size,
-                 stride, padding, dilation, norm_type="gLN", causal=False, dropout=0.0, loc = -1, feat_loc = 'residual'):
-        super(TemporalBlock, self).__init__()
-        # [M, B, K] -> [M, H, K]
-        conv1x1 = nn.Conv1d(in_channels, out_channels, 1, bias=False)
-        prelu = nn.PReLU()
-        norm = chose_norm(norm_type, out_channels)
-        # [M, H, K] -> [M, B, K]
-        dsconv = DepthwiseSeparableConv(out_channels, in_channels, kernel_size,
-                                        stride, padding, dilation, norm_type,
-                                        causal)
-
-        self.drop_loc = 3
-        self.dropout = dropout
-        self.net = nn.Sequential(conv1x1, prelu, norm, dsconv)
-
-        if feat_loc == 'residual':
-            self.feat_loc = -1
-        elif feat_loc == 'conv1x1':
-            self.feat_loc = 0
-        elif feat_loc == 'dsconv':
-            self.feat_loc = 3
-
-    def forward(self, x):
-        """
-        Args:
-            x: [M, B, K]
-        Returns:
-            [M, B, K]
-        """
-        feature = None
-        residual = x
-        for i, layer in enumerate(self.net):
-            if i == self.drop_loc and self.dropout > 0:
-                x = F.dropout(x, p=self.dropout)
-            x = layer(x)
-
-            if i == self.feat_loc:
-                feature = x
-
-        ret = x + residual
-        if self.feat_loc == -1:
-            feature = ret
-        return ret, feature
+        return self.score_to_mask(score), feature
 
 class AvgLayer(nn.Module):
     def __init__(self):
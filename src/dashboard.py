@@ -2,98 +2,163 @@
 Ref:
     https://medium.com/@sunprince12014/comet-ml-%E4%BD%A0%E5%BF%85%E9%A0%88%E7%9F%A5%E9%81%93%E7%9A%84-ml-%E5%AF%A6%E9%A9%97%E7%AE%A1%E7%90%86%E7%A5%9E%E5%99%A8-a4d3b4b16716?
 """
-import os
-from pathlib import Path
-from comet_ml import Experiment, ExistingExperiment
+import atexit
+from collections import defaultdict
+
+import torch
 
 from src.utils import DEBUG
+from src.metrics import build_sink, MetricsWriter
+from src.distributed import rank_zero_only, is_main_process
 
 class Dashboard:
-    """Record training/evaluation statistics to comet
+    """Record training/evaluation statistics to comet or a local file
     :params config: dict
     :params paras: namespace
     :params log_dir: Path
+    Sink is set by solver.dashboard (see src/metrics.py), comet by default.
+    Step info may be device tensors, they are kept on device and synced
+    every sync_every steps with one copy, records are written by a
+    background thread. Only rank 0 creates the sink under distributed
+    training, other ranks keep step/epoch counters only.
     """
     def __init__(self, exp_name, config, log_dir, resume=False):
         self.log_dir = log_dir
-        self.expkey_f = Path(self.log_dir, 'exp_key')
+
+        dash_conf = config['solver'].get('dashboard', {})
+        self.sink_type = dash_conf.get('sink', 'comet')
+        self.sync_every = dash_conf.get('sync_every', 20)
+        self.flush_secs = dash_conf.get('flush_secs', 10)
 
         self.global_step = 1
         self.global_epoch = 1
 
-        if resume:
-            assert self.expkey_f.exists(), f"Cannot find comet exp key in {self.log_dir}"
-            with open(Path(self.log_dir,'exp_key'),'r') as f:
-                exp_key = f.read().strip()
-            self.exp = ExistingExperiment(previous_experiment=exp_key,
-                                          auto_output_logging=None,
-                                          auto_metric_logging=None,
-                                          display_summary_level=0,
-                                          )
-        else:
-            self.exp = Experiment(auto_output_logging=None,
-                                  auto_metric_logging=None,
-                                  display_summary_level=0,
-                                  )
-            with open(self.expkey_f, 'w') as f:
-                print(self.exp.get_key(), file=f)
+        # (prefix, name, step) and device tensors of step info not synced yet
+        self.pending_keys = []
+        self.pending_vals = []
+        self.synced_step = self.global_step
 
-            self.log_config(config)
+        self.writer = None
+        if not is_main_process():
+            return
 
-            self.exp.set_name(exp_name)
+        sink = build_sink(self.sink_type, exp_name, log_dir, resume)
+        self.writer = MetricsWriter(sink, flush_secs = self.flush_secs)
+        # runs before the writer closes (atexit is LIFO)
+        atexit.register(self.flush)
+
+        if not resume:
+            self.log_config(config)
             if DEBUG:
-                self.exp.add_tag("debug")
+                self.add_tag("debug")
 
+    @rank_zero_only
     def add_tag(self, tag):
-        self.exp.add_tag(tag)
+        self.writer.call('add_tag', tag)
 
+    @rank_zero_only
     def log_config(self,config):
         #NOTE: depth at most 2
+        params = {}
         for block in config:
             for n, p in config[block].items():
                 if isinstance(p, dict):
-                    self.exp.log_parameters(p, prefix=f'{block}-{n}')
+                    self.writer.call('log_parameters', p, f'{block}-{n}')
                 else:
-                    self.exp.log_parameter(f'{block}-{n}', p)
+                    params[f'{block}-{n}'] = p
+        self.writer.call('log_parameters', params)
 
+    @rank_zero_only
     def set_script(self, name):
         # log train_{name}
-        self.exp.log_other('script', name)
+        self.writer.call('log_other', 'script', name)
 
+    @rank_zero_only
     def set_status(self,status):
         ## training / trained / decode / completed
-        self.exp.log_other('status', status)
+        self.writer.call('log_other', 'status', status)
 
     def step(self, n=1):
         self.global_step += n
+        if self.global_step - self.synced_step >= self.sync_every:
+            self.sync()
 
     def set_step(self, global_step=1):
+        self.sync()
         self.global_step = global_step
+        self.synced_step = global_step
 
     def epoch(self, n=1):
         self.global_epoch += n
+        self.sync()
 
     def set_epoch(self, global_epoch=1):
         self.global_epoch = global_epoch
 
+    @rank_zero_only
+    def sync(self):
+        """
+        One device sync per device for all pending step info
+        """
+        self.synced_step = self.global_step
+        if len(self.pending_vals) == 0:
+            return
+
+        groups = defaultdict(list)
+        for i, v in enumerate(self.pending_vals):
+            groups[v.device].append(i)
+        vals = [ None ] * len(self.pending_vals)
+        for idx in groups.values():
+            vs = torch.stack([ self.pending_vals[i].float().reshape(()) for i in idx ]).tolist()
+            for i, v in zip(idx, vs):
+                vals[i] = v
+
+        records = [ (prefix, k, v, step) for (prefix, k, step), v in zip(self.pending_keys, vals) ]
+        self.pending_keys = []
+        self.pending_vals = []
+        self.writer.log_metrics(records)
+
+    @rank_zero_only
+    def flush(self):
+        # sync pending step info and wait until the sink has everything
+        self.sync()
+        self.writer.flush()
+
+    @rank_zero_only
     def log_step_info(self, prefix, info):
-        self.exp.log_metrics({k: float(v) for k, v in info.items()}, prefix=prefix, step=self.global_step)
-
+        # O(1) per value, no device sync
+        records = []
+        for k, v in info.items():
+            if torch.is_tensor(v):
+                self.pending_keys.append((prefix, k, self.global_step))
+                self.pending_vals.append(v.detach())
+            else:
+                records.append((prefix, k, float(v), self.global_step))
+        if len(records) > 0:
+            self.writer.log_metrics(records)
+
+    @rank_zero_only
     def log_epoch_info(self, prefix, info):
-        self.exp.log_metrics({k: float(v) for k, v in info.items()}, prefix=prefix, step=self.global_epoch)
+        self.sync()
+        self.writer.log_metrics([ (prefix, k, float(v), self.global_epoch) for k, v in info.items() ])
 
+    @rank_zero_only
     def log_step(self):
-        self.exp.log_other('step', self.global_step)
+        self.writer.call('log_other', 'step', self.global_step)
 
+    @rank_zero_only
     def log_epoch(self):
-        self.exp.log_other('epoch', self.global_epoch)
+        self.writer.call('log_other', 'epoch', self.global_epoch)
 
+    @rank_zero_only
     def log_result(self, d, name = 'result.json'):
-        self.exp.log_asset_data(d, name)
+        self.writer.call('log_asset_data', d, name)
 
+    @rank_zero_only
     def add_figure(self, fig_name, data):
-        self.exp.log_figure(figure_name=fig_name, figure=data, step=self.global_step)
+        self.writer.call('log_figure', fig_name, data, self.global_step)
 
+    @rank_zero_only
     def check(self):
-        if not self.exp.alive:
+        if not self.writer.sink.alive():
             print("Comet logging stopped")
@@ -9,8 +9,10 @@ import soundfile as sf
 import _pickle as cPickle
 
 from io import BytesIO
-from tqdm import tqdm
 from torch.utils.data import Dataset
+from src.sample_cache import read_audio
+from src.preload import preload_audio
+from src.pseudo_label import crop_pseudo
 
 class wsj0(Dataset):
 
@@ -36,6 +38,10 @@ class wsj0(Dataset):
             self.seg_len = int(seg_len * self.sr)
 
         self.pre_load = pre_load
+        # shared sample cache, set by make_loader
+        self.cache = None
+        # offline teacher outputs (PseudoLabelStore), returned as 'pseudo'
+        self.pseudo = None
         self.one_chunk = one_chunk_in_utt
 
         if sp_factors != None:
@@ -82,15 +88,9 @@ class wsj0(Dataset):
 
         if self.pre_load:
             print('Start pre-loading audio')
-            self.audios = {}
-            for uid in tqdm(self.data):
-                self.audios[uid] = {}
-                for speaker in self.data[uid]:
-                    path, _ = self.data[uid][speaker]
-                    path = os.path.join(audio_root, path)
-                    audio, _ = sf.read(path)
-                    audio = audio.astype(np.float32)
-                    self.audios[uid][speaker] = audio
+            # one shared-memory copy for all DataLoader workers
+            uids = list(dict.fromkeys(info[0] for info in self.id_list))
+            self.audios = preload_audio(self.data, audio_root, uids)
 
     def pad_audio(self, audio, ilen):
         base = np.zeros(self.seg_len, dtype = np.float32)
@@ -99,7 +99,7 @@ class wsj0(Dataset):
 
     def load_audio(self, path, factor = 1.0):
         if factor == 1.0:
-            audio, _ = sf.read(path)
+            audio = read_audio(path, self.cache)
         else:
             cmd = f'sox {path} -t wav - speed {factor}'.split()
             result = subprocess.Popen(args = cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -117,9 +117,9 @@ class wsj0(Dataset):
         """
         uid, cid, s, e = self.id_list[idx]
         if self.pre_load:
-            mix_audio = self.audios[uid]['mix']
-            s1_audio = self.audios[uid]['s1']
-            s2_audio = self.audios[uid]['s2']
+            mix_audio = self.audios[uid, 'mix']
+            s1_audio = self.audios[uid, 's1']
+            s2_audio = self.audios[uid, 's2']
         else:
             mix_path = os.path.join(self.audio_root, self.data[uid]['mix'][0])
             s1_path = os.path.join(self.audio_root, self.data[uid]['s1'][0])
@@ -161,6 +161,8 @@ class wsj0(Dataset):
 
         sample = { 'uid': uid, 'cid': cid, 'ilens': ilen,
                    'mix': mix_audio, 'ref': sep_audio }
+        if self.pseudo is not None:
+            sample['pseudo'] = crop_pseudo(self.pseudo[uid], s, e, self.seg_len)
         return sample
 
 class wsj0_eval(Dataset):
@@ -186,6 +188,8 @@ class wsj0_eval(Dataset):
                 self.maxlen = l
 
         self.pre_load = pre_load
+        # shared sample cache, set by make_loader
+        self.cache = None
 
         self.id_list = []
         for uid in self.data:
@@ -200,15 +204,8 @@ class wsj0_eval(Dataset):
 
         if self.pre_load:
             print('Start pre-loading audio')
-            self.audios = {}
-            for uid in tqdm(self.data):
-                self.audios[uid] = {}
-                for speaker in self.data[uid]:
-                    path, _ = self.data[uid][speaker]
-                    path = os.path.join(audio_root, path)
-                    audio, _ = sf.read(path)
-                    audio = audio.astype(np.float32)
-                    self.audios[uid][speaker] = audio
+            # one shared-memory copy for all DataLoader workers
+            self.audios = preload_audio(self.data, audio_root)
 
     def pad_audio(self, audio, ilen):
         base = np.zeros(self.maxlen, dtype = np.float32)
@@ -224,17 +221,17 @@ class wsj0_eval(Dataset):
         """
         uid, cid, s, e = self.id_list[idx]
         if self.pre_load:
-            mix_audio = self.audios[uid]['mix']
-            s1_audio = self.audios[uid]['s1']
-            s2_audio = self.audios[uid]['s2']
+            mix_audio = self.audios[uid, 'mix']
+            s1_audio = self.audios[uid, 's1']
+            s2_audio = self.audios[uid, 's2']
         else:
             mix_path = os.path.join(self.audio_root, self.data[uid]['mix'][0])
             s1_path = os.path.join(self.audio_root, self.data[uid]['s1'][0])
             s2_path = os.path.join(self.audio_root, self.data[uid]['s2'][0])
 
-            mix_audio, _ = sf.read(mix_path)
-            s1_audio, _ = sf.read(s1_path)
-            s2_audio, _ = sf.read(s2_path)
+            mix_audio = read_audio(mix_path, self.cache)
+            s1_audio = read_audio(s1_path, self.cache)
+            s2_audio = read_audio(s2_path, self.cache)
 
             mix_audio = mix_audio.astype(np.float32)
             s1_audio = s1_audio.astype(np.float32)
@@ -0,0 +1,171 @@
+"""
+Data parallel training launched by torchrun, e.g.
+    torchrun --nproc_per_node 2 main.py --c config/train/baseline.yaml --mode baseline --cpu
+
+Every rank builds the same model (params are broadcast from rank 0), reads
+a disjoint shard of the dataset and all-reduces gradients after backward.
+Gradients are synced explicitly instead of wrapping with DDP, since trainers
+call custom forward methods (fetch_forward, cdan_forward, K_forward ...)
+which DDP wrapper does not see.
+"""
+
+import os
+import functools
+
+import torch
+import torch.distributed as dist
+
+from torch.utils.data import DataLoader, Sampler
+from torch.utils.data.distributed import DistributedSampler
+
+from src.sample_cache import attach_cache, worker_init_fn
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    return get_rank() == 0
+
+def init_distributed(backend = None):
+    """
+    Init process group from torchrun env vars (RANK, WORLD_SIZE, LOCAL_RANK,
+    MASTER_ADDR, MASTER_PORT). Do nothing if WORLD_SIZE is not set.
+    Returns:
+        local_rank
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return 0
+
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if backend == 'nccl':
+        torch.cuda.set_device(local_rank)
+    dist.init_process_group(backend = backend, init_method = 'env://')
+    print(f'Init {backend} process group, rank {get_rank()}/{get_world_size()}')
+    return local_rank
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+def rank_zero_only(fn):
+    """
+    Decorator, fn is skipped on rank != 0 (return None)
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if is_main_process():
+            return fn(*args, **kwargs)
+    return wrapper
+
+def broadcast_object(obj):
+    """
+    Use rank 0 value, e.g. time stamp of save dir
+    """
+    if not is_distributed():
+        return obj
+    objs = [ obj ]
+    dist.broadcast_object_list(objs, src = 0)
+    return objs[0]
+
+def broadcast_model(model):
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for t in list(model.parameters()) + list(model.buffers()):
+            dist.broadcast(t.data, src = 0)
+
+def sync_grads(model):
+    """
+    Average gradients over ranks, call between backward and grad clipping.
+    Params without grad on this rank contribute zeros.
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return
+    params = [ p for p in model.parameters() if p.requires_grad ]
+    grads = [ p.grad if p.grad is not None else torch.zeros_like(p) for p in params ]
+    flat = torch.cat([ g.reshape(-1) for g in grads ])
+    dist.all_reduce(flat)
+    flat /= world_size
+
+    offset = 0
+    for p, g in zip(params, grads):
+        n = g.numel()
+        g.copy_(flat[offset:offset+n].view_as(g))
+        if p.grad is None:
+            p.grad = g
+        offset += n
+
+def all_reduce_sum(values, device = None):
+    """
+    Args:
+        values: list of float or dict of float
+    Returns:
+        same type, summed over ranks
+    """
+    if not is_distributed():
+        return values
+    if isinstance(values, dict):
+        keys = list(values.keys())
+        summed = all_reduce_sum([ values[k] for k in keys ], device)
+        return { k: v for k, v in zip(keys, summed) }
+
+    if device is None:
+        device = torch.device('cuda') if dist.get_backend() == 'nccl' else torch.device('cpu')
+    t = torch.tensor([ float(v) for v in values ], dtype = torch.float64, device = device)
+    dist.all_reduce(t)
+    return t.tolist()
+
+class ShardSampler(Sampler):
+    """
+    Sequential sampler over indices[rank::world_size], no padding, so
+    summed eval metrics over ranks are exactly those of the whole set
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.dataset), self.world_size))
+
+    def __len__(self):
+        return len(range(self.rank, len(self.dataset), self.world_size))
+
+def make_loader(dataset, batch_size, shuffle, num_workers, **kwargs):
+    """
+    DataLoader with DistributedSampler (train, shuffle = True) or
+    ShardSampler (eval, shuffle = False) when distributed.
+    Workers are kept alive across epochs (persistent_workers) and seeded
+    per rank by default, dataset reads audio through the sample cache if set.
+    """
+    kwargs.setdefault('persistent_workers', num_workers > 0)
+    kwargs.setdefault('worker_init_fn', worker_init_fn(get_rank()))
+    attach_cache(dataset)
+    if not is_distributed():
+        return DataLoader(dataset, batch_size = batch_size, shuffle = shuffle,
+                          num_workers = num_workers, **kwargs)
+    if shuffle:
+        sampler = DistributedSampler(dataset, shuffle = True, drop_last = True)
+    else:
+        sampler = ShardSampler(dataset)
+    return DataLoader(dataset, batch_size = batch_size, sampler = sampler,
+                      num_workers = num_workers, **kwargs)
+
+def set_epoch(loader, epoch):
+    # reshuffle DistributedSampler every epoch
+    if isinstance(loader.sampler, DistributedSampler):
+        loader.sampler.set_epoch(epoch)
@@ -0,0 +1,50 @@
+
+from collections import defaultdict
+
+import torch
+
+class EMA():
+    """Exponential moving average of model into ema_model (mean teacher)
+
+    Params are collected once and updated with torch._foreach_* ops per
+    (device, dtype) group, two kernel launches per group instead of two per
+    tensor. Buffers (e.g. BN running stats) are copied from model.
+
+    Args:
+        model: student
+        ema_model: teacher, same architecture as model
+        alpha: decay, warmed up by min(1 - 1 / (step + 1), alpha)
+        every: update every k steps with decay alpha ** k (same time horizon)
+    """
+    def __init__(self, model, ema_model, alpha, every = 1):
+        self.alpha = alpha
+        self.every = every
+
+        self.groups = defaultdict(lambda: ([], []))
+        for ema_p, p in zip(ema_model.parameters(), model.parameters()):
+            ema_ps, ps = self.groups[(p.device, p.dtype)]
+            ema_ps.append(ema_p.data)
+            ps.append(p.data)
+        self.groups = dict(self.groups)
+
+        self.buffers = [ (ema_b, b) for ema_b, b in zip(ema_model.buffers(), model.buffers()) ]
+
+    def decay(self, step):
+        # TODO, weird alpha
+        alpha = min(1 - 1/(step + 1), self.alpha)
+        return alpha ** self.every
+
+    @torch.no_grad()
+    def update(self, step):
+        """
+        Args:
+            step: global step, call after every optimizer step
+        """
+        if (step + 1) % self.every != 0:
+            return
+        alpha = self.decay(step)
+        for ema_ps, ps in self.groups.values():
+            torch._foreach_mul_(ema_ps, alpha)
+            torch._foreach_add_(ema_ps, ps, alpha = 1 - alpha)
+        for ema_b, b in self.buffers:
+            ema_b.copy_(b)
@@ -0,0 +1,110 @@
+"""
+Evaluation of many dataset/split pairs through one DataLoader.
+
+All splits are chained into one ConcatDataset, batches never cross a split.
+The DataLoader workers are shared by every split and keep loading ahead,
+so the first batches of the next split are ready when the current one ends.
+Eval datasets pad every utt to the longest of the dataset; collate trims a
+batch to its own longest utt (dynamic padding).
+"""
+
+import json
+import os
+
+import numpy as np
+import torch
+
+from torch.utils.data import DataLoader, ConcatDataset, Sampler
+
+from src.sample_cache import attach_cache, worker_init_fn
+
+def collate_dynamic(samples):
+    """
+    Stack a batch of eval samples, audio is cut to the max ilens of the batch
+    """
+    L = max(s['ilens'] for s in samples)
+    batch = {}
+    for k in samples[0]:
+        vs = [ s[k] for s in samples ]
+        if isinstance(vs[0], np.ndarray):
+            batch[k] = torch.from_numpy(np.stack([ v[..., :L] for v in vs ]))
+        elif isinstance(vs[0], (int, np.integer)):
+            batch[k] = torch.LongTensor(vs)
+        elif isinstance(vs[0], float):
+            batch[k] = torch.FloatTensor(vs)
+        else:
+            batch[k] = vs
+    return batch
+
+class SplitBatchSampler(Sampler):
+    """
+    Batches of ConcatDataset in order, each batch inside one dataset
+    """
+    def __init__(self, sizes, batch_size):
+        self.batches = []
+        self.split_len = []
+        offset = 0
+        for n in sizes:
+            self.split_len.append(0)
+            for s in range(0, n, batch_size):
+                self.batches.append(list(range(offset + s, offset + min(s + batch_size, n))))
+                self.split_len[-1] += 1
+            offset += n
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+class SplitIter():
+    # batches of one split, drawn from the shared loader iterator
+    def __init__(self, it, n):
+        self.it = it
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for _ in range(self.n):
+            yield next(self.it)
+
+class EvalPipeline():
+    """
+    Args:
+        splits: list of (key, dataset), e.g. (('wsj0', 'cv'), wsj0_eval)
+        batch_size: batch size of every split, with dynamic padding
+        num_workers: shared by all splits
+        prefetch: batches loaded ahead per worker
+    Usage:
+        for key, loader in EvalPipeline(splits, ...):
+            evaluate(loader) # iterate it fully before the next split
+    """
+    def __init__(self, splits, batch_size = 1, num_workers = 4, prefetch = 2):
+        self.keys = [ key for key, _ in splits ]
+        datasets = [ d for _, d in splits ]
+        for d in datasets:
+            attach_cache(d)
+
+        self.sampler = SplitBatchSampler([ len(d) for d in datasets ], batch_size)
+        kwargs = {}
+        if num_workers > 0:
+            kwargs['prefetch_factor'] = prefetch
+            kwargs['worker_init_fn'] = worker_init_fn()
+        self.loader = DataLoader(ConcatDataset(datasets),
+                batch_sampler = self.sampler,
+                num_workers = num_workers,
+                collate_fn = collate_dynamic,
+                **kwargs)
+
+    def __iter__(self):
+        it = iter(self.loader)
+        for key, n in zip(self.keys, self.sampler.split_len):
+            yield key, SplitIter(it, n)
+
+def dump_result(result_dict, path):
+    # written after every split, atomic so an interrupted run keeps the last complete file
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(result_dict, f, indent = 1)
+    os.replace(f'{path}.tmp', path)
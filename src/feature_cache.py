@@ -0,0 +1,56 @@
+
+import random
+
+class FeatureCache(object):
+    """Replay buffer of detached generator features for discriminator training
+
+    Entries are (src_feat, src_mask, tgt_feat, tgt_mask) of one src/tgt batch pair.
+    Time is counted in discriminator rounds (one train_dis_once call, i.e. one
+    generator update in between), call step() at the start of every round.
+
+    Args:
+        size: max number of cached batch pairs
+        max_staleness: drop entries computed more than max_staleness rounds ago
+        refresh_every: compute `refresh_num` fresh pairs every k rounds
+        refresh_num: number of fresh pairs per refresh
+    """
+    def __init__(self, size, max_staleness, refresh_every = 1, refresh_num = 1):
+        self.size = size
+        self.max_staleness = max_staleness
+        self.refresh_every = refresh_every
+        self.refresh_num = refresh_num
+
+        self.now = 0
+        self.last_refresh = None
+        self.entries = []
+
+    def step(self):
+        self.now += 1
+        self.entries = [ e for e in self.entries if self.now - e['time'] <= self.max_staleness ]
+
+    def need_refresh(self):
+        if len(self.entries) == 0 or self.last_refresh is None:
+            return True
+        return self.now - self.last_refresh >= self.refresh_every
+
+    def push(self, feats):
+        self.entries.append({ 'time': self.now, 'feats': feats })
+        if len(self.entries) > self.size:
+            self.entries.pop(0)
+
+    def fetch(self, compute_fn):
+        """
+        Args:
+            compute_fn: callable, return features of a fresh batch pair
+        Returns:
+            features of a random cached batch pair
+        """
+        if self.need_refresh():
+            for _ in range(self.refresh_num):
+                self.push(compute_fn())
+            self.last_refresh = self.now
+        return random.choice(self.entries)['feats']
+
+    def clear(self):
+        self.entries = []
+        self.last_refresh = None
@@ -12,6 +12,7 @@ from io import BytesIO
 from tqdm import tqdm
 from torch.utils.data import Dataset
 from src.gender_mapper import GenderMapper
+from src.sample_cache import read_audio
 
 class wsj0_gender(Dataset):
 
@@ -37,6 +38,8 @@ class wsj0_gender(Dataset):
             self.seg_len = int(seg_len * self.sr)
 
         self.pre_load = pre_load
+        # shared sample cache, set by make_loader
+        self.cache = None
         self.one_chunk = one_chunk_in_utt
 
         self.gender_mapper = GenderMapper()
@@ -80,7 +83,7 @@ class wsj0_gender(Dataset):
 
     def load_audio(self, path, factor = 1.0):
         if factor == 1.0:
-            audio, _ = sf.read(path)
+            audio = read_audio(path, self.cache)
         else:
             cmd = f'sox {path} -t wav - speed {factor}'.split()
             result = subprocess.Popen(args = cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -4,8 +4,10 @@ import torch.autograd as autograd
 
 from src.utils import DEV
 
-def calc_gradient_penalty(D, real_data, fake_data):
-
+def interpolate(real_data, fake_data):
+    """
+    Random points between real and fake, input of D for gradient penalty
+    """
     B = real_data.size(0)
     if real_data.dim() == 2:
         alpha = torch.rand(B, 1)
@@ -16,17 +18,25 @@ def calc_gradient_penalty(D, real_data, fake_data):
 
     interpolates = alpha * real_data + ((1 - alpha) * fake_data)
     interpolates.requires_grad = True
-
-    disc_interpolates = D(interpolates)
-
-    gp = 0.
-    for d_out in disc_interpolates:
-        gradients = autograd.grad(outputs = d_out,
-                                  inputs=interpolates,
-                                  grad_outputs = torch.ones(d_out.size()).to(DEV),
-                                  create_graph=True, retain_graph=True, only_inputs=True)[0]
-
-        gradient_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean()
-        gp = gp + gradient_penalty
+    return interpolates
+
+def penalty(disc_interpolates, interpolates):
+    """
+    One double backward for all D outputs. D treats samples independently,
+    so grad of the summed outputs w.r.t. each sample is the grad of its own
+    outputs. Same gradient as penalizing every sample output separately,
+    the value differs from that by a constant (B - 1).
+    Args:
+        disc_interpolates: D(interpolates), may be a slice of a larger D batch
+        interpolates: from interpolate()
+    """
+    gradients = autograd.grad(outputs = disc_interpolates.sum(),
+                              inputs = interpolates,
+                              create_graph = True, only_inputs = True)[0]
+    gp = ((gradients.norm(2, dim = 1) - 1) ** 2).mean()
     return gp
 
+def calc_gradient_penalty(D, real_data, fake_data):
+    interpolates = interpolate(real_data, fake_data)
+    disc_interpolates = D(interpolates)
+    return penalty(disc_interpolates, interpolates)
@@ -3,9 +3,9 @@ import random
 import math
 import torch
 import numpy as np
-import soundfile as sf
 import _pickle as cPickle
 from torch.utils.data import Dataset
+from src.sample_cache import read_audio
 
 def sample_seg(utt_len, seg_len):
     re = utt_len - seg_len
@@ -49,6 +49,8 @@ class LimitDataset(Dataset):
         self.data = cPickle.load(open(id_list_path, 'rb'))
         self.ginfo = cPickle.load(open(spk_info, 'rb'))
         self.audio_root = audio_root
+        # shared sample cache, set by make_loader
+        self.cache = None
         self.sr = 8000
 
         self.seg_len = int(seg_len * self.sr)
@@ -148,7 +150,7 @@ class LimitDataset(Dataset):
         return base
 
     def load_audio(self, path, factor = 1.0):
-        audio, _ = sf.read(path)
+        audio = read_audio(path, self.cache)
         return audio
 
     def sample_from_another_spk(self, spk):
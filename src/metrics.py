@@ -0,0 +1,315 @@
+"""
+Metrics sinks and the background writer of Dashboard.
+
+Training loops log every step, values may be 0-dim device tensors.
+Dashboard keeps them on device and syncs them with one .tolist() every
+sync_every steps, records are handed to MetricsWriter which batches them
+into the sink in a background thread. The hot loop never waits on disk or
+network. Set by config:
+    solver:
+        dashboard:
+            sink: 'comet'   # 'comet', 'jsonl', 'sqlite' or 'none'
+            sync_every: 20  # steps between device syncs of step metrics
+            flush_secs: 10  # max delay of batched records in the writer
+Local sinks write into log_dir:
+    metrics.jsonl / metrics.db  metrics, others (status, script, ...), params and tags
+    assets/                     log_result json, figures
+"""
+
+import os
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+
+from pathlib import Path
+from collections import defaultdict
+
+class NullSink():
+    """
+    Drop everything, also the base of other sinks
+    Records are (prefix, name, value, step)
+    """
+    def log_metrics(self, records):
+        pass
+
+    def log_other(self, key, value):
+        pass
+
+    def add_tag(self, tag):
+        pass
+
+    def log_parameters(self, params, prefix = None):
+        pass
+
+    def log_asset_data(self, d, name):
+        pass
+
+    def log_figure(self, name, figure, step):
+        pass
+
+    def alive(self):
+        return True
+
+    def close(self):
+        pass
+
+class CometSink(NullSink):
+    """
+    Args:
+        exp_name: name of a new comet experiment
+        log_dir: exp key is kept in log_dir/exp_key
+        resume: continue the experiment of log_dir/exp_key
+    """
+    def __init__(self, exp_name, log_dir, resume = False):
+        from comet_ml import Experiment, ExistingExperiment
+
+        expkey_f = Path(log_dir, 'exp_key')
+        if resume:
+            assert expkey_f.exists(), f"Cannot find comet exp key in {log_dir}"
+            with open(expkey_f, 'r') as f:
+                exp_key = f.read().strip()
+            self.exp = ExistingExperiment(previous_experiment=exp_key,
+                                          auto_output_logging=None,
+                                          auto_metric_logging=None,
+                                          display_summary_level=0,
+                                          )
+        else:
+            self.exp = Experiment(auto_output_logging=None,
+                                  auto_metric_logging=None,
+                                  display_summary_level=0,
+                                  )
+            with open(expkey_f, 'w') as f:
+                print(self.exp.get_key(), file=f)
+            self.exp.set_name(exp_name)
+
+    def log_metrics(self, records):
+        # one comet call per (prefix, step)
+        groups = defaultdict(dict)
+        for prefix, name, value, step in records:
+            groups[(prefix, step)][name] = value
+        for (prefix, step), metrics in groups.items():
+            self.exp.log_metrics(metrics, prefix=prefix, step=step)
+
+    def log_other(self, key, value):
+        self.exp.log_other(key, value)
+
+    def add_tag(self, tag):
+        self.exp.add_tag(tag)
+
+    def log_parameters(self, params, prefix = None):
+        self.exp.log_parameters(params, prefix=prefix)
+
+    def log_asset_data(self, d, name):
+        self.exp.log_asset_data(d, name)
+
+    def log_figure(self, name, figure, step):
+        self.exp.log_figure(figure_name=name, figure=figure, step=step)
+
+    def alive(self):
+        return self.exp.alive
+
+    def close(self):
+        self.exp.end()
+
+def param_name(k, prefix):
+    return k if prefix is None else f'{prefix}-{k}'
+
+class LocalSink(NullSink):
+    # assets and figures are files under log_dir/assets
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.asset_dir = os.path.join(log_dir, 'assets')
+
+    def log_asset_data(self, d, name):
+        os.makedirs(self.asset_dir, exist_ok = True)
+        path = os.path.join(self.asset_dir, name)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(d, f, indent = 1)
+        os.replace(f'{path}.tmp', path)
+
+    def log_figure(self, name, figure, step):
+        os.makedirs(self.asset_dir, exist_ok = True)
+        # matplotlib figure
+        figure.savefig(os.path.join(self.asset_dir, f'{name}_{step}.png'))
+
+class JSONLSink(LocalSink):
+    """
+    log_dir/metrics.jsonl, one json object per line:
+        { "type": "metric", "prefix", "name", "value", "step", "time" }
+        { "type": "other", "name", "value", "time" }
+        { "type": "param", "name", "value" }
+        { "type": "tag", "value" }
+    """
+    def __init__(self, log_dir):
+        super().__init__(log_dir)
+        self.path = os.path.join(log_dir, 'metrics.jsonl')
+        self.f = open(self.path, 'a')
+
+    def write(self, lines):
+        self.f.write(''.join(json.dumps(l, default = str) + '\n' for l in lines))
+        self.f.flush()
+
+    def log_metrics(self, records):
+        t = time.time()
+        self.write([ { 'type': 'metric', 'prefix': prefix, 'name': name, 'value': value, 'step': step, 'time': t }
+                     for prefix, name, value, step in records ])
+
+    def log_other(self, key, value):
+        self.write([ { 'type': 'other', 'name': key, 'value': value, 'time': time.time() } ])
+
+    def add_tag(self, tag):
+        self.write([ { 'type': 'tag', 'value': tag } ])
+
+    def log_parameters(self, params, prefix = None):
+        self.write([ { 'type': 'param', 'name': param_name(k, prefix), 'value': v } for k, v in params.items() ])
+
+    def close(self):
+        self.f.close()
+
+class SQLiteSink(LocalSink):
+    """
+    log_dir/metrics.db with tables
+        metrics(prefix, name, value, step, time)
+        others(name, value, time), params(name, value), tags(value)
+    value of others/params is json
+    """
+    def __init__(self, log_dir):
+        super().__init__(log_dir)
+        self.path = os.path.join(log_dir, 'metrics.db')
+        # opened in the writer thread, sqlite connections are bound to their thread
+        self.db = None
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path)
+            self.db.execute('CREATE TABLE IF NOT EXISTS metrics (prefix TEXT, name TEXT, value REAL, step INTEGER, time REAL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS others (name TEXT, value TEXT, time REAL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS params (name TEXT, value TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS tags (value TEXT)')
+        return self.db
+
+    def execute(self, sql, rows):
+        db = self.connect()
+        with db:
+            db.executemany(sql, rows)
+
+    def log_metrics(self, records):
+        t = time.time()
+        self.execute('INSERT INTO metrics VALUES (?, ?, ?, ?, ?)',
+                     [ (prefix, name, value, step, t) for prefix, name, value, step in records ])
+
+    def log_other(self, key, value):
+        self.execute('INSERT INTO others VALUES (?, ?, ?)', [ (key, json.dumps(value, default = str), time.time()) ])
+
+    def add_tag(self, tag):
+        self.execute('INSERT INTO tags VALUES (?)', [ (tag,) ])
+
+    def log_parameters(self, params, prefix = None):
+        self.execute('INSERT INTO params VALUES (?, ?)', [ (param_name(k, prefix), json.dumps(v, default = str)) for k, v in params.items() ])
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+def build_sink(sink, exp_name, log_dir, resume = False):
+    if sink == 'comet':
+        return CometSink(exp_name, log_dir, resume)
+    elif sink == 'jsonl':
+        return JSONLSink(log_dir)
+    elif sink == 'sqlite':
+        return SQLiteSink(log_dir)
+    elif sink == 'none':
+        return NullSink()
+    else:
+        print(f'Not support dashboard sink: {sink}')
+        exit()
+
+class MetricsWriter():
+    """Background thread feeding a sink
+
+    Metric records are buffered and written in one sink call when
+    max_batch records are pending or flush_secs passed. Other calls are
+    written in order, after the pending metrics.
+    Errors of the sink are raised in the main thread at the next call/flush.
+    Args:
+        sink: NullSink, CometSink, JSONLSink or SQLiteSink
+    """
+    def __init__(self, sink, flush_secs = 10, max_batch = 1000):
+        self.sink = sink
+        self.flush_secs = flush_secs
+        self.max_batch = max_batch
+
+        self.queue = queue.Queue()
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target = self.worker, daemon = True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def worker(self):
+        buf = []
+        last = time.time()
+        while True:
+            try:
+                item = self.queue.get(timeout = self.flush_secs)
+            except queue.Empty:
+                item = None
+
+            done = item is not None and item[0] == 'close'
+            if item is not None and item[0] == 'metrics':
+                buf += item[1]
+            if len(buf) > 0 and (item is None or item[0] != 'metrics' or len(buf) >= self.max_batch
+                                 or time.time() - last >= self.flush_secs):
+                self.run(self.sink.log_metrics, buf)
+                buf = []
+                last = time.time()
+
+            if item is not None:
+                if item[0] == 'call':
+                    self.run(getattr(self.sink, item[1]), *item[2])
+                elif done:
+                    self.run(self.sink.close)
+                self.queue.task_done()
+            if done:
+                return
+
+    def run(self, fn, *args):
+        try:
+            fn(*args)
+        except Exception as e:
+            self.error = e
+
+    def check(self):
+        if self.error is not None:
+            e, self.error = self.error, None
+            raise e
+
+    def log_metrics(self, records):
+        self.check()
+        self.queue.put(('metrics', records))
+
+    def call(self, method, *args):
+        # sink.method(*args) in the writer thread
+        self.check()
+        self.queue.put(('call', method, args))
+
+    def flush(self):
+        # 'flush' item forces the pending metrics out
+        if self.closed:
+            return
+        self.queue.put(('flush',))
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(('close',))
+        self.queue.join()
+        self.thread.join()
+        self.check()
@@ -0,0 +1,129 @@
+
+import time
+import contextlib
+
+import torch
+
+class MixedPrecision():
+    """torch.autocast wrapper shared by all trainers
+    solver config:
+        amp: False, 'bf16' or 'fp16'
+             (legacy `fp16: True` of train_pimt is treated as amp: 'fp16')
+    bf16 has the fp32 exponent range, no loss scaling is needed.
+    fp16 uses GradScaler and only works on cuda, fp16 on cpu falls back to bf16.
+
+    Usage in train loop:
+        with self.amp.autocast():
+            loss = ...
+        self.opt.zero_grad()
+        self.amp.backward(loss)
+        self.amp.unscale_(self.opt)
+        torch.nn.utils.clip_grad_norm_(...)
+        self.amp.step(self.opt)
+    """
+    def __init__(self, solver_config, device):
+        mode = solver_config.get('amp', False)
+        if not mode and solver_config.get('fp16', False):
+            mode = 'fp16'
+        if mode == True:
+            mode = 'bf16'
+
+        self.device_type = device.type
+        if mode == 'fp16' and self.device_type != 'cuda':
+            print('fp16 autocast need cuda, use bf16 instead')
+            mode = 'bf16'
+        if mode not in [ False, 'bf16', 'fp16' ]:
+            print(f'Unsupported amp mode: {mode}')
+            exit()
+
+        self.mode = mode
+        self.enabled = mode != False
+        self.dtype = torch.float16 if mode == 'fp16' else torch.bfloat16
+
+        self.scaler = None
+        if mode == 'fp16':
+            self.scaler = torch.cuda.amp.GradScaler()
+
+        if self.enabled:
+            print(f'Use {mode} mixed precision')
+
+    def autocast(self):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype = self.dtype)
+
+    def backward(self, loss, **kwargs):
+        if self.scaler is not None:
+            loss = self.scaler.scale(loss)
+        loss.backward(**kwargs)
+
+    def unscale_(self, opt):
+        # call before grad clipping so clip sees real grad norm
+        if self.scaler is not None:
+            self.scaler.unscale_(opt)
+
+    def step(self, opt):
+        if self.scaler is not None:
+            self.scaler.step(opt)
+            self.scaler.update()
+        else:
+            opt.step()
+
+    def update(self):
+        # step is skipped (e.g. NaN grad norm), still reset scaler state of this iteration
+        if self.scaler is not None:
+            self.scaler.update()
+
+    def state_dict(self):
+        if self.scaler is not None:
+            return self.scaler.state_dict()
+        return {}
+
+    def load_state_dict(self, state):
+        # old apex amp state dict is not compatible, skip it
+        if self.scaler is not None and 'scale' in state:
+            self.scaler.load_state_dict(state)
+
+def fp32_region(device_type):
+    """
+    Disable autocast, tensors inside should be cast by .float()
+    """
+    return torch.autocast(device_type, enabled = False)
+
+def benchmark(mode, steps = 10, B = 4, T = 32000):
+    from src.conv_tasnet import ConvTasNet
+    from src.pit_criterion import cal_loss
+
+    config = { 'N': 256, 'L': 20, 'B': 256, 'H': 512, 'P': 3, 'X': 8, 'R': 4, 'C': 2,
+               'norm_type': 'gLN', 'causal': False, 'mask_nonlinear': 'relu' }
+    dev = torch.device('cpu')
+    model = ConvTasNet(config).to(dev)
+    opt = torch.optim.Adam(model.parameters(), lr = 1e-3)
+    amp = MixedPrecision({ 'amp': mode }, dev)
+
+    mixture = torch.randn(B, T)
+    source = torch.randn(B, 2, T)
+    lengths = torch.full((B,), T, dtype = torch.long)
+
+    for i in range(steps + 1):
+        # first step is warmup
+        if i == 1:
+            start = time.time()
+        with amp.autocast():
+            est = model(mixture)
+            loss, _, _, _ = cal_loss(source, est, lengths)
+        opt.zero_grad()
+        amp.backward(loss)
+        amp.unscale_(opt)
+        torch.nn.utils.clip_grad_norm_(model.parameters(), 5.)
+        amp.step(opt)
+    elapsed = time.time() - start
+    return steps * B / elapsed
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    fp32 = benchmark(False)
+    bf16 = benchmark('bf16')
+    print(f'fp32: {fp32:.2f} utts/s')
+    print(f'bf16: {bf16:.2f} utts/s')
+    print(f'speed up: {bf16 / fp32:.2f}x')
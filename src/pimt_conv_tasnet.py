@@ -65,37 +65,31 @@ class InputTransform(nn.Module):
 
 class Separator(TemporalConvNet):
     def __init__(self, N, B, H, P, X, R, C, norm_type="gLN", causal=False,
-                 mask_nonlinear='relu', dropout = 0.0, sep_in_dropout = 0.0, sep_out_dropout = 0.0):
+                 mask_nonlinear='relu', dropout = 0.0, sep_in_dropout = 0.0, sep_out_dropout = 0.0, checkpoint_blocks = False,
+                 block_type = 'residual'):
         super(Separator, self).__init__(N, B, H, P, X, R, C,
-                norm_type, causal, mask_nonlinear, dropout, sep_in_dropout, sep_out_dropout)
+                norm_type, causal, mask_nonlinear, dropout, sep_in_dropout, sep_out_dropout,
+                checkpoint_blocks = checkpoint_blocks, block_type = block_type)
 
-        self.sep_in_dropout = nn.Dropout(self.sep_in_d)
-        self.sep_out_dropout = nn.Dropout(self.sep_out_d)
-
-    def forward(self, mixture_w):
+    def forward(self, mixture_w, taps = None):
         """
         Keep this API same with TasNet
         Args:
             mixture_w: [M, N, K], M is batch size
+            taps: Taps from self.taps(), features returned when given
         returns:
             est_mask: [M, C, N, K]
+            score: [M, C, N, K], before mask_nonlinear
+            feat: { label: tensor }, only when taps is given
         """
         M, N, K = mixture_w.size()
 
-        score = self.sep_in_dropout(mixture_w)
-        for i, l in enumerate(self.network):
-            score = l(score)
-            if i == 2:
-                score = self.sep_out_dropout(score)
-
+        score, feat = self.tap_forward(mixture_w, taps)
         score = score.view(M, self.C, N, K) # [M, C*N, K] -> [M, C, N, K]
-        if self.mask_nonlinear == 'softmax':
-            est_mask = F.softmax(score, dim=1)
-        elif self.mask_nonlinear == 'relu':
-            est_mask = F.relu(score)
-        else:
-            raise ValueError("Unsupported mask non-linear function")
-        return est_mask, score
+        est_mask = self.score_to_mask(score)
+        if taps is None:
+            return est_mask, score
+        return est_mask, score, feat
 
 class PiMtConvTasNet(ConvTasNet):
     def __init__(self, config):
@@ -103,54 +97,24 @@ class PiMtConvTasNet(ConvTasNet):
 
         del self.separator
         self.separator = Separator(self.N, self.B, self.H, self.P, self.X, self.R, self.C,
-                self.norm_type, self.causal, self.mask_nonlinear, self.dropout, self.sep_in_dropout, self.sep_out_dropout)
+                self.norm_type, self.causal, self.mask_nonlinear, self.dropout, self.sep_in_dropout, self.sep_out_dropout,
+                checkpoint_blocks = self.checkpoint_blocks, block_type = self.block_type)
+        # compiled taps of fetch_forward, keyed by locs
+        self.tap_cache = {}
         # init
         for p in self.parameters():
             if p.dim() > 1:
                 nn.init.xavier_normal_(p)
 
-    def get_layer(self, loc):
+    def get_taps(self, locs):
         """
-        loc:
-            a       -> idx = a in separator.network
-            a|b     -> idx = b in TemporalConvNet R
-            a|b|c   -> idx = c in TemporalConvNet X
-            a|b|c|d -> a, b, c as following and idx = c in TemporalBlock
-
-            a should always be 2 in a|*... setting
-
-        Range of loc:
-            a: 0 to 3 (layer_norm, bottleneck_conv1x1, temporal_conv_net, mask_conv1x1)
-            b: 0 to R - 1 ( layers in TemporalConvNet R )
-            c: 0 to X - 1 ( layers in TemporalConvNet X )
-            d: 0 to 3 (conv1x1, prelu, norm, dsconv)
-
-            a = -1 equal to 'mask'
-            a|b == a|b|-1
-
-        I am so idiot, it seems that loc would be 2 XD
+        locs: a, a|b, a|b|c, a|b|c|d (see parse_tap), 'mask' and 'score'
+        are returned by separator forward, no need to tap
         """
-        ll = [ int(l) for l in loc.split('|') ]
-        assert len(ll) in [ 1, 2, 3, 4 ]
-
-        if len(ll) == 1:
-            a = ll[0]
-            layer = self.separator.network[a]
-        if len(ll) == 2:
-            a, b = ll
-            layer = self.separator.network[2][b]
-        if len(ll) == 3:
-            a, b, c = ll
-            layer = self.separator.network[2][b][c]
-        if len(ll) == 4:
-            a, b, c, d = ll
-            layer = self.separator.network[2][b][c][d]
-        return layer
-
-    def clean_hook_tensor(self, feat):
-        locs = list(feat.keys())
-        for loc in locs:
-            del feat[loc]
+        key = tuple(locs)
+        if key not in self.tap_cache:
+            self.tap_cache[key] = self.separator.taps({ loc: loc for loc in locs if loc not in [ 'mask', 'score' ] })
+        return self.tap_cache[key]
 
     def forward(self, mixture):
         """
@@ -193,59 +157,39 @@ class PiMtConvTasNet(ConvTasNet):
         """
         for pseudo labeling, should be call under torch.no_grad()
         noise: dropout, addnoise, specaugm
+        K views run in one separator call (K times batch size), masks are averaged
         """
         clean_mixture_w = self.encoder(mixture)
+        M = clean_mixture_w.size(0)
+
+        # K views stacked on batch dim, transform drawn independently per view
+        if transform is None:
+            # views differ by dropout only
+            views = clean_mixture_w.repeat(K, 1, 1)
+        elif transform.where == 'wav':
+            views = self.encoder(torch.cat([ transform(mixture) for _ in range(K) ], dim = 0))
+        elif transform.where == 'spec':
+            views = torch.cat([ transform(clean_mixture_w) for _ in range(K) ], dim = 0)
+
+        est_mask, _ = self.separator(views)
+        est_mask = est_mask.view(K, M, *est_mask.shape[1:]).mean(dim = 0)
 
-        mask = None
-        for k in range(K):
-            if transform is None:
-                est_mask, _ = self.separator(clean_mixture_w)
-            else:
-                if transform.where == 'wav':
-                    mixture = transform(mixture)
-                    mixture_w = self.encoder(mixture)
-                elif transform.where == 'spec':
-                    mixture_w = transform(clean_mixture_w)
-                est_mask, _ = self.separator(mixture_w)
-            if mask is None:
-                mask = est_mask
-            else:
-                mask  = mask + est_mask
-
-        est_mask = mask / K
         if T != 1:
             est_mask = est_mask ** (1/T)
             est_mask = est_mask / est_mask.sum(dim = 1, keepdim = True)
 
         est_source = self.decoder(clean_mixture_w, est_mask)
         T_origin = mixture.size(-1)
-        T_conv = est_source .size(-1)
+        T_conv = est_source.size(-1)
         est_source = F.pad(est_source, (0, T_origin - T_conv))
         return est_source
 
     def fetch_forward(self, mixture, locs, transform = None):
         """
-        loc: a, a|b, a|b|c, mask
-        mask can fetch in forward, so no need to do register
+        loc: a, a|b, a|b|c, a|b|c|d, mask, score
+        Only the requested intermediates are kept (taps, no forward hooks)
         """
-        store_mask = False
-        store_score = False
-        if 'mask' in locs:
-            store_mask = True
-        if 'score' in locs:
-            store_score = True
-
-        feat = {}
-        handles = []
-        def get_feat(loc):
-            def fetch(module, feat_in, feat_out):
-                feat[loc] = feat_out
-            return fetch
-        for loc in locs:
-            if loc not in [ 'mask', 'score']:
-                layer = self.get_layer(loc = loc)
-                h = layer.register_forward_hook(hook = get_feat(loc))
-                handles.append(h)
+        taps = self.get_taps(locs)
 
         if transform != None:
             if transform.where == 'wav':
@@ -255,14 +199,14 @@ class PiMtConvTasNet(ConvTasNet):
             elif transform.where == 'spec':
                 mixture_w = self.encoder(mixture)
                 mixture_w_purb = transform(mixture_w)
-            est_mask, score = self.separator(mixture_w_purb)
+            est_mask, score, feat = self.separator(mixture_w_purb, taps)
         else:
             mixture_w = self.encoder(mixture)
-            est_mask, score = self.separator(mixture_w)
+            est_mask, score, feat = self.separator(mixture_w, taps)
 
-        if store_mask:
+        if 'mask' in locs:
             feat['mask'] = est_mask
-        if store_score:
+        if 'score' in locs:
             feat['score'] = score
 
         est_source = self.decoder(mixture_w, est_mask)
@@ -270,10 +214,6 @@ class PiMtConvTasNet(ConvTasNet):
         T_conv = est_source.size(-1)
         est_source = F.pad(est_source, (0, T_origin - T_conv))
 
-        # remove hooks
-        for h in handles:
-            h.remove()
-
         return est_source, feat
 
 class ConsistencyLoss(nn.Module):
@@ -294,7 +234,7 @@ class ConsistencyLoss(nn.Module):
                 if loc != 'mask' or loc != '3':
                     c = feat_clean[loc]
                     n = feat_noise[loc]
-                    loss += ((c - n) ** 2).mean()
+                    loss += ((c.float() - n.float()) ** 2).mean()
                 else:
                     loss += PITMSELoss(c, n)
         return loss
@@ -1,6 +1,7 @@
 # Created on 2018/12
 # Author: Kaituo XU
 
+import functools
 from itertools import permutations
 
 import torch
@@ -8,7 +9,26 @@ import torch.nn.functional as F
 
 EPS = 1e-8
 
-
+def fp32_safe(fn):
+    """
+    Run fn with autocast disabled and floating tensors cast to fp32,
+    energies and log10 in SI-SNR underflow/overflow in half precision
+    """
+    def cast(x):
+        if torch.is_tensor(x) and x.is_floating_point():
+            return x.float()
+        return x
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        args = [ cast(a) for a in args ]
+        kwargs = { k: cast(v) for k, v in kwargs.items() }
+        device_type = args[0].device.type
+        with torch.autocast(device_type, enabled = False):
+            return fn(*args, **kwargs)
+    return wrapper
+
+@fp32_safe
 def cal_loss(source, estimate_source, source_lengths):
     """
     Args:
@@ -46,6 +66,7 @@ def cal_norm(unmix, remix1, remix2):
     loss = F.relu(loss)
     return loss
 
+@fp32_safe
 def cal_si_snr_with_pit(source, estimate_source, source_lengths):
     """Calculate SI-SNR with PIT training.
     Args:
@@ -134,6 +155,7 @@ def get_mask(source, source_lengths):
         mask[i, :, source_lengths[i]:] = 0
     return mask
 
+@fp32_safe
 def SISNR(source, sig, source_lengths):
     """
     This sisnr only support no pit sisnr on pytorch
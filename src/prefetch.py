@@ -0,0 +1,101 @@
+
+import queue
+import threading
+
+import torch
+
+import src.utils as utils
+
+def pin_batch(batch):
+    if torch.is_tensor(batch):
+        return batch.pin_memory()
+    if isinstance(batch, dict):
+        return { k: pin_batch(v) for k, v in batch.items() }
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(pin_batch(v) for v in batch)
+    return batch
+
+def batch_to(batch, device, non_blocking = False):
+    if torch.is_tensor(batch):
+        return batch.to(device, non_blocking = non_blocking)
+    if isinstance(batch, dict):
+        return { k: batch_to(v, device, non_blocking) for k, v in batch.items() }
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(batch_to(v, device, non_blocking) for v in batch)
+    return batch
+
+def record_batch(batch, stream):
+    # tell the caching allocator the batch is used on the compute stream
+    if torch.is_tensor(batch):
+        batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for v in batch.values():
+            record_batch(v, stream)
+    elif isinstance(batch, (list, tuple)):
+        for v in batch:
+            record_batch(v, stream)
+
+class Prefetcher():
+    """Infinite iterator over a DataLoader, drop-in for inf_data_gen
+
+    A background thread loops over the loader (one pass = one epoch of the
+    sampler) and keeps `num` batches ready in pinned memory. On cuda the next
+    batch is copied to device on a side stream while the current one is used,
+    so the returned batch is already on DEV (`.to(DEV)` in trainers is a no-op).
+    Every source (sup, uns, pretrained ...) gets its own prefetcher.
+
+    Args:
+        loader: DataLoader, use persistent_workers so epoch boundaries don't restart workers
+        num: number of batches kept ready
+        device: default is DEV
+    """
+    def __init__(self, loader, num = 2, device = None):
+        self.loader = loader
+        self.device = device if device is not None else utils.DEV
+        self.use_cuda = self.device.type == 'cuda'
+        self.pin = self.use_cuda and not loader.pin_memory
+        self.stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+
+        self.queue = queue.Queue(maxsize = num)
+        self.thread = threading.Thread(target = self.worker, daemon = True)
+        self.thread.start()
+        self.next_batch = None
+
+    def worker(self):
+        epoch = 0
+        try:
+            while True:
+                # reshuffle DistributedSampler every pass
+                if hasattr(self.loader.sampler, 'set_epoch'):
+                    self.loader.sampler.set_epoch(epoch)
+                for s in self.loader:
+                    if self.pin:
+                        s = pin_batch(s)
+                    self.queue.put(s)
+                epoch += 1
+        except Exception as e:
+            # re-raised in the main thread
+            self.queue.put(e)
+
+    def preload(self):
+        batch = self.queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        if not self.use_cuda:
+            return batch
+        with torch.cuda.stream(self.stream):
+            return batch_to(batch, self.device, non_blocking = True)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.next_batch is None:
+            self.next_batch = self.preload()
+        batch = self.next_batch
+        if self.use_cuda:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_stream(self.stream)
+            record_batch(batch, stream)
+        self.next_batch = self.preload()
+        return batch
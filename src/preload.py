@@ -0,0 +1,61 @@
+
+import os
+import numpy as np
+import soundfile as sf
+import torch
+
+from tqdm import tqdm
+
+class PreloadArena():
+    """All audio of a dataset in one shared-memory float32 tensor with an offset index
+
+    The tensor is allocated in shared memory (/dev/shm, check its size in
+    docker), DataLoader workers map the same pages instead of copying a dict
+    of numpy arrays, so pre_load of a whole trainset costs one copy of RAM.
+    __getitem__ returns a zero-copy numpy view, don't modify it in place.
+
+    Args:
+        items: list of (key, path)
+    """
+    def __init__(self, items):
+        lengths = [ sf.info(path).frames for _, path in items ]
+        self.data = torch.empty(sum(lengths), dtype = torch.float32).share_memory_()
+        self.index = {}
+
+        offset = 0
+        for (key, path), l in zip(tqdm(items), lengths):
+            audio, _ = sf.read(path)
+            audio = audio.astype(np.float32)[:l]
+            l = len(audio)
+            self.data[offset:offset+l] = torch.from_numpy(audio)
+            self.index[key] = (offset, l)
+            offset += l
+
+        print(f'Pre-load {len(items)} files, {offset * 4 / 2**30:.2f} GB in shared memory')
+
+    def __getitem__(self, key):
+        offset, l = self.index[key]
+        return self.data[offset:offset+l].numpy()
+
+    def __contains__(self, key):
+        return key in self.index
+
+def preload_audio(data, audio_root, uids = None, extra = None):
+    """
+    Args:
+        data: id_list dict, uid -> { speaker: (path, len) }
+        uids: only load these uids (default all)
+        extra: list of additional (key, path), e.g. wham noise
+    Returns:
+        PreloadArena keyed by (uid, speaker)
+    """
+    if uids is None:
+        uids = list(data.keys())
+    items = []
+    for uid in uids:
+        for speaker in data[uid]:
+            path, _ = data[uid][speaker]
+            items.append(((uid, speaker), os.path.join(audio_root, path)))
+    if extra is not None:
+        items += extra
+    return PreloadArena(items)
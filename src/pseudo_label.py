@@ -0,0 +1,168 @@
+"""
+Offline pseudo labels of a frozen teacher (noisy student).
+
+The teacher separates every unlabeled utterance once, outputs are packed into
+raw float32 files and read back by np.memmap, so workers only touch the pages
+of the crops they use. Layout of a store dir (one shard per rank):
+    shard{rank}.bin  C x len float32 of each uid, back to back
+    shard{rank}.pkl  uid -> (offset, C, len)
+    manifest.json    teacher, world_size, #utts, written by rank 0 after every shard
+A dir without manifest (interrupted build) or of another teacher is rebuilt.
+Set by config:
+    solver:
+        ns:
+            offline: True
+            pseudo_dir: ''   # default <save_dir>/pseudo_<uns_dset>, reused if exists
+"""
+
+import os
+import glob
+import json
+import numpy as np
+import _pickle as cPickle
+import torch
+
+from tqdm import tqdm
+
+from src.utils import DEV, NCOL
+from src.distributed import get_rank, get_world_size, is_main_process, barrier, make_loader
+
+class PseudoLabelStore():
+    """
+    Args:
+        store_dir: dir written by build_pseudo_labels
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.index = {}
+        self.bins = []
+        for i, idx_path in enumerate(sorted(glob.glob(os.path.join(store_dir, 'shard*.pkl')))):
+            self.bins.append(idx_path[:-len('.pkl')] + '.bin')
+            for uid, (offset, C, l) in cPickle.load(open(idx_path, 'rb')).items():
+                self.index[uid] = (i, offset, C, l)
+        # opened lazily, in each DataLoader worker
+        self.maps = None
+
+    def __getstate__(self):
+        # memmap would be pickled as a full copy
+        state = self.__dict__.copy()
+        state['maps'] = None
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, uid):
+        return uid in self.index
+
+    def __getitem__(self, uid):
+        """
+        Returns:
+            [C, len] float32, read-only view
+        """
+        if self.maps is None:
+            self.maps = [ np.memmap(path, dtype = np.float32, mode = 'r') if os.path.getsize(path) > 0 else None
+                          for path in self.bins ]
+        i, offset, C, l = self.index[uid]
+        return self.maps[i][offset:offset+C*l].reshape(C, l)
+
+    def missing(self, uids):
+        return [ uid for uid in uids if uid not in self.index ]
+
+    @staticmethod
+    def exists(store_dir, teacher = ''):
+        """
+        Complete store of this teacher (path of its checkpoint, '' for an untrained one)
+        """
+        manifest = read_manifest(store_dir)
+        if manifest is None:
+            return False
+        if manifest['teacher'] != teacher:
+            print(f"Pseudo labels in {store_dir} are of teacher '{manifest['teacher']}', not '{teacher}'")
+            return False
+        shards = glob.glob(os.path.join(store_dir, 'shard*.pkl'))
+        return len(shards) == manifest['world_size']
+
+def manifest_path(store_dir):
+    return os.path.join(store_dir, 'manifest.json')
+
+def read_manifest(store_dir):
+    if not os.path.exists(manifest_path(store_dir)):
+        return None
+    with open(manifest_path(store_dir)) as f:
+        return json.load(f)
+
+def build_pseudo_labels(teacher, dataset, store_dir, amp = None, num_workers = 4, teacher_path = ''):
+    """
+    Run teacher over the full utterances of dataset once (sharded over ranks)
+    Args:
+        teacher: separation model, est_source = teacher(mixture)
+        dataset: eval dataset (wsj0_eval, wham_eval) of the unlabeled train list
+        amp: MixedPrecision of the trainer, teacher runs in its autocast
+        teacher_path: checkpoint of teacher, kept in the manifest
+    Returns:
+        PseudoLabelStore
+    """
+    os.makedirs(store_dir, exist_ok = True)
+    rank = get_rank()
+    world_size = get_world_size()
+    if is_main_process():
+        # invalidate the old store, shards of a larger world size would be read too
+        if os.path.exists(manifest_path(store_dir)):
+            os.remove(manifest_path(store_dir))
+        for path in glob.glob(os.path.join(store_dir, 'shard*.*')):
+            r = int(os.path.basename(path)[len('shard'):].split('.')[0])
+            if r >= world_size:
+                os.remove(path)
+    bin_path = os.path.join(store_dir, f'shard{rank}.bin')
+    idx_path = os.path.join(store_dir, f'shard{rank}.pkl')
+
+    # one utt per batch, no padding inside the teacher
+    loader = make_loader(dataset, batch_size = 1, shuffle = False,
+                         num_workers = num_workers, persistent_workers = False)
+
+    teacher.eval()
+    index = {}
+    offset = 0
+    with open(bin_path, 'wb') as f, torch.no_grad():
+        for sample in tqdm(loader, ncols = NCOL):
+            ilen = sample['ilens'][0].item()
+            mixture = sample['mix'][:, :ilen].to(DEV)
+            if amp is not None:
+                with amp.autocast():
+                    est_source = teacher(mixture)
+            else:
+                est_source = teacher(mixture)
+
+            est = est_source[0].float().cpu().numpy()
+            f.write(est.tobytes())
+            C, l = est.shape
+            index[sample['uid'][0]] = (offset, C, l)
+            offset += C * l
+
+    # index last, a store without index is incomplete
+    cPickle.dump(index, open(idx_path, 'wb'))
+    barrier()
+
+    store = PseudoLabelStore(store_dir)
+    if is_main_process():
+        # last, marks the store complete
+        path = manifest_path(store_dir)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump({ 'teacher': teacher_path, 'world_size': world_size, 'utts': len(store) }, f, indent = 1)
+        os.replace(f'{path}.tmp', path)
+    barrier()
+    print(f'Pseudo labels: {len(store)} utts, {offset * 4 / 2**30:.2f} GB on rank {rank} in {store_dir}')
+    return store
+
+def crop_pseudo(pseudo, s, e, seg_len):
+    """
+    Same crop as mix/ref of train datasets, zero padded to seg_len
+    """
+    audio = pseudo[:, s:e]
+    ilen = audio.shape[1]
+    if ilen < seg_len:
+        base = np.zeros((audio.shape[0], seg_len), dtype = np.float32)
+        base[:, :ilen] = audio
+        audio = base
+    return np.ascontiguousarray(audio)
@@ -17,15 +17,17 @@
                 #changed eps to 1e-5 as better default than 1e-8.
 
 import math
+import time
 import torch
 from torch.optim.optimizer import Optimizer, required
 import itertools as it
+from collections import defaultdict
 
 
 
 class Ranger(Optimizer):
 
-    def __init__(self, params, lr=1e-3, alpha=0.5, k=6, N_sma_threshhold=5, betas=(.95,0.999), eps=1e-5, weight_decay=0):
+    def __init__(self, params, lr=1e-3, alpha=0.5, k=6, N_sma_threshhold=5, betas=(.95,0.999), eps=1e-5, weight_decay=0, foreach=True):
         #parameter checks
         if not 0.0 <= alpha <= 1.0:
             raise ValueError(f'Invalid slow update rate: {alpha}')
@@ -58,6 +60,10 @@ class Ranger(Optimizer):
         self.alpha = alpha
         self.k = k 
 
+        #multi-tensor step (torch._foreach_*), same state layout as the per param step
+        #so optimizer state dicts load either way
+        self.foreach = foreach and hasattr(torch, '_foreach_addcdiv_')
+
         #radam buffer for state
         self.radam_buffer = [[None,None,None] for ind in range(10)]
 
@@ -80,6 +86,102 @@ class Ranger(Optimizer):
 
 
     def step(self, closure=None):
+        if self.foreach:
+            return self.step_foreach(closure)
+        return self.step_loop(closure)
+
+    def radam_step_size(self, step, beta1, beta2):
+        buffered = self.radam_buffer[int(step % 10)]
+        if step == buffered[0]:
+            N_sma, step_size = buffered[1], buffered[2]
+        else:
+            buffered[0] = step
+            beta2_t = beta2 ** step
+            N_sma_max = 2 / (1 - beta2) - 1
+            N_sma = N_sma_max - 2 * step * beta2_t / (1 - beta2_t)
+            buffered[1] = N_sma
+            if N_sma > self.N_sma_threshhold:
+                step_size = math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** step)
+            else:
+                step_size = 1.0 / (1 - beta1 ** step)
+            buffered[2] = step_size
+        return N_sma, step_size
+
+    @torch.no_grad()
+    def step_foreach(self, closure=None):
+        """
+        Same update as step_loop, params sharing (step, device, dtype) are
+        updated together by torch._foreach_* ops
+        """
+        loss = None
+        for group in self.param_groups:
+            beta1, beta2 = group['betas']
+
+            buckets = defaultdict(list)
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                if p.grad.is_sparse:
+                    raise RuntimeError('Ranger optimizer does not support sparse gradients')
+
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(p, dtype = torch.float32)
+                    state['exp_avg_sq'] = torch.zeros_like(p, dtype = torch.float32)
+                    state['slow_buffer'] = p.detach().clone()
+                else:
+                    state['exp_avg'] = state['exp_avg'].float()
+                    state['exp_avg_sq'] = state['exp_avg_sq'].float()
+                buckets[(state['step'], p.device, p.dtype)].append(p)
+
+            for (step, _, dtype), params in buckets.items():
+                step += 1
+                states = [ self.state[p] for p in params ]
+                grads = [ p.grad.float() for p in params ]
+                # float() is a no-op for fp32 params, otherwise an fp32 copy
+                fp32 = [ p.data.float() for p in params ]
+                exp_avgs = [ st['exp_avg'] for st in states ]
+                exp_avg_sqs = [ st['exp_avg_sq'] for st in states ]
+
+                #compute variance mov avg
+                torch._foreach_mul_(exp_avg_sqs, beta2)
+                torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value = 1 - beta2)
+                #compute mean moving avg
+                torch._foreach_mul_(exp_avgs, beta1)
+                torch._foreach_add_(exp_avgs, grads, alpha = 1 - beta1)
+
+                for st in states:
+                    st['step'] = step
+
+                N_sma, step_size = self.radam_step_size(step, beta1, beta2)
+
+                if group['weight_decay'] != 0:
+                    torch._foreach_add_(fp32, fp32, alpha = -group['weight_decay'] * group['lr'])
+
+                if N_sma > self.N_sma_threshhold:
+                    denom = torch._foreach_sqrt(exp_avg_sqs)
+                    torch._foreach_add_(denom, group['eps'])
+                    torch._foreach_addcdiv_(fp32, exp_avgs, denom, value = -step_size * group['lr'])
+                else:
+                    torch._foreach_add_(fp32, exp_avgs, alpha = -step_size * group['lr'])
+
+                if dtype != torch.float32:
+                    for p, p32 in zip(params, fp32):
+                        p.data.copy_(p32)
+
+                #integrated look ahead...
+                if step % group['k'] == 0:
+                    fast = [ p.data for p in params ]
+                    slow = [ st['slow_buffer'] for st in states ]
+                    diff = torch._foreach_sub(fast, slow)
+                    torch._foreach_add_(slow, diff, alpha = self.alpha)
+                    for f, sl in zip(fast, slow):
+                        f.copy_(sl)
+
+        return loss
+
+    def step_loop(self, closure=None):
         loss = None
         #note - below is commented out b/c I have other work that passes back the loss as a float, and thus not a callable closure.  
         #Uncomment if you need to use the actual closure...
@@ -122,36 +224,23 @@ class Ranger(Optimizer):
                 beta1, beta2 = group['betas']
 
                 #compute variance mov avg
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
+                exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value = 1 - beta2)
                 #compute mean moving avg
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
+                exp_avg.mul_(beta1).add_(grad, alpha = 1 - beta1)
 
                 state['step'] += 1
 
 
-                buffered = self.radam_buffer[int(state['step'] % 10)]
-                if state['step'] == buffered[0]:
-                    N_sma, step_size = buffered[1], buffered[2]
-                else:
-                    buffered[0] = state['step']
-                    beta2_t = beta2 ** state['step']
-                    N_sma_max = 2 / (1 - beta2) - 1
-                    N_sma = N_sma_max - 2 * state['step'] * beta2_t / (1 - beta2_t)
-                    buffered[1] = N_sma
-                    if N_sma > self.N_sma_threshhold:
-                        step_size = math.sqrt((1 - beta2_t) * (N_sma - 4) / (N_sma_max - 4) * (N_sma - 2) / N_sma * N_sma_max / (N_sma_max - 2)) / (1 - beta1 ** state['step'])
-                    else:
-                        step_size = 1.0 / (1 - beta1 ** state['step'])
-                    buffered[2] = step_size
+                N_sma, step_size = self.radam_step_size(state['step'], beta1, beta2)
 
                 if group['weight_decay'] != 0:
-                    p_data_fp32.add_(-group['weight_decay'] * group['lr'], p_data_fp32)
+                    p_data_fp32.add_(p_data_fp32, alpha = -group['weight_decay'] * group['lr'])
 
                 if N_sma > self.N_sma_threshhold:
                     denom = exp_avg_sq.sqrt().add_(group['eps'])
-                    p_data_fp32.addcdiv_(-step_size * group['lr'], exp_avg, denom)
+                    p_data_fp32.addcdiv_(exp_avg, denom, value = -step_size * group['lr'])
                 else:
-                    p_data_fp32.add_(-step_size * group['lr'], exp_avg)
+                    p_data_fp32.add_(exp_avg, alpha = -step_size * group['lr'])
 
                 p.data.copy_(p_data_fp32)
 
@@ -159,7 +248,45 @@ class Ranger(Optimizer):
                 #we do it at the param level instead of group level
                 if state['step'] % group['k'] == 0:
                     slow_p = state['slow_buffer'] #get access to slow param tensor
-                    slow_p.add_(self.alpha, p.data - slow_p)  #(fast weights - slow weights) * alpha
+                    slow_p.add_(p.data - slow_p, alpha = self.alpha)  #(fast weights - slow weights) * alpha
                     p.data.copy_(slow_p)  #copy interpolated weights to RAdam param tensor
 
         return loss
+
+def benchmark_ranger(steps = 50, device = 'cpu'):
+    """
+    Time step_loop vs step_foreach on the ConvTasNet (baseline.yaml) parameter
+    layout, and check both give the same params
+    """
+    import yaml
+    from src.conv_tasnet import ConvTasNet
+
+    config = yaml.load(open('./config/train/baseline.yaml'), Loader = yaml.FullLoader)
+    torch.manual_seed(0)
+    model = ConvTasNet(config['model']).to(device)
+    params = [ p for p in model.parameters() ]
+    print(f'{len(params)} tensors, {sum(p.numel() for p in params)} params')
+    grads = [ [ torch.randn_like(p) * 1e-2 for p in params ] for _ in range(4) ]
+
+    results = {}
+    for foreach in [ False, True ]:
+        ps = [ p.detach().clone().requires_grad_() for p in params ]
+        opt = Ranger(ps, lr = 1e-3, foreach = foreach)
+        if device != 'cpu':
+            torch.cuda.synchronize()
+        start = time.time()
+        for i in range(steps):
+            for p, g in zip(ps, grads[i % len(grads)]):
+                p.grad = g
+            opt.step()
+        if device != 'cpu':
+            torch.cuda.synchronize()
+        t = (time.time() - start) / steps
+        results[foreach] = ps
+        print(f'foreach = {foreach}: {t * 1000:.2f} ms / step')
+
+    diff = max((a - b).abs().max().item() for a, b in zip(results[False], results[True]))
+    print(f'max param diff: {diff}')
+
+if __name__ == '__main__':
+    benchmark_ranger()
@@ -0,0 +1,200 @@
+"""
+Audio cache shared by all DataLoader workers of one process (rank).
+
+Decoded audio is stored in a shared-memory float32 arena split into fixed
+size blocks. The LRU index (entry table and block owners) is a set of shared
+int64 tensors guarded by one process-shared lock, so every worker sees the
+same entries without a round trip to another process, and a file read by
+one worker in epoch 1 is served from RAM to any worker afterwards. Set size
+by config:
+    data:
+        cache_mb: 2048   # 0: no cache
+Only original audio is cached (no speed perturb), keyed by file path.
+"""
+
+import os
+import math
+import random
+import hashlib
+import threading
+import functools
+import numpy as np
+import soundfile as sf
+import torch
+import torch.multiprocessing as mp
+
+# columns of the entry table
+KEY, GEN, STATE, TICK, PID, TID, NUMEL, NDIM, DIM0, DIM1 = range(10)
+# entry states
+EMPTY, WRITING, READY = 0, 1, 2
+# shared counters
+C_GEN, C_CLOCK, C_HITS, C_MISSES = range(4)
+
+def key_hash(key):
+    # stable across processes (str hash is salted per interpreter)
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size = 8).digest(), 'little', signed = True)
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class SharedLRUCache():
+    """
+    Args:
+        size_mb: arena size
+        block_size: #samples of a block, build_sample_cache uses 1 sec (data.sample_rate)
+    Every entry holds at least one block, so the entry table has num_blocks rows.
+    Readers copy outside the lock and check the entry generation afterwards,
+    since an entry may be evicted and its blocks reused while they copy.
+    An entry stays WRITING between allocation and commit, entries of a dead
+    worker (or an aborted put) are freed by the next allocation.
+    """
+    def __init__(self, size_mb, block_size = 16000):
+        self.block_size = block_size
+        self.num_blocks = int(size_mb * 2**20 / 4) // block_size
+        self.arena = torch.zeros(self.num_blocks, block_size).share_memory_()
+
+        self.entries = torch.zeros(self.num_blocks, 10, dtype = torch.int64).share_memory_()
+        # entry of each block, -1: free
+        self.block_owner = torch.full((self.num_blocks,), -1, dtype = torch.int64).share_memory_()
+        self.counters = torch.zeros(4, dtype = torch.int64).share_memory_()
+        self.lock = mp.Lock()
+        print(f'Sample cache: {size_mb} MB, {self.num_blocks} blocks')
+
+    def find(self, h, states):
+        # entry index of key hash h in one of states, -1 if none
+        match = (self.entries[:, KEY] == h) & torch.isin(self.entries[:, STATE], torch.tensor(states))
+        idx = match.nonzero()
+        return idx[0, 0].item() if len(idx) > 0 else -1
+
+    def evict(self, e):
+        self.block_owner[self.block_owner == e] = -1
+        self.entries[e, STATE] = EMPTY
+        self.entries[e, GEN] = -1
+
+    def reclaim(self, pid, tid):
+        # uncommitted entries of dead workers, or an older aborted put of this thread
+        # (prefetch threads of one process may put concurrently)
+        for e in (self.entries[:, STATE] == WRITING).nonzero()[:, 0].tolist():
+            p, t = self.entries[e, PID].item(), self.entries[e, TID].item()
+            if (p, t) == (pid, tid) or not pid_alive(p):
+                self.evict(e)
+
+    def get(self, key):
+        h = key_hash(key)
+        with self.lock:
+            e = self.find(h, [ READY ])
+            if e < 0:
+                self.counters[C_MISSES] += 1
+                return None
+            self.counters[C_HITS] += 1
+            self.counters[C_CLOCK] += 1
+            self.entries[e, TICK] = self.counters[C_CLOCK]
+            entry = self.entries[e].tolist()
+            blocks = (self.block_owner == e).nonzero()[:, 0]
+
+        shape = entry[DIM0:DIM0+entry[NDIM]]
+        data = self.arena[blocks].view(-1)[:entry[NUMEL]].numpy().astype(np.float64).reshape(shape)
+        now = self.entries[e].tolist()
+        if now[GEN] != entry[GEN] or now[STATE] != READY:
+            return None
+        return data
+
+    def put(self, key, audio):
+        n = max(math.ceil(audio.size / self.block_size), 1)
+        if n > self.num_blocks or audio.ndim > 2:
+            return
+        h = key_hash(key)
+        pid, tid = os.getpid(), threading.get_native_id()
+        with self.lock:
+            if self.find(h, [ WRITING, READY ]) >= 0:
+                return
+            self.reclaim(pid, tid)
+            # evict least recently used, entries being written are kept
+            free = (self.block_owner < 0).nonzero()[:, 0]
+            while len(free) < n:
+                ready = self.entries[:, STATE] == READY
+                if not ready.any():
+                    return
+                ticks = self.entries[:, TICK].masked_fill(~ready, torch.iinfo(torch.int64).max)
+                self.evict(ticks.argmin().item())
+                free = (self.block_owner < 0).nonzero()[:, 0]
+
+            # fewer entries than used blocks, so an empty row exists
+            e = (self.entries[:, STATE] == EMPTY).nonzero()[0, 0].item()
+            blocks = free[:n]
+            self.counters[C_GEN] += 1
+            gen = self.counters[C_GEN].item()
+            dims = list(audio.shape) + [ 0 ] * (2 - audio.ndim)
+            self.block_owner[blocks] = e
+            self.entries[e] = torch.tensor([ h, gen, WRITING, 0, pid, tid, audio.size, audio.ndim ] + dims)
+
+        flat = torch.from_numpy(audio.reshape(-1).astype(np.float32))
+        for i, b in enumerate(blocks.tolist()):
+            chunk = flat[i*self.block_size:(i+1)*self.block_size]
+            self.arena[b, :chunk.numel()] = chunk
+
+        with self.lock:
+            if self.entries[e, GEN].item() == gen:
+                self.counters[C_CLOCK] += 1
+                self.entries[e, TICK] = self.counters[C_CLOCK]
+                self.entries[e, STATE] = READY
+
+    def stats(self):
+        with self.lock:
+            used = (self.block_owner >= 0).sum().item()
+            return { 'entries': (self.entries[:, STATE] != EMPTY).sum().item(), 'used_blocks': used,
+                     'num_blocks': self.num_blocks, 'hits': self.counters[C_HITS].item(),
+                     'misses': self.counters[C_MISSES].item() }
+
+def read_audio(path, cache = None):
+    """
+    Same as sf.read(path)[0], served from cache if given.
+    16 bit audio is exact in float32, so cached audio is identical.
+    """
+    if cache is None:
+        audio, _ = sf.read(path)
+        return audio
+    audio = cache.get(path)
+    if audio is None:
+        audio, _ = sf.read(path)
+        cache.put(path, audio)
+    return audio
+
+_cache = None
+
+def set_sample_cache(cache):
+    global _cache
+    _cache = cache
+
+def get_sample_cache():
+    return _cache
+
+def build_sample_cache(data_config):
+    size_mb = data_config.get('cache_mb', 0)
+    if size_mb > 0 and _cache is None:
+        set_sample_cache(SharedLRUCache(size_mb, block_size = data_config.get('sample_rate', 8000)))
+    return _cache
+
+def attach_cache(dataset):
+    # datasets with a `cache` attribute read audio through read_audio
+    if hasattr(dataset, 'cache') and dataset.cache is None:
+        dataset.cache = _cache
+
+def seed_worker(worker_id, rank = 0):
+    """
+    worker_init_fn, torch seeds each worker with base_seed + worker_id,
+    also seed numpy/random and decorrelate ranks (same base_seed on every rank)
+    """
+    seed = (torch.initial_seed() + 1000003 * rank) % 2**32
+    torch.manual_seed(seed)
+    random.seed(seed)
+    np.random.seed(seed)
+
+def worker_init_fn(rank = 0):
+    return functools.partial(seed_worker, rank = rank)
@@ -1,13 +1,116 @@
 
 import os
+import json
+import queue
+import atexit
+import threading
 import torch
 
 from glob import glob
 from functools import cmp_to_key
 
-class Saver(object):
+from src.distributed import rank_zero_only, is_main_process
+from src.checkpoint import load_meta
+
+def to_cpu(obj):
+    """
+    Snapshot of a (nested) state dict, tensors are copied to cpu so training
+    can go on updating the originals while the copy is written
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy = True)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+def atomic_save(obj, path):
+    # readers never see a partial file, a crash leaves the old one
+    tmp = f'{path}.tmp'
+    torch.save(obj, tmp)
+    os.replace(tmp, path)
+
+def can_hard_link(d):
+    # probe once per save dir, e.g. some network filesystems have no hard links
+    src = os.path.join(d, '.link_probe')
+    dst = f'{src}.link'
+    try:
+        open(src, 'w').close()
+        os.link(src, dst)
+        return True
+    except OSError:
+        return False
+    finally:
+        for p in [ src, dst ]:
+            if os.path.lexists(p):
+                os.remove(p)
+
+def state_version(model, info_dict):
+    """
+    Cheap fingerprint of what a save would write: in-place updates of params
+    (optimizer steps) bump tensor versions, scalar entries (epoch, step, ...)
+    are compared by value
+    """
+    versions = sum(p._version for p in model.parameters())
+    scalars = tuple((k, v) for k, v in info_dict.items() if isinstance(v, (int, float, str)))
+    return versions, scalars
+
+def atomic_link(src, path):
+    # same payload already on disk, hard link instead of serializing again
+    tmp = f'{path}.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.link(src, tmp)
+    os.replace(tmp, path)
+
+class CheckpointWriter():
+    """Background thread running write jobs in submit order
+
+    Errors of a job are raised in the main thread at the next submit/flush.
+    Args:
+        max_pending: submit blocks when this many jobs are queued (bounds cpu copies)
+    """
+    def __init__(self, max_pending = 2):
+        self.queue = queue.Queue(maxsize = max_pending)
+        self.error = None
+        self.thread = threading.Thread(target = self.worker, daemon = True)
+        self.thread.start()
+
+    def worker(self):
+        while True:
+            fn, args = self.queue.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def check(self):
+        if self.error is not None:
+            e, self.error = self.error, None
+            raise e
+
+    def submit(self, fn, *args):
+        self.check()
+        self.queue.put((fn, args))
+
+    def flush(self):
+        self.queue.join()
+        self.check()
 
-    def __init__(self, max_save_num, save_dir, keep, resume = False, resume_score_fn = None):
+class Saver(object):
+    # Only rank 0 writes checkpoints under distributed training
+    # index.json lists the kept checkpoints (score, path, epoch, step), resume
+    # reads it instead of loading every checkpoint.
+    # Writes are async by default: state is copied to cpu, then a background
+    # thread writes it to a temp file and os.replace-s it in. Saving the same
+    # model and info_dict again (e.g. latest.pth after {epoch}.pth) hard links
+    # the file already written, as long as params and scalar entries of
+    # info_dict are unchanged (state_version) and save_dir supports hard links.
+    # No payload is kept after its write. Call flush() before reading checkpoints.
+
+    def __init__(self, max_save_num, save_dir, keep, resume = False, resume_score_fn = None, async_write = True):
         # keep: min, max
         assert keep in ['min', 'max']
 
@@ -21,25 +124,76 @@ class Saver(object):
         else:
             self.reverse = False
 
-        if resume:
+        self.writer = None
+        if async_write and is_main_process():
+            self.writer = CheckpointWriter()
+            atexit.register(self.flush)
+        # (model, info_dict, state_version, path) of the last save, for dedupe
+        self.last_save = None
+        self.can_link = None
+
+        if resume and is_main_process():
             # resume_score_fn: a callable function to get score for sorting
             if resume_score_fn == None:
                 print('Specify function to get sorting score')
 
-            # exclude latest.pth
-            paths = glob(os.path.join(self.save_dir, '[!latest]*.pth'))
-            save_list = []
-            for path in paths:
-                info_dict = torch.load(path)
-                score = resume_score_fn(info_dict)
-                save_list.append({'score': score, 'path': path})
+            save_list = self.read_index()
+            if save_list is None:
+                save_list = self.scan_checkpoints(resume_score_fn)
             save_list = sorted(save_list, key = lambda x: x['score'], reverse = self.reverse)
             self.save_list = save_list[:self.max_save_num]
 
+    def index_path(self):
+        return os.path.join(self.save_dir, 'index.json')
+
+    def read_index(self):
+        """
+        save_list from index.json (written by update), None if missing
+        """
+        if not os.path.exists(self.index_path()):
+            return None
+        with open(self.index_path()) as f:
+            items = json.load(f)
+        save_list = []
+        for item in items:
+            item['path'] = os.path.join(self.save_dir, item['path'])
+            if os.path.exists(item['path']):
+                save_list.append(item)
+        print(f'Resume {len(save_list)} checkpoints from {self.index_path()}')
+        return save_list
+
+    def scan_checkpoints(self, resume_score_fn):
+        # no index (older exp), read metadata of every checkpoint
+        # exclude latest.pth
+        paths = glob(os.path.join(self.save_dir, '[!latest]*.pth'))
+        save_list = []
+        for path in paths:
+            info_dict = load_meta(path)
+            score = resume_score_fn(info_dict)
+            save_list.append({ 'score': score, 'path': path,
+                               'epoch': info_dict.get('epoch'), 'step': info_dict.get('step') })
+        return save_list
+
+    def write_index(self):
+        items = [ { 'score': float(item['score']), 'path': os.path.basename(item['path']),
+                    'epoch': item.get('epoch'), 'step': item.get('step') } for item in self.save_list ]
+        path = self.index_path()
+        def write():
+            with open(f'{path}.tmp', 'w') as f:
+                json.dump(items, f, indent = 4)
+            os.replace(f'{path}.tmp', path)
+        # after the checkpoint writes it lists
+        if self.writer is not None:
+            self.writer.submit(write)
+        else:
+            write()
+
+    @rank_zero_only
     def force_save(self, model, model_name, info_dict = None):
         path = os.path.join(self.save_dir, model_name)
         self.save(model, path, info_dict)
 
+    @rank_zero_only
     def logging(self):
         with open(os.path.join(self.save_dir, 'save.log'), 'w') as f:
             for item in self.save_list[::-1]:
@@ -47,21 +201,65 @@ class Saver(object):
                 p = item['path']
                 f.write(f'{p}: {s}\n')
 
+    @rank_zero_only
+    def flush(self):
+        # wait until all queued checkpoints are on disk
+        if self.writer is not None:
+            self.writer.flush()
+
+    def remove(self, path):
+        # queued after the writes, so a pending write can't recreate it
+        if self.writer is not None:
+            self.writer.submit(os.remove, path)
+        else:
+            os.remove(path)
+
     def save(self, model, path, info_dict = None):
 
+        # unwrap DataParallel-like module
+        if hasattr(model, 'module'):
+            model = model.module
+
+        last = self.last_save
+        if last is not None and last[0] is model and last[1] is info_dict and info_dict is not None \
+                and last[3] != path and last[2] == state_version(model, info_dict) and self.link_supported():
+            # nothing changed since the last save, same payload
+            self.last_save = (model, info_dict, last[2], path)
+            if self.writer is not None:
+                # queued after the write of last[3]
+                self.writer.submit(atomic_link, last[3], path)
+                return
+            try:
+                atomic_link(last[3], path)
+                return
+            except OSError:
+                # src removed, write again from the current state
+                pass
+
         if info_dict is None:
             info_dict = { 'state_dict': model.state_dict() }
         else:
             info_dict['state_dict'] = model.state_dict()
 
-        torch.save(info_dict, path)
+        if self.writer is not None:
+            self.writer.submit(atomic_save, to_cpu(info_dict), path)
+        else:
+            atomic_save(info_dict, path)
+        self.last_save = (model, info_dict, state_version(model, info_dict), path)
+
+    def link_supported(self):
+        if self.can_link is None:
+            self.can_link = can_hard_link(self.save_dir)
+        return self.can_link
 
+    @rank_zero_only
     def update(self, model, score, model_name, info_dict = None):
 
         path = os.path.join(self.save_dir, model_name)
+        meta = info_dict if info_dict is not None else {}
+        item = { 'score': score, 'path': path, 'epoch': meta.get('epoch'), 'step': meta.get('step') }
 
         if len(self.save_list) < self.max_save_num:
-            item = { 'score': score, 'path': path }
             self.save_list.append(item)
             self.save(model, path, info_dict)
 
@@ -76,11 +274,12 @@ class Saver(object):
                 flag = score > m_score
 
             if flag:
-                os.remove(self.save_list[0]['path'])
-                self.save_list[0] = { 'score': score, 'path': path }
+                self.remove(self.save_list[0]['path'])
+                self.save_list[0] = item
                 self.save(model, path, info_dict)
                 self.save_list = sorted(self.save_list, key = lambda x: x['score'], reverse = self.reverse)
 
+        self.write_index()
         self.logging()
 
     @staticmethod
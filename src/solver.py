@@ -1,14 +1,74 @@
 
 import os
+import math
 import importlib
+import torch
 from src.utils import read_path_conf
+from src.sample_cache import build_sample_cache
 
 class Solver():
     def __init__(self, config):
         self.config = config
         self.test_after_finished = self.config['solver'].get('test_after_finished', True)
 
+        # gradient accumulation, optimizer steps every accum_steps micro-batches
+        self.accum_steps = self.config['solver'].get('accum_steps', 1)
+        self.step_meta = {}
+        self.step_meta_cnt = 0
+
+        # audio cache shared by DataLoader workers, data.cache_mb (0: off)
+        build_sample_cache(self.config.get('data', {}))
+        # pre load trainset/devset into one shared-memory arena (src/preload.py)
+        self.pre_load = self.config.get('data', {}).get('pre_load', False)
+
+    def accum_steps_of(self, n):
+        # optimizer steps of an epoch with n micro-batches
+        return math.ceil(n / self.accum_steps)
+
+    def is_accum_start(self, i):
+        return i % self.accum_steps == 0
+
+    def is_accum_end(self, i, n):
+        return (i + 1) % self.accum_steps == 0 or (i + 1) == n
+
+    def accum_loss(self, loss):
+        """
+        Each micro-batch loss is a batch mean (cal_loss), scale it so the
+        accumulated grad is the mean over the whole effective batch
+        """
+        return loss / self.accum_steps
+
+    def rescale_tail_grads(self, models, i):
+        """
+        Last window of an epoch may have less than accum_steps micro-batches,
+        rescale grads so it is still a mean. Call before grad clipping.
+        """
+        k = i % self.accum_steps + 1
+        if k == self.accum_steps:
+            return
+        for model in models:
+            for p in model.parameters():
+                if p.grad is not None:
+                    p.grad.mul_(self.accum_steps / k)
+
+    def accum_meta(self, meta):
+        # tensors are summed on device, Dashboard syncs them every few steps
+        for k, v in meta.items():
+            v = v.detach() if torch.is_tensor(v) else float(v)
+            self.step_meta[k] = self.step_meta.get(k, 0.) + v
+        self.step_meta_cnt += 1
+
+    def pop_step_meta(self):
+        # meta averaged over micro-batches of one optimizer step
+        meta = { k: v / self.step_meta_cnt for k, v in self.step_meta.items() }
+        self.step_meta = {}
+        self.step_meta_cnt = 0
+        return meta
+
     def construct_test_conf(self, dsets = 'all', sdir = '', choose_best = False, compute_sdr = False):
+        # checkpoints are written in background
+        if hasattr(self, 'saver'):
+            self.saver.flush()
         exp_name = os.path.basename(self.save_dir)
         if dsets == 'all':
             dsets = [ 'wsj0', 'vctk', 'wham', 'wham-easy', 'wsj0-vctk' ]
@@ -1,13 +1,12 @@
 import os
 import time
 import yaml
-import json
 import datetime
 
 import torch
 
 from tqdm import tqdm
-from torch.utils.data import DataLoader
+from src.distributed import make_loader
 
 from src.solver import Solver
 from src.utils import DEV, DEBUG, NCOL, read_scale
@@ -18,6 +17,8 @@ from src.wham import wham_eval
 from src.evaluation import cal_SDR, cal_SISNRi
 from src.sep_utils import remove_pad, load_mix_sdr
 from src.gender_mapper import GenderMapper
+from src.checkpoint import load_state_dict
+from src.eval_pipeline import EvalPipeline, dump_result
 
 class Tester(Solver):
     def __init__(self, config):
@@ -31,26 +32,39 @@ class Tester(Solver):
 
         self.checkpoint = config['solver']['checkpoint']
 
-        self.batch_size = 1
-        self.num_workers = 4
+        # batch_size > 1 pads a batch to its longest utt, gLN statistics then
+        # include the padding of shorter utts, 1 gives the reference numbers
+        self.batch_size = config['solver'].get('batch_size', 1)
+        self.num_workers = config['solver'].get('num_workers', 4)
 
-        save_dict = torch.load(self.checkpoint, map_location=torch.device('cpu'))
+        # only state_dict is read, optim stays on disk
+        state_dict, save_dict = load_state_dict(self.checkpoint)
         self.epoch = save_dict['epoch']
         self.valid_score = save_dict['valid_score']
-        self.optim_dict = save_dict['optim']
 
-        state_dict = save_dict['state_dict']
         self.set_model(state_dict)
 
         self.compute_sdr = config['solver'].get('compute_sdr', False)
         self.g_mapper = GenderMapper()
 
     def load_dset(self, dset):
+        devset, testset = self.load_sets(dset)
+        cv_loader = make_loader(devset,
+                batch_size = self.batch_size,
+                shuffle = False,
+                num_workers = self.num_workers)
+        tt_loader = make_loader(testset,
+                batch_size = self.batch_size,
+                shuffle = False,
+                num_workers = self.num_workers)
+        return cv_loader, tt_loader
+
+    def load_sets(self, dset):
         # root: wsj0_root, vctk_root, libri_root
         d = 'wsj' if dset == 'wsj0' else dset # stupid error
         if 'wham' in dset:
             # load wham, wham-easy
-            return self.load_wham(dset)
+            return self.load_wham_sets(dset)
 
         audio_root = self.config['data'][f'{d}_root']
         cv_list = f'./data/{dset}/id_list/cv.pkl'
@@ -62,21 +76,12 @@ class Tester(Solver):
         devset = wsj0_eval(cv_list,
                 audio_root = audio_root,
                 pre_load = False)
-        cv_loader = DataLoader(devset,
-                batch_size = self.batch_size,
-                shuffle = False,
-                num_workers = self.num_workers)
-
         testset = wsj0_eval(tt_list,
                 audio_root = audio_root,
                 pre_load = False)
-        tt_loader = DataLoader(testset,
-                batch_size = self.batch_size,
-                shuffle = False,
-                num_workers = self.num_workers)
-        return cv_loader, tt_loader
+        return devset, testset
 
-    def load_wham(self, dset):
+    def load_wham_sets(self, dset):
         audio_root = self.config['data'][f'wsj_root']
         cv_list = f'./data/wsj0/id_list/cv.pkl'
         tt_list = f'./data/wsj0/id_list/tt.pkl'
@@ -89,21 +94,12 @@ class Tester(Solver):
                 pre_load = False,
                 mode = 'cv',
                 scale = scale)
-        cv_loader = DataLoader(devset,
-                batch_size = self.batch_size,
-                shuffle = False,
-                num_workers = self.num_workers)
-
         testset = wham_eval(tt_list,
                 audio_root = audio_root,
                 pre_load = False,
                 mode = 'tt',
                 scale = scale)
-        tt_loader = DataLoader(testset,
-                batch_size = self.batch_size,
-                shuffle = False,
-                num_workers = self.num_workers)
-        return cv_loader, tt_loader
+        return devset, testset
 
     def set_model(self, state_dict):
         model_type = self.tr_config['model'].get('type', 'convtasnet')
@@ -137,21 +133,22 @@ class Tester(Solver):
                 sdr_keys.append(f'{splt}_{g}')
         sdr_keys = splts + sdr_keys
 
+        # all dset/split pairs share one worker pool, next split loads while this one runs
+        splits = []
+        sdr0 = {}
         for dset in dsets:
-            cv_loader, tt_loader = self.load_dset(dset)
-            sdr0 = load_mix_sdr(f'./data/{dset}/mix_sdr/', sdr_keys)
-
+            devset, testset = self.load_sets(dset)
+            splits += [ ((dset, 'cv'), devset), ((dset, 'tt'), testset) ]
+            sdr0[dset] = load_mix_sdr(f'./data/{dset}/mix_sdr/', sdr_keys)
             result_dict[dset] = {}
 
-            r = self.evaluate(cv_loader, 'cv', dset, sdr0)
-            result_dict[dset]['cv'] = r
-
-            r = self.evaluate(tt_loader, 'tt', dset, sdr0)
-            result_dict[dset]['tt'] = r
-
         result_dict['tr_config'] = self.tr_config
         rname = os.path.join(self.result_dir, 'result.json')
-        json.dump(result_dict, open(rname, 'w'), indent = 1)
+        pipeline = EvalPipeline(splits, self.batch_size, self.num_workers)
+        for (dset, splt), loader in pipeline:
+            result_dict[dset][splt] = self.evaluate(loader, splt, dset, sdr0[dset])
+            # partial result survives an interrupted run
+            dump_result(result_dict, rname)
         return result_dict
 
     def evaluate(self, loader, dset, dataset, sdr0):
@@ -182,9 +179,8 @@ class Tester(Solver):
                 loss, max_snr, estimate_source, reorder_estimate_source = \
                     cal_loss(padded_source, estimate_source, mixture_lengths)
 
-                total_loss += loss.item()
-
                 B = reorder_estimate_source.size(0)
+                total_loss += loss.item() * B
                 total_cnt += B
 
                 padded_mixture = remove_pad(padded_mixture, mixture_lengths)
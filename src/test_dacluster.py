@@ -12,7 +12,7 @@ import torch.nn.functional as F
 from tqdm import tqdm
 from tsnecuda import TSNE
 from sklearn.decomposition import PCA
-from torch.utils.data import DataLoader
+from src.distributed import make_loader
 
 import src.cka as cka
 from src.solver import Solver
@@ -26,6 +26,7 @@ from src.wham import wham_eval, wham_parallel_eval
 from src.evaluation import cal_SDR, cal_SISNRi
 from src.sep_utils import remove_pad, load_mix_sdr
 from src.gender_mapper import GenderMapper
+from src.checkpoint import load_state_dict
 
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
@@ -104,7 +105,7 @@ class Tester(Solver):
         devset = wsj0_eval(cv_list,
                 audio_root = audio_root,
                 pre_load = False)
-        cv_loader = DataLoader(devset,
+        cv_loader = make_loader(devset,
                 batch_size = self.batch_size,
                 shuffle = False,
                 num_workers = self.num_workers)
@@ -112,7 +113,7 @@ class Tester(Solver):
         testset = wsj0_eval(tt_list,
                 audio_root = audio_root,
                 pre_load = False)
-        tt_loader = DataLoader(testset,
+        tt_loader = make_loader(testset,
                 batch_size = self.batch_size,
                 shuffle = False,
                 num_workers = self.num_workers)
@@ -131,7 +132,7 @@ class Tester(Solver):
                 pre_load = False,
                 mode = 'cv',
                 scale = scale)
-        cv_loader = DataLoader(devset,
+        cv_loader = make_loader(devset,
                 batch_size = self.batch_size,
                 shuffle = False,
                 num_workers = self.num_workers)
@@ -141,7 +142,7 @@ class Tester(Solver):
                 pre_load = False,
                 mode = 'tt',
                 scale = scale)
-        tt_loader = DataLoader(testset,
+        tt_loader = make_loader(testset,
                 batch_size = self.batch_size,
                 shuffle = False,
                 num_workers = self.num_workers)
@@ -155,10 +156,9 @@ class Tester(Solver):
         print(f'Load: {checkpoint}')
 
         tr_config = yaml.load(open(tr_config), Loader=yaml.FullLoader)
-        save_dict = torch.load(checkpoint, map_location=torch.device('cpu'))
+        state_dict, save_dict = load_state_dict(checkpoint)
         epoch = save_dict['epoch']
         valid_score = save_dict['valid_score']
-        state_dict = save_dict['state_dict']
 
         if 'gen' in tr_config['model']:
             mconf = tr_config['model']['gen']
@@ -0,0 +1,216 @@
+import os
+import yaml
+import json
+
+import torch
+
+from tqdm import tqdm
+
+from src.solver import Solver
+from src.test_baseline import Tester as BaselineTester
+from src.utils import DEV, NCOL
+from src.conv_tasnet import ConvTasNet
+from src.da_conv_tasnet import DAConvTasNet
+from src.pit_criterion import cal_loss
+from src.evaluation import cal_SDR, cal_SISNR
+from src.sep_utils import remove_pad, load_mix_sdr
+from src.gender_mapper import GenderMapper
+from src.checkpoint import load_state_dict
+from src.eval_pipeline import EvalPipeline, dump_result
+
+class Tester(BaselineTester):
+    """Evaluate many checkpoints of one training config with one data pass
+
+    Every eval batch is read and decoded once, then run by all models.
+    Mixture SI-SNR (baseline of SI-SNRi) and mix SDR are computed once.
+    Config (solver):
+        checkpoints: [ path, ... ]
+        or
+        save_dir: exp dir of Saver, its kept checkpoints (index.json / save.log)
+        top_k: only the best k of save_dir (0: all)
+    """
+    def __init__(self, config):
+        Solver.__init__(self, config)
+
+        self.tr_config = config['solver']['train_config']
+        self.tr_config = yaml.load(open(self.tr_config), Loader=yaml.FullLoader)
+
+        self.result_dir = config['solver']['result_dir']
+        self.safe_mkdir(self.result_dir)
+
+        self.batch_size = config['solver'].get('batch_size', 1)
+        self.num_workers = config['solver'].get('num_workers', 4)
+
+        self.checkpoints = self.list_checkpoints(config['solver'])
+        self.models = {}
+        self.epochs = {}
+        for path in self.checkpoints:
+            print(f'Load: {path}')
+            state_dict, save_dict = load_state_dict(path)
+            name = os.path.basename(path)
+            self.epochs[name] = save_dict.get('epoch')
+            self.models[name] = self.build_model(state_dict)
+
+        self.compute_sdr = config['solver'].get('compute_sdr', False)
+        self.g_mapper = GenderMapper()
+
+    @staticmethod
+    def list_checkpoints(conf):
+        if len(conf.get('checkpoints', [])) > 0:
+            return conf['checkpoints']
+
+        save_dir = conf['save_dir']
+        index_path = os.path.join(save_dir, 'index.json')
+        if os.path.exists(index_path):
+            items = json.load(open(index_path))
+            items = [ (item['score'], os.path.join(save_dir, item['path'])) for item in items ]
+        else:
+            # save.log: '<path>: <score>', best first
+            items = []
+            for line in open(os.path.join(save_dir, 'save.log')):
+                path, score = line.rstrip().rsplit(':', 1)
+                items.append((float(score), path))
+        # higher score first
+        items = sorted(items, key = lambda x: x[0], reverse = True)
+        top_k = conf.get('top_k', 0)
+        if top_k > 0:
+            items = items[:top_k]
+        return [ path for _, path in items ]
+
+    def build_model(self, state_dict):
+        if 'gen' in self.tr_config['model']:
+            model = DAConvTasNet(self.tr_config['model']['gen']).to(DEV)
+        else:
+            model = ConvTasNet(self.tr_config['model']).to(DEV)
+        model.load_state_dict(state_dict)
+        model.eval()
+        return model
+
+    def separate(self, model, mixture):
+        estimate_source = model(mixture)
+        # DAConvTasNet returns (est_source, feature)
+        if isinstance(estimate_source, tuple):
+            estimate_source = estimate_source[0]
+        return estimate_source
+
+    def exec(self):
+        dsets = self.config['data']['dsets']
+
+        ds = ', '.join(dsets)
+        print(f"Evaluate {len(self.models)} checkpoints on following datasets: {ds}")
+
+        result_dict = { name: {} for name in self.models }
+
+        splts = [ 'cv', 'tt' ]
+        gs = [ 'MM', 'FF', 'MF' ]
+        sdr_keys = []
+        for splt in splts:
+            for g in gs:
+                sdr_keys.append(f'{splt}_{g}')
+        sdr_keys = splts + sdr_keys
+
+        splits = []
+        sdr0 = {}
+        for dset in dsets:
+            devset, testset = self.load_sets(dset)
+            splits += [ ((dset, 'cv'), devset), ((dset, 'tt'), testset) ]
+            sdr0[dset] = load_mix_sdr(f'./data/{dset}/mix_sdr/', sdr_keys)
+
+        result_dict['tr_config'] = self.tr_config
+        result_dict['epochs'] = self.epochs
+        rname = os.path.join(self.result_dir, 'sweep.json')
+        pipeline = EvalPipeline(splits, self.batch_size, self.num_workers)
+        for (dset, splt), loader in pipeline:
+            rs = self.evaluate(loader, splt, dset, sdr0[dset])
+            for name, r in rs.items():
+                result_dict[name].setdefault(dset, {})[splt] = r
+            dump_result(result_dict, rname)
+
+        self.print_table(result_dict, dsets, splts)
+        return result_dict
+
+    def print_table(self, result_dict, dsets, splts):
+        cols = [ f'{dset}_{splt}' for dset in dsets for splt in splts ]
+        print(' | '.join([ 'checkpoint' ] + cols))
+        for name in self.models:
+            row = [ f"{result_dict[name][dset][splt]['total_SISNRi']:.2f}" for dset in dsets for splt in splts ]
+            print(' | '.join([ name ] + row))
+
+    def evaluate(self, loader, dset, dataset, sdr0):
+        names = list(self.models.keys())
+        gs = [ 'MM', 'FF', 'MF' ]
+
+        total_loss = { n: 0. for n in names }
+        total_SISNRi = { n: 0. for n in names }
+        total_SDR = { n: 0. for n in names }
+        gender_SISNRi = { n: { g: 0. for g in gs } for n in names }
+        gender_SDR = { n: { g: 0. for g in gs } for n in names }
+        gender_cnt = { g: 0. for g in gs }
+        total_cnt = 0
+
+        with torch.no_grad():
+            for i, sample in enumerate(tqdm(loader, ncols = NCOL)):
+
+                padded_mixture = sample['mix'].to(DEV)
+                padded_source = sample['ref'].to(DEV)
+                mixture_lengths = sample['ilens'].to(DEV)
+                uids = sample['uid']
+
+                ml = mixture_lengths.max().item()
+                padded_mixture = padded_mixture[:, :ml]
+                padded_source = padded_source[:, :, :ml]
+
+                B = padded_mixture.size(0)
+                total_cnt += B
+
+                # shared by all checkpoints
+                mixes = remove_pad(padded_mixture, mixture_lengths)
+                srcs = remove_pad(padded_source, mixture_lengths)
+                genders = [ self.g_mapper(uid, dataset) for uid in uids ]
+                sisnr_base = [ (cal_SISNR(src[0], mix) + cal_SISNR(src[1], mix)) / 2 for src, mix in zip(srcs, mixes) ]
+                for g in genders:
+                    gender_cnt[g] += 1
+
+                for name in names:
+                    estimate_source = self.separate(self.models[name], padded_mixture)
+
+                    loss, max_snr, estimate_source, reorder_estimate_source = \
+                        cal_loss(padded_source, estimate_source, mixture_lengths)
+                    total_loss[name] += loss.item() * B
+
+                    ests = remove_pad(reorder_estimate_source, mixture_lengths)
+                    for b in range(B):
+                        src_ref, src_est, g = srcs[b], ests[b], genders[b]
+
+                        sisnr = (cal_SISNR(src_ref[0], src_est[0]) + cal_SISNR(src_ref[1], src_est[1])) / 2
+                        sisnri = sisnr - sisnr_base[b]
+                        total_SISNRi[name] += sisnri
+                        gender_SISNRi[name][g] += sisnri
+
+                        if self.compute_sdr:
+                            sdr = cal_SDR(src_ref, src_est)
+                            total_SDR[name] += sdr
+                            gender_SDR[name][g] += sdr
+
+        results = {}
+        for name in names:
+            loss = total_loss[name] / total_cnt
+            SISNRi = total_SISNRi[name] / total_cnt
+
+            if self.compute_sdr:
+                total_SDRi = total_SDR[name] / total_cnt - sdr0[dset]
+            else:
+                total_SDRi = 0
+
+            g_SISNRi = {}
+            g_SDRi = {}
+            for g in gs:
+                g_SISNRi[g] = gender_SISNRi[name][g] / gender_cnt[g]
+                if self.compute_sdr:
+                    g_SDRi[g] = gender_SDR[name][g] / gender_cnt[g] - sdr0[f'{dset}_{g}']
+                else:
+                    g_SDRi[g] = 0.
+
+            results[name] = { 'total_loss': loss, 'total_SDRi': total_SDRi, 'total_SISNRi': SISNRi,
+                              'gender_SDRi': g_SDRi, 'gender_SISNRi': g_SISNRi }
+        return results
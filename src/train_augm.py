@@ -7,7 +7,6 @@ import datetime
 import torch
 
 from tqdm import tqdm
-from torch.utils.data import DataLoader
 
 from src.solver import Solver
 from src.saver import Saver
@@ -21,6 +20,8 @@ from src.dprnn import DualRNN
 from src.evaluation import cal_SDR, cal_SISNRi, cal_SISNR
 from src.sep_utils import remove_pad, load_mix_sdr
 from src.dashboard import Dashboard
+from src.mixed_precision import MixedPrecision
+from src.distributed import is_main_process, broadcast_object, broadcast_model, sync_grads, all_reduce_sum, make_loader, set_epoch
 
 """
 from src.scheduler import FlatCosineLR, CosineWarmupLR
@@ -36,13 +37,16 @@ class Trainer(Solver):
 
         ts = time.time()
         st = datetime.datetime.fromtimestamp(ts).strftime('%Y_%m_%d_%H_%M_%S')
+        # same save/log dir on every rank
+        st = broadcast_object(st)
 
         save_name = self.exp_name + '-' + st
         self.save_dir = os.path.join(config['solver']['save_dir'], save_name)
         self.safe_mkdir(self.save_dir)
         self.saver = Saver(config['solver']['max_save_num'], self.save_dir, 'max')
-        yaml.dump(config, open(os.path.join(self.save_dir, 'config.yaml'), 'w'),
-                default_flow_style = False ,indent = 4)
+        if is_main_process():
+            yaml.dump(config, open(os.path.join(self.save_dir, 'config.yaml'), 'w'),
+                    default_flow_style = False ,indent = 4)
 
         log_name = self.exp_name + '-' + st
         self.log_dir = os.path.join(config['solver']['log_dir'], log_name)
@@ -61,6 +65,8 @@ class Trainer(Solver):
         self.step = 0
         self.valid_times = 0
 
+        self.amp = MixedPrecision(config['solver'], DEV)
+
         self.load_data()
         self.set_model()
 
@@ -101,18 +107,18 @@ class Trainer(Solver):
         trainset = wsj0('./data/wsj0/id_list/tr.pkl',
                 audio_root = audio_root,
                 seg_len = seg_len,
-                pre_load = False,
+                pre_load = self.pre_load,
                 one_chunk_in_utt = True,
                 mode = 'tr')
-        self.wsj0_tr_loader = DataLoader(trainset,
+        self.wsj0_tr_loader = make_loader(trainset,
                 batch_size = self.batch_size,
                 shuffle = True,
                 num_workers = self.num_workers)
 
         devset = wsj0_eval('./data/wsj0/id_list/cv.pkl',
                 audio_root = audio_root,
-                pre_load = False)
-        self.wsj0_cv_loader = DataLoader(devset,
+                pre_load = self.pre_load)
+        self.wsj0_cv_loader = make_loader(devset,
                 batch_size = self.batch_size,
                 shuffle = False,
                 num_workers = self.num_workers)
@@ -125,18 +131,18 @@ class Trainer(Solver):
         trainset = wsj0('./data/vctk/id_list/tr.pkl',
                 audio_root = audio_root,
                 seg_len = seg_len,
-                pre_load = False,
+                pre_load = self.pre_load,
                 one_chunk_in_utt = True,
                 mode = 'tr')
-        self.vctk_tr_loader = DataLoader(trainset,
+        self.vctk_tr_loader = make_loader(trainset,
                 batch_size = self.batch_size,
                 shuffle = True,
                 num_workers = self.num_workers)
 
         devset = wsj0_eval('./data/vctk/id_list/cv.pkl',
                 audio_root = audio_root,
-                pre_load = False)
-        self.vctk_cv_loader = DataLoader(devset,
+                pre_load = self.pre_load)
+        self.vctk_cv_loader = make_loader(devset,
                 batch_size = self.batch_size,
                 shuffle = False,
                 num_workers = self.num_workers)
@@ -149,18 +155,18 @@ class Trainer(Solver):
         trainset = wsj0('./data/libri/id_list/tr.pkl',
                 audio_root = audio_root,
                 seg_len = seg_len,
-                pre_load = False,
+                pre_load = self.pre_load,
                 one_chunk_in_utt = True,
                 mode = 'tr')
-        self.libri_tr_loader = DataLoader(trainset,
+        self.libri_tr_loader = make_loader(trainset,
                 batch_size = self.batch_size,
                 shuffle = True,
                 num_workers = self.num_workers)
 
         devset = wsj0_eval('./data/libri/id_list/cv.pkl',
                 audio_root = audio_root,
-                pre_load = False)
-        self.libri_cv_loader = DataLoader(devset,
+                pre_load = self.pre_load)
+        self.libri_cv_loader = make_loader(devset,
                 batch_size = self.batch_size,
                 shuffle = False,
                 num_workers = self.num_workers)
@@ -199,6 +205,11 @@ class Trainer(Solver):
 
                 if self.config['solver']['resume_optim']:
                     optim_dict = info_dict['optim']
+                    if 'amp' in info_dict:
+                        self.amp.load_state_dict(info_dict['amp'])
+
+        # every rank starts from rank 0 weights
+        broadcast_model(self.model)
 
         lr = self.config['optim']['lr']
         weight_decay = self.config['optim']['weight_decay']
@@ -259,6 +270,7 @@ class Trainer(Solver):
             self.writer.epoch()
 
     def train_one_epoch(self, epoch, tr_loader):
+        set_epoch(tr_loader, epoch)
         self.model.train()
         total_loss = 0.
         total_sisnri = 0.
@@ -270,28 +282,37 @@ class Trainer(Solver):
             padded_source = sample['ref'].to(DEV)
             mixture_lengths = sample['ilens'].to(DEV)
 
-            estimate_source = self.model.noise_forward(padded_mixture, self.transform)
+            with self.amp.autocast():
+                estimate_source = self.model.noise_forward(padded_mixture, self.transform)
 
-            loss, max_snr, estimate_source, reorder_estimate_source = \
-                cal_loss(padded_source, estimate_source, mixture_lengths)
+                loss, max_snr, estimate_source, reorder_estimate_source = \
+                    cal_loss(padded_source, estimate_source, mixture_lengths)
 
-            self.opt.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
-            self.opt.step()
+            update = self.is_accum_end(i, len(tr_loader))
+            if self.is_accum_start(i):
+                self.opt.zero_grad()
+            self.amp.backward(self.accum_loss(loss))
+            if update:
+                self.rescale_tail_grads([ self.model ], i)
+                sync_grads(self.model)
+                self.amp.unscale_(self.opt)
+                torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
+                self.amp.step(self.opt)
 
             B = padded_source.size(0)
-            total_loss += loss.item() * B
+            total_loss += loss.detach() * B
             cnt += B
             with torch.no_grad():
                 mix_sisnr = SISNR(padded_source, padded_mixture, mixture_lengths)
                 total_sisnri += (max_snr - mix_sisnr).sum()
 
-            meta = { 'iter_loss': loss.item() }
-            self.writer.log_step_info('train', meta)
+            meta = { 'iter_loss': loss.detach() }
+            self.accum_meta(meta)
 
-            self.step += 1
-            self.writer.step()
+            if update:
+                self.writer.log_step_info('train', self.pop_step_meta())
+                self.step += 1
+                self.writer.step()
 
         total_loss = total_loss / cnt
         total_sisnri = total_sisnri / cnt
@@ -330,6 +351,8 @@ class Trainer(Solver):
                 total_sisnri += max_sisnri.sum().item()
                 cnt += B
 
+        # sum over ranks
+        total_loss, total_sisnri, cnt = all_reduce_sum([ total_loss, total_sisnri, cnt ])
         total_sisnri = total_sisnri / cnt
         total_loss = total_loss / cnt
 
@@ -347,6 +370,7 @@ class Trainer(Solver):
         model_name = f'{epoch}.pth'
         info_dict = { 'epoch': epoch, 'valid_score': valid_score, 'config': self.config }
         info_dict['optim'] = self.opt.state_dict()
+        info_dict['amp'] = self.amp.state_dict()
 
         self.saver.update(self.model, total_sisnri, model_name, info_dict)
 
@@ -7,7 +7,6 @@ import datetime
 import torch
 
 from tqdm import tqdm
-from torch.utils.data import DataLoader
 
 from src.solver import Solver
 from src.saver import Saver
@@ -22,6 +21,8 @@ from src.evaluation import cal_SDR, cal_SISNRi, cal_SISNR
 from src.sep_utils import remove_pad, load_mix_sdr
 from src.dashboard import Dashboard
 from src.gender_mapper import GenderMapper
+from src.mixed_precision import MixedPrecision
+from src.distributed import is_main_process, broadcast_object, broadcast_model, sync_grads, all_reduce_sum, make_loader, set_epoch
 
 """
 from src.scheduler import FlatCosineLR, CosineWarmupLR
@@ -37,6 +38,8 @@ class Trainer(Solver):
 
         ts = time.time()
         st = datetime.datetime.fromtimestamp(ts).strftime('%Y_%m_%d_%H_%M_%S')
+        # same save/log dir on every rank
+        st = broadcast_object(st)
 
         self.resume_model = False
         resume_exp_name = config['solver'].get('resume_exp_name', '')
@@ -64,8 +67,9 @@ class Trainer(Solver):
             self.save_dir = os.path.join(config['solver']['save_dir'], save_name)
             self.safe_mkdir(self.save_dir)
             self.saver = Saver(config['solver']['max_save_num'], self.save_dir, 'max')
-            yaml.dump(config, open(os.path.join(self.save_dir, 'config.yaml'), 'w'),
-                    default_flow_style = False ,indent = 4)
+            if is_main_process():
+                yaml.dump(config, open(os.path.join(self.save_dir, 'config.yaml'), 'w'),
+                        default_flow_style = False ,indent = 4)
 
             log_name = self.exp_name + '-' + st
             self.log_dir = os.path.join(config['solver']['log_dir'], log_name)
@@ -86,6 +90,8 @@ class Trainer(Solver):
         self.step = 0
         self.valid_times = 0
 
+        self.amp = MixedPrecision(config['solver'], DEV)
+
         self.gender = config['data'].get('gender', 'all')
         self.gender_mapper = GenderMapper()
         self.load_data()
@@ -126,7 +132,7 @@ class Trainer(Solver):
             trainset = wsj0_gender(tr_list,
                     audio_root = audio_root,
                     seg_len = seg_len,
-                    pre_load = False,
+                    pre_load = self.pre_load,
                     one_chunk_in_utt = True,
                     mode = 'tr',
                     gender = self.gender)
@@ -134,19 +140,20 @@ class Trainer(Solver):
             trainset = wsj0(tr_list,
                     audio_root = audio_root,
                     seg_len = seg_len,
-                    pre_load = False,
+                    # speed perturb reads from disk
+                    pre_load = self.pre_load and sp_factors is None,
                     one_chunk_in_utt = True,
                     mode = 'tr',
                     sp_factors = sp_factors)
-        tr_loader = DataLoader(trainset,
+        tr_loader = make_loader(trainset,
                 batch_size = self.batch_size,
                 shuffle = True,
                 num_workers = self.num_workers)
 
         devset = wsj0_eval(cv_list,
                 audio_root = audio_root,
-                pre_load = False)
-        cv_loader = DataLoader(devset,
+                pre_load = self.pre_load)
+        cv_loader = make_loader(devset,
                 batch_size = self.batch_size,
                 shuffle = False,
                 num_workers = self.num_workers)
@@ -164,21 +171,21 @@ class Trainer(Solver):
         trainset = wham(tr_list,
                 audio_root = audio_root,
                 seg_len = seg_len,
-                pre_load = False,
+                pre_load = self.pre_load,
                 one_chunk_in_utt = True,
                 mode = 'tr',
                 scale = scale)
-        tr_loader = DataLoader(trainset,
+        tr_loader = make_loader(trainset,
                 batch_size = self.batch_size,
                 shuffle = True,
                 num_workers = self.num_workers)
 
         devset = wham_eval(cv_list,
                 audio_root = audio_root,
-                pre_load = False,
+                pre_load = self.pre_load,
                 mode = 'cv',
                 scale = scale)
-        cv_loader = DataLoader(devset,
+        cv_loader = make_loader(devset,
                 batch_size = self.batch_size,
                 shuffle = False,
                 num_workers = self.num_workers)
@@ -220,6 +227,8 @@ class Trainer(Solver):
 
             if self.config['solver']['resume_optim']:
                 optim_dict = info_dict['optim']
+                if 'amp' in info_dict:
+                    self.amp.load_state_dict(info_dict['amp'])
 
             # dashboard is one-base
             self.writer.set_epoch(self.start_epoch + 1)
@@ -228,6 +237,9 @@ class Trainer(Solver):
             print(self.start_epoch)
             print(self.step)
 
+        # every rank starts from rank 0 weights
+        broadcast_model(self.model)
+
         lr = self.config['optim']['lr']
         weight_decay = self.config['optim']['weight_decay']
 
@@ -290,7 +302,7 @@ class Trainer(Solver):
 
             self.writer.epoch()
 
-        if self.test_after_finished:
+        if self.test_after_finished and is_main_process():
             conf = self.construct_test_conf(dsets = 'all', sdir = 'chapter3', choose_best = False, compute_sdr = False)
             result = self.run_tester('test_baseline.py', conf)
             result['tt_config'] = conf
@@ -314,6 +326,7 @@ class Trainer(Solver):
         return reg
 
     def train_one_epoch(self, epoch, tr_loader):
+        set_epoch(tr_loader, epoch)
         self.model.train()
         total_loss = 0.
         total_sisnri = 0.
@@ -325,10 +338,11 @@ class Trainer(Solver):
             padded_source = sample['ref'].to(DEV)
             mixture_lengths = sample['ilens'].to(DEV)
 
-            estimate_source = self.model(padded_mixture)
+            with self.amp.autocast():
+                estimate_source = self.model(padded_mixture)
 
-            loss, max_snr, estimate_source, reorder_estimate_source = \
-                cal_loss(padded_source, estimate_source, mixture_lengths)
+                loss, max_snr, estimate_source, reorder_estimate_source = \
+                    cal_loss(padded_source, estimate_source, mixture_lengths)
 
             if self.L2_reg_w > 0:
                 l2_reg = self.compute_w_reg('L2')
@@ -337,23 +351,31 @@ class Trainer(Solver):
                 l1_reg = self.compute_w_reg('L1')
                 loss = loss + self.L1_reg_w * l1_reg
 
-            self.opt.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
-            self.opt.step()
+            update = self.is_accum_end(i, len(tr_loader))
+            if self.is_accum_start(i):
+                self.opt.zero_grad()
+            self.amp.backward(self.accum_loss(loss))
+            if update:
+                self.rescale_tail_grads([ self.model ], i)
+                sync_grads(self.model)
+                self.amp.unscale_(self.opt)
+                torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
+                self.amp.step(self.opt)
 
             B = padded_source.size(0)
-            total_loss += loss.item() * B
+            total_loss += loss.detach() * B
             cnt += B
             with torch.no_grad():
                 mix_sisnr = SISNR(padded_source, padded_mixture, mixture_lengths)
                 total_sisnri += (max_snr - mix_sisnr).sum()
 
-            meta = { 'iter_loss': loss.item() }
-            self.writer.log_step_info('train', meta)
+            meta = { 'iter_loss': loss.detach() }
+            self.accum_meta(meta)
 
-            self.step += 1
-            self.writer.step()
+            if update:
+                self.writer.log_step_info('train', self.pop_step_meta())
+                self.step += 1
+                self.writer.step()
 
         total_loss = total_loss / cnt
         total_sisnri = total_sisnri / cnt
@@ -402,6 +424,10 @@ class Trainer(Solver):
                     gender_sisnri[g] += max_sisnri[b].item()
                     gender_cnt[g] += 1
 
+        # sum over ranks
+        total_loss, total_sisnri, cnt = all_reduce_sum([ total_loss, total_sisnri, cnt ])
+        gender_sisnri = all_reduce_sum(gender_sisnri)
+        gender_cnt = all_reduce_sum(gender_cnt)
         total_sisnri = total_sisnri / cnt
         total_loss = total_loss / cnt
 
@@ -424,6 +450,7 @@ class Trainer(Solver):
         model_name = f'{epoch}.pth'
         info_dict = { 'epoch': epoch, 'valid_score': valid_score, 'config': self.config }
         info_dict['optim'] = self.opt.state_dict()
+        info_dict['amp'] = self.amp.state_dict()
 
         self.saver.update(self.model, total_sisnri, model_name, info_dict)
 
@@ -10,7 +10,6 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from tqdm import tqdm
-from torch.utils.data import DataLoader
 
 from src.solver import Solver
 from src.saver import Saver
@@ -23,7 +22,10 @@ from src.dataset import wsj0, wsj0_eval
 from src.wham import wham, wham_eval
 from src.gender_dset import wsj0_gender
 from src.scheduler import RampScheduler, ConstantScheduler, DANNScheduler
-from src.gradient_penalty import calc_gradient_penalty
+from src.gradient_penalty import interpolate, penalty
+from src.feature_cache import FeatureCache
+from src.mixed_precision import MixedPrecision, fp32_region
+from src.distributed import is_main_process, broadcast_object, broadcast_model, sync_grads, all_reduce_sum, make_loader, set_epoch
 from src.dashboard import Dashboard
 from src.ranger import Ranger
 from src.gender_mapper import GenderMapper
@@ -36,6 +38,8 @@ class Trainer(Solver):
 
         ts = time.time()
         st = datetime.datetime.fromtimestamp(ts).strftime('%Y_%m_%d_%H_%M_%S')
+        # same save/log dir on every rank
+        st = broadcast_object(st)
 
         self.resume_model = False
         resume_exp_name = config['solver'].get('resume_exp_name', '')
@@ -63,8 +67,9 @@ class Trainer(Solver):
             self.save_dir = os.path.join(config['solver']['save_dir'], save_name)
             self.safe_mkdir(self.save_dir)
             self.saver = Saver(config['solver']['max_save_num'], self.save_dir, 'max')
-            yaml.dump(config, open(os.path.join(self.save_dir, 'config.yaml'), 'w'),
-                    default_flow_style = False ,indent = 4)
+            if is_main_process():
+                yaml.dump(config, open(os.path.join(self.save_dir, 'config.yaml'), 'w'),
+                        default_flow_style = False ,indent = 4)
 
             log_name = self.exp_name + '-' + st
             self.log_dir = os.path.join(config['solver']['log_dir'], log_name)
@@ -78,6 +83,7 @@ class Trainer(Solver):
         self.G_grad_clip = config['solver']['G_grad_clip']
         self.num_workers = config['solver']['num_workers']
         self.step = 0
+        self.amp = MixedPrecision(config['solver'], DEV)
         self.pretrain_d_step = config['solver'].get('pretrain_d_step', 0)
 
         self.g_iters = config['solver']['g_iters']
@@ -85,9 +91,26 @@ class Trainer(Solver):
 
         self.adv_loss = config['solver']['adv_loss']
         self.gp_lambda = config['solver']['gp_lambda']
+        # lazy regularization, gradient penalty every gp_every D steps (scaled by gp_every)
+        self.gp_every = config['solver'].get('gp_every', 1)
+        self.d_step = 0
 
         self.cdan = config['model']['domain_cls'].get('cdan', False)
 
+        # one G forward on [ src; tgt ] for both sup loss and adversarial loss
+        self.fused_gen = config['solver'].get('fused_gen', False)
+        # extra no-grad G forward on a uns batch for epoch_uns_sisnri, every k optimizer steps (0: off)
+        self.uns_sisnri_every = config['solver'].get('uns_sisnri_every', 0)
+
+        # replay G features across d_iters instead of a G forward per D update
+        self.feat_cache = None
+        cache_conf = config['solver'].get('feat_cache', {})
+        if cache_conf.get('use', False):
+            self.feat_cache = FeatureCache(cache_conf['size'],
+                                           cache_conf['max_staleness'],
+                                           refresh_every = cache_conf.get('refresh_every', 1),
+                                           refresh_num = cache_conf.get('refresh_num', 1))
+
         self.load_data()
         self.set_model()
         self.gender_mapper = GenderMapper()
@@ -126,12 +149,18 @@ class Trainer(Solver):
         # Load loader for sup training
         seg_len = self.config['data']['segment']
         self.sup_loader = self.load_tr_dset(self.dset, seg_len)
-        self.steps_per_epoch = len(self.sup_loader)
+        # optimizer steps per epoch
+        self.steps_per_epoch = self.accum_steps_of(len(self.sup_loader))
 
         # Load data gen for gan training
         uns_len = self.config['data'].get('uns_segment', 2.0)
-        self.sup_gen = inf_data_gen(self.load_tr_dset(self.dset, uns_len))
-        self.uns_gen = inf_data_gen(self.load_tr_dset(self.uns_dset, uns_len))
+        # batches kept ready per data gen
+        prefetch = self.config['solver'].get('prefetch', 0)
+        self.sup_gen = inf_data_gen(self.load_tr_dset(self.dset, uns_len), prefetch)
+        self.uns_gen = inf_data_gen(self.load_tr_dset(self.uns_dset, uns_len), prefetch)
+        if self.fused_gen:
+            # tgt batch is concatenated with sup batch, so same segment len
+            self.uns_sup_gen = inf_data_gen(self.load_tr_dset(self.uns_dset, seg_len), prefetch)
 
         # Load cv loader
         self.dsets = {}
@@ -157,11 +186,11 @@ class Trainer(Solver):
         trainset = wsj0(tr_list,
                 audio_root = audio_root,
                 seg_len = seg_len,
-                pre_load = False,
+                pre_load = self.pre_load,
                 one_chunk_in_utt = True,
                 mode = 'tr',
                 sp_factors = None)
-        tr_loader = DataLoader(trainset,
+        tr_loader = make_loader(trainset,
                 batch_size = self.batch_size,
                 shuffle = True,
                 num_workers = self.num_workers,
@@ -179,11 +208,11 @@ class Trainer(Solver):
         trainset = wsj0_gender(tr_list,
                 audio_root = audio_root,
                 seg_len = seg_len,
-                pre_load = False,
+                pre_load = self.pre_load,
                 one_chunk_in_utt = True,
                 mode = 'tr',
                 gender = gender)
-        tr_loader = DataLoader(trainset,
+        tr_loader = make_loader(trainset,
                 batch_size = self.batch_size,
                 shuffle = True,
                 num_workers = self.num_workers,
@@ -200,8 +229,8 @@ class Trainer(Solver):
         cv_list = f'./data/{dset}/id_list/cv.pkl'
         devset = wsj0_eval(cv_list,
                 audio_root = audio_root,
-                pre_load = False)
-        cv_loader = DataLoader(devset,
+                pre_load = self.pre_load)
+        cv_loader = make_loader(devset,
                 batch_size = self.batch_size,
                 shuffle = False,
                 num_workers = self.num_workers)
@@ -219,11 +248,11 @@ class Trainer(Solver):
             trainset = wham(tr_list,
                     audio_root = audio_root,
                     seg_len = seg_len,
-                    pre_load = False,
+                    pre_load = self.pre_load,
                     one_chunk_in_utt = True,
                     mode = 'tr',
                     scale = scale)
-            tr_loader = DataLoader(trainset,
+            tr_loader = make_loader(trainset,
                     batch_size = self.batch_size,
                     shuffle = True,
                     num_workers = self.num_workers,
@@ -232,10 +261,10 @@ class Trainer(Solver):
         else:
             devset = wham_eval(cv_list,
                     audio_root = audio_root,
-                    pre_load = False,
+                    pre_load = self.pre_load,
                     mode = 'cv',
                     scale = scale)
-            cv_loader = DataLoader(devset,
+            cv_loader = make_loader(devset,
                     batch_size = self.batch_size,
                     shuffle = False,
                     num_workers = self.num_workers)
@@ -298,6 +327,8 @@ class Trainer(Solver):
         self.bce_loss = nn.BCEWithLogitsLoss()
         self.src_label = torch.FloatTensor([0]).to(DEV)
         self.tgt_label = torch.FloatTensor([1]).to(DEV)
+        # D label tensors of [ src; tgt ] batch, key: (output shape, #src)
+        self.label_cache = {}
 
         pretrained = self.config['solver']['pretrained']
         if pretrained != '':
@@ -336,10 +367,17 @@ class Trainer(Solver):
                 optim_dict = info_dict['d_optim']
                 self.d_optim.load_state_dict(optim_dict)
 
+                if 'amp' in info_dict:
+                    self.amp.load_state_dict(info_dict['amp'])
+
             # dashboard is one-base
             self.writer.set_epoch(self.start_epoch + 1)
             self.writer.set_step(self.step + 1)
 
+        # every rank starts from rank 0 weights
+        broadcast_model(self.G)
+        broadcast_model(self.D)
+
         self.Lg_scheduler = self.set_scheduler(self.config['solver']['Lg_scheduler'])
         self.Ld_scheduler = self.set_scheduler(self.config['solver']['Ld_scheduler'])
 
@@ -401,6 +439,7 @@ class Trainer(Solver):
             info_dict['g_optim'] = self.g_optim.state_dict()
             info_dict['d_optim'] = self.d_optim.state_dict()
             info_dict['D_state_dict'] = self.D.state_dict()
+            info_dict['amp'] = self.amp.state_dict()
 
             self.saver.update(self.G, save_crit, model_name, info_dict)
 
@@ -408,7 +447,7 @@ class Trainer(Solver):
             self.saver.force_save(self.G, model_name, info_dict)
             self.writer.epoch()
 
-        if self.test_after_finished:
+        if self.test_after_finished and is_main_process():
             conf = self.construct_test_conf(dsets = 'all', sdir = 'chapter4', choose_best = True, compute_sdr = False)
             result = self.run_tester('test_dagan.py', conf)
             result['tt_config'] = conf
@@ -420,11 +459,15 @@ class Trainer(Solver):
             self.writer.log_result(result, 'result.json')
 
     def train_one_epoch(self, epoch, tr_loader):
+        if self.fused_gen:
+            return self.train_one_epoch_fused(epoch, tr_loader)
+        set_epoch(tr_loader, epoch)
         self.G.train()
         total_loss = 0.
         total_sisnri = 0.
         total_uns_sisnri = 0.
         cnt = 0
+        uns_cnt = 0
 
         for i, sample in enumerate(tqdm(tr_loader, ncols = NCOL)):
 
@@ -432,45 +475,154 @@ class Trainer(Solver):
             padded_source = sample['ref'].to(DEV)
             mixture_lengths = sample['ilens'].to(DEV)
 
-            estimate_source, _ = self.G(padded_mixture)
+            with self.amp.autocast():
+                estimate_source, _ = self.G(padded_mixture)
 
-            loss, max_snr, estimate_source, reorder_estimate_source = \
-                cal_loss(padded_source, estimate_source, mixture_lengths)
+                loss, max_snr, estimate_source, reorder_estimate_source = \
+                    cal_loss(padded_source, estimate_source, mixture_lengths)
 
-            self.D.zero_grad()
-            self.G.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(self.G.parameters(), self.G_grad_clip)
-            self.g_optim.step()
+            update = self.is_accum_end(i, len(tr_loader))
+            if self.is_accum_start(i):
+                self.D.zero_grad()
+                self.G.zero_grad()
+            self.amp.backward(self.accum_loss(loss))
+            if update:
+                self.rescale_tail_grads([ self.G ], i)
+                sync_grads(self.G)
+                self.amp.unscale_(self.g_optim)
+                torch.nn.utils.clip_grad_norm_(self.G.parameters(), self.G_grad_clip)
+                self.amp.step(self.g_optim)
 
             B = padded_source.size(0)
-            total_loss += loss.item() * B
+            total_loss += loss.detach() * B
             cnt += B
             with torch.no_grad():
                 mix_sisnr = SISNR(padded_source, padded_mixture, mixture_lengths)
                 total_sisnri += (max_snr - mix_sisnr).sum()
 
-            meta = { 'iter_loss': loss.item() }
-            self.writer.log_step_info('train', meta)
+            meta = { 'iter_loss': loss.detach() }
+            self.accum_meta(meta)
+
+            # semi part, one adversarial update per sup optimizer step
+            if update:
+                self.writer.log_step_info('train', self.pop_step_meta())
+                self.train_dis_once(self.step, self.sup_gen, self.uns_gen)
+                self.train_gen_once(self.step, self.sup_gen, self.uns_gen)
+
+            if update and self.uns_sisnri_every > 0 and self.step % self.uns_sisnri_every == 0:
+                with torch.no_grad(), self.amp.autocast():
+                    uns_sample = self.uns_gen.__next__()
+                    padded_mixture = uns_sample['mix'].to(DEV)
+                    padded_source = uns_sample['ref'].to(DEV)
+                    mixture_lengths = uns_sample['ilens'].to(DEV)
+
+                    estimate_source, _ = self.G(padded_mixture)
+                    loss, max_snr, estimate_source, reorder_estimate_source = \
+                        cal_loss(padded_source, estimate_source, mixture_lengths)
+                    mix_sisnr = SISNR(padded_source, padded_mixture, mixture_lengths)
+                    total_uns_sisnri += (max_snr - mix_sisnr).sum()
+                    uns_cnt += padded_source.size(0)
+
+            if update:
+                self.step += 1
+                self.writer.step()
 
-            # semi part
-            self.train_dis_once(self.step, self.sup_gen, self.uns_gen)
-            self.train_gen_once(self.step, self.sup_gen, self.uns_gen)
+        total_loss = total_loss / cnt
+        total_sisnri = total_sisnri / cnt
 
-            with torch.no_grad():
-                uns_sample = self.uns_gen.__next__()
-                padded_mixture = uns_sample['mix'].to(DEV)
-                padded_source = uns_sample['ref'].to(DEV)
-                mixture_lengths = uns_sample['ilens'].to(DEV)
+        meta = { 'epoch_loss': total_loss,
+                 'epoch_sisnri': total_sisnri }
+        if uns_cnt > 0:
+            meta['epoch_uns_sisnri'] = total_uns_sisnri / uns_cnt
+        self.writer.log_epoch_info('train', meta)
+
+    def train_one_epoch_fused(self, epoch, tr_loader):
+        """
+        Sup loss and adversarial G loss from one G forward on [ src; tgt ]
+        and one backward, D is updated after each G step.
+        g_iters is not used, there is one G step per sup batch.
+        """
+        set_epoch(tr_loader, epoch)
+        self.G.train()
+        total_loss = 0.
+        total_sisnri = 0.
+        total_uns_sisnri = 0.
+        total_g_loss = 0.
+        domain_acc = 0.
+        cnt = 0
+        dcnt = 0
+
+        for i, sample in enumerate(tqdm(tr_loader, ncols = NCOL)):
+
+            padded_mixture = sample['mix'].to(DEV)
+            padded_source = sample['ref'].to(DEV)
+            mixture_lengths = sample['ilens'].to(DEV)
+
+            uns_sample = self.uns_sup_gen.__next__()
+            uns_mixture = uns_sample['mix'].to(DEV)
+            uns_source = uns_sample['ref'].to(DEV)
+            uns_lengths = uns_sample['ilens'].to(DEV)
+
+            B = padded_mixture.size(0)
+            mixture = torch.cat([ padded_mixture, uns_mixture ], dim = 0)
+
+            with self.amp.autocast():
+                if not self.cdan:
+                    estimate_source, feat = self.G(mixture)
+                    src_mask, tgt_mask = None, None
+                else:
+                    estimate_source, feat, mask = self.G.cdan_forward(mixture)
+                    src_mask, tgt_mask = mask[:B], mask[B:]
+                uns_estimate = estimate_source[B:].detach()
 
-                estimate_source, _ = self.G(padded_mixture)
                 loss, max_snr, estimate_source, reorder_estimate_source = \
-                    cal_loss(padded_source, estimate_source, mixture_lengths)
+                    cal_loss(padded_source, estimate_source[:B], mixture_lengths)
+                g_loss, (c, n) = self.gen_adv_loss(feat[:B], src_mask, feat[B:], tgt_mask)
+
+            g_lambda = self.Lg_scheduler.value(self.step)
+            update = self.is_accum_end(i, len(tr_loader))
+            if self.is_accum_start(i):
+                self.D.zero_grad()
+                self.G.zero_grad()
+            self.amp.backward(self.accum_loss(loss + g_lambda * g_loss))
+            if update:
+                self.rescale_tail_grads([ self.G ], i)
+                sync_grads(self.G)
+                self.amp.unscale_(self.g_optim)
+                grad_norm = torch.nn.utils.clip_grad_norm_(self.G.parameters(), self.G_grad_clip)
+                if math.isnan(grad_norm):
+                    print('Error : grad norm is NaN @ step '+str(self.step))
+                    self.amp.update()
+                else:
+                    self.amp.step(self.g_optim)
+
+            total_loss += loss.detach() * B
+            total_g_loss += g_loss.detach() * B
+            domain_acc += c
+            dcnt += n
+            cnt += B
+            with torch.no_grad():
                 mix_sisnr = SISNR(padded_source, padded_mixture, mixture_lengths)
-                total_uns_sisnri += (max_snr - mix_sisnr).sum()
+                total_sisnri += (max_snr - mix_sisnr).sum()
 
-            self.step += 1
-            self.writer.step()
+                # tgt sisnri from the same forward
+                _, uns_max_snr, _, _ = cal_loss(uns_source, uns_estimate, uns_lengths)
+                uns_mix_sisnr = SISNR(uns_source, uns_mixture, uns_lengths)
+                total_uns_sisnri += (uns_max_snr - uns_mix_sisnr).sum()
+
+            meta = { 'iter_loss': loss.detach(),
+                     'g_loss': g_loss.detach(),
+                     'weighted_g_loss': g_lambda * g_loss.detach() }
+            self.accum_meta(meta)
+
+            if update:
+                meta = self.pop_step_meta()
+                meta['g_lambda'] = g_lambda
+                self.writer.log_step_info('train', meta)
+                self.train_dis_once(self.step, self.sup_gen, self.uns_gen)
+
+                self.step += 1
+                self.writer.step()
 
         total_loss = total_loss / cnt
         total_sisnri = total_sisnri / cnt
@@ -478,12 +630,54 @@ class Trainer(Solver):
 
         meta = { 'epoch_loss': total_loss,
                  'epoch_sisnri': total_sisnri,
-                 'epoch_uns_sisnri': total_uns_sisnri }
+                 'epoch_uns_sisnri': total_uns_sisnri,
+                 'epoch_g_loss': total_g_loss / cnt }
+        if self.adv_loss == 'gan':
+            meta['epoch_gen_domain_acc'] = domain_acc / dcnt
         self.writer.log_epoch_info('train', meta)
 
+    def compute_dis_features(self, src_gen, tgt_gen):
+        """
+        G features of a fresh src and tgt batch in one G forward,
+        mask is None if not cdan
+        Returns:
+            [ src_feat, src_mask, tgt_feat, tgt_mask ]
+        """
+        src_mixture = src_gen.__next__()['mix'].to(DEV)
+        tgt_mixture = tgt_gen.__next__()['mix'].to(DEV)
+        B = src_mixture.size(0)
+        mixture = torch.cat([ src_mixture, tgt_mixture ], dim = 0)
+        with torch.no_grad():
+            if not self.cdan:
+                _, feat = self.G(mixture)
+                return [ feat[:B], None, feat[B:], None ]
+            _, feat, mask = self.G.cdan_forward(mixture)
+            return [ feat[:B], mask[:B], feat[B:], mask[B:] ]
+
+    def dis_features(self, src_gen, tgt_gen):
+        compute_fn = lambda: self.compute_dis_features(src_gen, tgt_gen)
+        if self.feat_cache is None:
+            return compute_fn()
+        return self.feat_cache.fetch(compute_fn)
+
+    def dis_labels(self, d_out, n_src):
+        """
+        Domain labels of D output on [ src; tgt ], cached by shape
+        """
+        key = (tuple(d_out.size()), n_src)
+        if key not in self.label_cache:
+            labels = torch.empty(d_out.size(), device = d_out.device)
+            labels[:n_src] = self.src_label
+            labels[n_src:] = self.tgt_label
+            self.label_cache[key] = labels
+        return self.label_cache[key]
+
     def train_dis_once(self, step, src_gen, tgt_gen, pretrain = False):
         # assert batch_size is even
 
+        if self.feat_cache is not None:
+            self.feat_cache.step()
+
         if pretrain:
             prefix = 'pretrain_'
         else:
@@ -492,6 +686,7 @@ class Trainer(Solver):
         total_d_loss = 0.
         weighted_d_loss = 0.
         total_gp = 0.
+        gp_cnt = 0
         src_domain_acc = 0.
         tgt_domain_acc = 0.
         total_grad_norm = 0.
@@ -499,98 +694,83 @@ class Trainer(Solver):
         tgt_cnt = 0
         for _ in range(self.d_iters):
 
-            # fake(src) sample
-            sample = src_gen.__next__()
-            src_mixture = sample['mix'].to(DEV)
-
-            with torch.no_grad():
-                if not self.cdan:
-                    _, src_feat = self.G(src_mixture)
-                else:
-                    _, src_feat, src_mask = self.G.cdan_forward(src_mixture)
-
-            if self.adv_loss == 'wgan-gp':
-                d_fake_loss = self.D(src_feat).mean()
-            elif self.adv_loss == 'gan':
-                if not self.cdan:
-                    d_fake_out = self.D(src_feat)
-                else:
-                    d_fake_out = self.D(src_feat, src_mask)
-                d_fake_loss = self.bce_loss(d_fake_out,
-                                            self.src_label.expand_as(d_fake_out))
-                with torch.no_grad():
-                    src_dp = ((F.sigmoid(d_fake_out) >= 0.5).float() == self.src_label).float()
-                    src_domain_acc += src_dp.sum().item()
-                    src_cnt += src_dp.numel()
-            elif self.adv_loss == 'hinge':
-                d_fake_out = self.D(src_feat)
-                d_fake_loss = F.relu(d_fake_out).mean()
-                with torch.no_grad():
-                    src_dp = ((F.sigmoid(d_fake_out) >= 0.5).float() == self.src_label).float()
-                    src_domain_acc += src_dp.sum().item()
-                    src_cnt += src_dp.numel()
-
-            # true(tgt) sample
-            sample = tgt_gen.__next__()
-            tgt_mixture = sample['mix'].to(DEV)
-
-            with torch.no_grad():
-                if not self.cdan:
-                    _, tgt_feat = self.G(tgt_mixture)
-                else:
-                    _, tgt_feat, tgt_mask = self.G.cdan_forward(tgt_mixture)
+            use_gp = self.adv_loss == 'wgan-gp' and self.d_step % self.gp_every == 0
+            self.d_step += 1
+            if use_gp:
+                gp_cnt += 1
 
-            if self.adv_loss == 'wgan-gp':
-                d_real_loss = - self.D(tgt_feat).mean()
-            elif self.adv_loss == 'gan':
-                if not self.cdan:
-                    d_real_out = self.D(tgt_feat)
+            self.D.zero_grad()
+            self.G.zero_grad()
+            for _ in range(self.accum_steps):
+                with self.amp.autocast():
+                    # fake(src) and true(tgt) features
+                    src_feat, src_mask, tgt_feat, tgt_mask = self.dis_features(src_gen, tgt_gen)
+                    B = src_feat.size(0)
+                    feat = torch.cat([ src_feat, tgt_feat ], dim = 0)
+
+                    if self.adv_loss == 'wgan-gp':
+                        if use_gp:
+                            # interpolates share the D call, double backward of the penalty is kept in fp32
+                            with fp32_region(DEV.type):
+                                interpolates = interpolate(tgt_feat.float(), src_feat.float())
+                                d_out = self.D(torch.cat([ feat.float(), interpolates ], dim = 0))
+                                gp = penalty(d_out[2*B:], interpolates)
+                        else:
+                            d_out = self.D(feat)
+                        d_fake_loss = d_out[:B].mean()
+                        d_real_loss = - d_out[B:2*B].mean()
+                    else:
+                        if self.adv_loss == 'gan' and self.cdan:
+                            d_out = self.D(feat, torch.cat([ src_mask, tgt_mask ], dim = 0))
+                        else:
+                            d_out = self.D(feat)
+
+                        if self.adv_loss == 'gan':
+                            labels = self.dis_labels(d_out, B)
+                            d_losses = F.binary_cross_entropy_with_logits(d_out, labels, reduction = 'none')
+                            d_fake_loss = d_losses[:B].mean()
+                            d_real_loss = d_losses[B:].mean()
+                        elif self.adv_loss == 'hinge':
+                            d_fake_loss = F.relu(d_out[:B]).mean()
+                            d_real_loss = F.relu(1.0 - d_out[B:]).mean()
+
+                        with torch.no_grad():
+                            labels = self.dis_labels(d_out, B)
+                            dp = ((torch.sigmoid(d_out) >= 0.5).float() == labels).float()
+                            src_domain_acc += dp[:B].sum()
+                            tgt_domain_acc += dp[B:].sum()
+                            src_cnt += dp[:B].numel()
+                            tgt_cnt += dp[B:].numel()
+
+                    d_loss = d_real_loss + d_fake_loss
+
+                if use_gp:
+                    d_loss = d_loss + self.gp_every * self.gp_lambda * gp
+                    total_gp += gp.detach() / self.accum_steps
+
+                if pretrain:
+                    d_lambda = 1
                 else:
-                    d_real_out = self.D(tgt_feat, tgt_mask)
-                d_real_loss = self.bce_loss(d_real_out,
-                                            self.tgt_label.expand_as(d_real_out))
-                with torch.no_grad():
-                    tgt_dp = ((F.sigmoid(d_real_out) >= 0.5).float() == self.tgt_label).float()
-                    tgt_domain_acc += tgt_dp.sum().item()
-                    tgt_cnt += tgt_dp.numel()
-            elif self.adv_loss == 'hinge':
-                d_real_out = self.D(tgt_feat)
-                d_real_loss = F.relu(1.0 - d_real_out).mean()
-                with torch.no_grad():
-                    tgt_dp = ((F.sigmoid(d_real_out) >= 0.5).float() == self.tgt_label).float()
-                    tgt_domain_acc += tgt_dp.sum().item()
-                    tgt_cnt += tgt_dp.numel()
-
-            d_loss = d_real_loss + d_fake_loss
-
-            if self.adv_loss == 'wgan-gp':
-                gp = calc_gradient_penalty(self.D, tgt_feat, src_feat)
-                d_lambda = self.Ld_scheduler.value(step)
-                d_loss = d_loss + self.gp_lambda * gp
-                total_gp += gp.item()
-
-            if pretrain:
-                d_lambda = 1
-            else:
-                d_lambda = self.Ld_scheduler.value(step)
-            _d_loss = d_lambda * d_loss
+                    d_lambda = self.Ld_scheduler.value(step)
+                _d_loss = d_lambda * d_loss
 
-            total_d_loss += d_loss.item()
-            weighted_d_loss += _d_loss.item()
+                total_d_loss += d_loss.detach() / self.accum_steps
+                weighted_d_loss += _d_loss.detach() / self.accum_steps
+                self.amp.backward(self.accum_loss(_d_loss))
 
-            self.D.zero_grad()
-            self.G.zero_grad()
-            _d_loss.backward()
+            sync_grads(self.D)
+            self.amp.unscale_(self.d_optim)
             grad_norm = torch.nn.utils.clip_grad_norm_(self.D.parameters(), self.D_grad_clip)
             total_grad_norm += grad_norm
             if math.isnan(grad_norm):
                 print('Error : grad norm is NaN @ step '+str(step))
+                self.amp.update()
             else:
-                self.d_optim.step()
+                self.amp.step(self.d_optim)
 
         total_d_loss /= self.d_iters
         weighted_d_loss /= self.d_iters
-        total_gp /= self.d_iters
+        total_gp /= max(gp_cnt, 1)
         total_grad_norm /= self.d_iters
         meta = { f'{prefix}d_loss': total_d_loss,
                  f'{prefix}gradient_penalty': total_gp,
@@ -605,87 +785,95 @@ class Trainer(Solver):
 
         self.writer.log_step_info('train', meta)
 
+    def gen_adv_loss(self, src_feat, src_mask, tgt_feat, tgt_mask):
+        """
+        G loss of fooling D, src is labeled as tgt and vice versa
+        Returns:
+            g_loss, [ #correct D predictions, #predictions ] ('gan' only, else zeros)
+        """
+        correct = 0.
+        cnt = 0
+        if self.adv_loss == 'wgan-gp':
+            g_fake_loss = - self.D(src_feat).mean()
+            g_real_loss = self.D(tgt_feat).mean()
+        elif self.adv_loss == 'gan':
+            if not self.cdan:
+                g_fake_out = self.D(src_feat)
+                g_real_out = self.D(tgt_feat)
+            else:
+                g_fake_out = self.D(src_feat, src_mask)
+                g_real_out = self.D(tgt_feat, tgt_mask)
+            g_fake_loss = self.bce_loss(g_fake_out,
+                                        self.tgt_label.expand_as(g_fake_out))
+            g_real_loss = self.bce_loss(g_real_out,
+                                        self.src_label.expand_as(g_real_out))
+            with torch.no_grad():
+                src_dp = ((F.sigmoid(g_fake_out) >= 0.5).float() == self.src_label).float()
+                tgt_dp = ((F.sigmoid(g_real_out) >= 0.5).float() == self.tgt_label).float()
+                correct = src_dp.sum() + tgt_dp.sum()
+                cnt = src_dp.numel() + tgt_dp.numel()
+        elif self.adv_loss == 'hinge':
+            g_fake_loss = - self.D(src_feat).mean()
+            g_real_loss = self.D(tgt_feat).mean()
+
+        g_loss = g_real_loss + g_fake_loss
+        return g_loss, [ correct, cnt ]
+
     def train_gen_once(self, step, src_gen, tgt_gen):
         # Only remain gan now
 
         total_g_loss = 0.
         weighted_g_loss = 0.
         domain_acc = 0.
-        src_domain_acc = 0.
-        tgt_domain_acc = 0.
         total_grad_norm = 0.
         cnt = 0
         for _ in range(self.g_iters):
 
-            # fake(src) sample
-            sample = src_gen.__next__()
-            src_mixture = sample['mix'].to(DEV)
-
-            if not self.cdan:
-                _, src_feat = self.G(src_mixture)
-            else:
-                _, src_feat, src_mask = self.G.cdan_forward(src_mixture)
-
-            if self.adv_loss == 'wgan-gp':
-                g_fake_loss = - self.D(src_feat).mean()
-            elif self.adv_loss == 'gan':
-                if not self.cdan:
-                    g_fake_out = self.D(src_feat)
-                else:
-                    g_fake_out = self.D(src_feat, src_mask)
-                g_fake_loss = self.bce_loss(g_fake_out,
-                                            self.tgt_label.expand_as(g_fake_out))
-                with torch.no_grad():
-                    src_dp = ((F.sigmoid(g_fake_out) >= 0.5).float() == self.src_label).float()
-                    domain_acc += src_dp.sum().item()
-                    cnt += src_dp.numel()
-            elif self.adv_loss == 'hinge':
-                g_fake_out = self.D(src_feat)
-                g_fake_loss = - g_fake_out.mean()
-
-            # true(tgt) sample
-            sample = tgt_gen.__next__()
-            tgt_mixture = sample['mix'].to(DEV)
-
-            if not self.cdan:
-                _, tgt_feat = self.G(tgt_mixture)
-            else:
-                _, tgt_feat, tgt_mask = self.G.cdan_forward(tgt_mixture)
-
-            if self.adv_loss == 'wgan-gp':
-                g_real_loss = self.D(tgt_feat).mean()
-            elif self.adv_loss == 'gan':
-                if not self.cdan:
-                    g_real_out = self.D(tgt_feat)
-                else:
-                    g_real_out = self.D(tgt_feat, tgt_mask)
-                g_real_loss = self.bce_loss(g_real_out,
-                                            self.src_label.expand_as(g_real_out))
-                with torch.no_grad():
-                    tgt_dp = ((F.sigmoid(g_real_out) >= 0.5).float() == self.tgt_label).float()
-                    domain_acc += tgt_dp.sum().item()
-                    cnt += tgt_dp.numel()
-            elif self.adv_loss == 'hinge':
-                g_real_out = self.D(tgt_feat)
-                g_real_loss = g_real_out.mean()
-
-            g_loss = g_real_loss + g_fake_loss
-            g_lambda = self.Lg_scheduler.value(step)
-            print(g_lambda)
-            _g_loss = g_loss * g_lambda
-
             self.D.zero_grad()
             self.G.zero_grad()
-            _g_loss.backward()
+            for _ in range(self.accum_steps):
+                with self.amp.autocast():
+                    # fake(src) sample
+                    sample = src_gen.__next__()
+                    src_mixture = sample['mix'].to(DEV)
+
+                    if not self.cdan:
+                        _, src_feat = self.G(src_mixture)
+                        src_mask = None
+                    else:
+                        _, src_feat, src_mask = self.G.cdan_forward(src_mixture)
+
+                    # true(tgt) sample
+                    sample = tgt_gen.__next__()
+                    tgt_mixture = sample['mix'].to(DEV)
+
+                    if not self.cdan:
+                        _, tgt_feat = self.G(tgt_mixture)
+                        tgt_mask = None
+                    else:
+                        _, tgt_feat, tgt_mask = self.G.cdan_forward(tgt_mixture)
+
+                    g_loss, (c, n) = self.gen_adv_loss(src_feat, src_mask, tgt_feat, tgt_mask)
+                    domain_acc += c
+                    cnt += n
+
+                g_lambda = self.Lg_scheduler.value(step)
+                print(g_lambda)
+                _g_loss = g_loss * g_lambda
+                self.amp.backward(self.accum_loss(_g_loss))
+
+                total_g_loss += g_loss.detach() / self.accum_steps
+                weighted_g_loss += _g_loss.detach() / self.accum_steps
+
+            sync_grads(self.G)
+            self.amp.unscale_(self.g_optim)
             grad_norm = torch.nn.utils.clip_grad_norm_(self.G.parameters(), self.G_grad_clip)
             total_grad_norm += grad_norm
             if math.isnan(grad_norm):
                 print('Error : grad norm is NaN @ step '+str(step))
+                self.amp.update()
             else:
-                self.g_optim.step()
-
-            total_g_loss += g_loss.item()
-            weighted_g_loss += _g_loss.item()
+                self.amp.step(self.g_optim)
 
         total_g_loss /= self.g_iters
         weighted_g_loss /= self.g_iters
@@ -736,6 +924,9 @@ class Trainer(Solver):
                 total_sisnri += max_sisnri.sum().item()
                 cnt += B
 
+        # sum over ranks
+        total_loss, total_sisnri, cnt, domain_acc, dcnt = \
+                all_reduce_sum([ total_loss, total_sisnri, cnt, domain_acc, dcnt ])
         total_sisnri = total_sisnri / cnt
         total_loss = total_loss / cnt
         if self.adv_loss != 'wgan-gp' and label != None:
@@ -815,6 +1006,11 @@ class Trainer(Solver):
                             acc_num = (dp_b == label).sum().item()
                             domain_acc += float(acc_num)
 
+        # sum over ranks
+        total_loss, total_sisnri, cnt, domain_acc, dcnt = \
+                all_reduce_sum([ total_loss, total_sisnri, cnt, domain_acc, dcnt ])
+        gender_sisnri = all_reduce_sum(gender_sisnri)
+        gender_cnt = all_reduce_sum(gender_cnt)
         total_sisnri = total_sisnri / cnt
         total_loss = total_loss / cnt
         if self.adv_loss != 'wgan-gp' and label != None:
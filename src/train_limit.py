@@ -11,7 +11,6 @@ import torch
 import torch.nn as nn
 
 from tqdm import tqdm
-from torch.utils.data import DataLoader
 
 from src.solver import Solver
 from src.saver import Saver
@@ -23,6 +22,8 @@ from src.wham import wham, wham_eval
 from src.limited_dataset import LimitDataset, LimitWham
 from src.ranger import Ranger
 from src.dashboard import Dashboard
+from src.mixed_precision import MixedPrecision
+from src.distributed import is_main_process, broadcast_object, broadcast_model, sync_grads, all_reduce_sum, make_loader, set_epoch
 from src.scheduler import RampScheduler, ConstantScheduler, DANNScheduler
 
 class Trainer(Solver):
@@ -34,6 +35,8 @@ class Trainer(Solver):
 
         ts = time.time()
         st = datetime.datetime.fromtimestamp(ts).strftime('%Y_%m_%d_%H_%M_%S')
+        # same save/log dir on every rank
+        st = broadcast_object(st)
 
         self.resume_model = False
         resume_exp_name = config['solver'].get('resume_exp_name', '')
@@ -73,6 +76,7 @@ class Trainer(Solver):
         self.grad_clip = config['solver']['grad_clip']
         self.num_workers = config['solver']['num_workers']
         self.step = 0
+        self.amp = MixedPrecision(config['solver'], DEV)
 
         self.jointly = config['solver']['jointly']
         self.jointly_w = config['solver']['jointly_w']
@@ -82,8 +86,9 @@ class Trainer(Solver):
 
         config['limit_info'] = self.limit_info
         if not resume_exp_name:
-            yaml.dump(config, open(os.path.join(self.save_dir, 'config.yaml'), 'w'),
-                    default_flow_style = False ,indent = 4)
+            if is_main_process():
+                yaml.dump(config, open(os.path.join(self.save_dir, 'config.yaml'), 'w'),
+                        default_flow_style = False ,indent = 4)
 
         self.script_name = os.path.basename(__file__).split('.')[0].split('_')[-1]
         self.writer.add_tag(self.script_name)
@@ -115,7 +120,10 @@ class Trainer(Solver):
         self.sup_dset = dset
         self.limit_dset = limit_dset
         self.sup_tr_loader, self.sup_cv_loader = self.load_dset(self.sup_dset, seg_len)
-        self.pretrained_tr_gen = inf_data_gen(self.sup_tr_loader)
+        # only consumed by joint training
+        self.pretrained_tr_gen = None
+        if self.jointly:
+            self.pretrained_tr_gen = inf_data_gen(self.sup_tr_loader, self.config['solver'].get('prefetch', 0))
 
         _, self.limit_cv_loader = self.load_dset(self.limit_dset, 4.0)
         self.limit_tr_loader = self.load_limit(limit_dset, limit_seg_len, limit_spk_num, limit_utts_per_spk)
@@ -134,19 +142,19 @@ class Trainer(Solver):
         trainset = wsj0(tr_list,
                 audio_root = audio_root,
                 seg_len = seg_len,
-                pre_load = False,
+                pre_load = self.pre_load,
                 one_chunk_in_utt = True,
                 mode = 'tr',
                 sp_factors = sp_factors)
-        tr_loader = DataLoader(trainset,
+        tr_loader = make_loader(trainset,
                 batch_size = self.batch_size,
                 shuffle = True,
                 num_workers = self.num_workers)
 
         devset = wsj0_eval(cv_list,
                 audio_root = audio_root,
-                pre_load = False)
-        cv_loader = DataLoader(devset,
+                pre_load = self.pre_load)
+        cv_loader = make_loader(devset,
                 batch_size = self.batch_size,
                 shuffle = False,
                 num_workers = self.num_workers)
@@ -163,21 +171,21 @@ class Trainer(Solver):
         trainset = wham(tr_list,
                 audio_root = audio_root,
                 seg_len = seg_len,
-                pre_load = False,
+                pre_load = self.pre_load,
                 one_chunk_in_utt = True,
                 mode = 'tr',
                 scale = scale)
-        tr_loader = DataLoader(trainset,
+        tr_loader = make_loader(trainset,
                 batch_size = self.batch_size,
                 shuffle = True,
                 num_workers = self.num_workers)
 
         devset = wham_eval(cv_list,
                 audio_root = audio_root,
-                pre_load = False,
+                pre_load = self.pre_load,
                 mode = 'cv',
                 scale = scale)
-        cv_loader = DataLoader(devset,
+        cv_loader = make_loader(devset,
                 batch_size = self.batch_size,
                 shuffle = False,
                 num_workers = self.num_workers)
@@ -216,7 +224,7 @@ class Trainer(Solver):
                     scale = scale)
 
         self.limit_info = trainset.get_info()
-        tr_loader = DataLoader(trainset,
+        tr_loader = make_loader(trainset,
                 batch_size = self.batch_size,
                 shuffle = True,
                 num_workers = self.num_workers)
@@ -291,11 +299,15 @@ class Trainer(Solver):
 
             if self.config['solver']['resume_optim']:
                 optim_dict = info_dict['optim']
+                if 'amp' in info_dict:
+                    self.amp.load_state_dict(info_dict['amp'])
 
             # dashboard is one-base
             self.writer.set_epoch(self.start_epoch + 1)
             self.writer.set_step(self.step + 1)
 
+        # every rank starts from rank 0 weights
+        broadcast_model(self.model)
         self.opt = self.set_optim(self.config['optim'], self.model.parameters(), optim_dict)
 
         self.use_scheduler = False
@@ -335,13 +347,14 @@ class Trainer(Solver):
 
             self.writer.epoch()
 
-        if self.test_after_finished:
+        if self.test_after_finished and is_main_process():
             conf = self.construct_test_conf(dsets = 'all', sdir = 'chapter3', choose_best = False, compute_sdr = False)
             result = self.run_tester('test_baseline.py', conf)
             result['tt_config'] = conf
             self.writer.log_result(result)
 
     def train_one_epoch(self, epoch, sup_loader, pretrained_gen):
+        set_epoch(sup_loader, epoch)
         self.model.train()
         total_loss = 0.
         total_pretrained_loss = 0.
@@ -355,9 +368,10 @@ class Trainer(Solver):
             B = sup_mixture.size(0)
 
             # sup part
-            est_source = self.model(sup_mixture)
-            limit_loss, max_snr, estimate_source, reorder_estimate_source = \
-                    cal_loss(sup_source, est_source, sup_lengths)
+            with self.amp.autocast():
+                est_source = self.model(sup_mixture)
+                limit_loss, max_snr, estimate_source, reorder_estimate_source = \
+                        cal_loss(sup_source, est_source, sup_lengths)
             loss = limit_loss
 
             if self.jointly:
@@ -366,28 +380,37 @@ class Trainer(Solver):
                 pre_source = pre_sample['ref'].to(DEV)
                 pre_lengths = pre_sample['ilens'].to(DEV)
 
-                est_source = self.model(pre_mixture)
-                pre_loss, max_snr, estimate_source, reorder_estimate_source = \
-                         cal_loss(pre_source, est_source, pre_lengths)
+                with self.amp.autocast():
+                    est_source = self.model(pre_mixture)
+                    pre_loss, max_snr, estimate_source, reorder_estimate_source = \
+                             cal_loss(pre_source, est_source, pre_lengths)
 
                 loss += self.jointly_w * pre_loss
 
-            self.model.zero_grad()
-            loss.backward()
-            grad_norm = torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
-            self.opt.step()
-
-            meta = { 'iter_loss': limit_loss.item() }
-            total_loss += limit_loss.item() * B
+            update = self.is_accum_end(i, len(sup_loader))
+            if self.is_accum_start(i):
+                self.model.zero_grad()
+            self.amp.backward(self.accum_loss(loss))
+            if update:
+                self.rescale_tail_grads([ self.model ], i)
+                sync_grads(self.model)
+                self.amp.unscale_(self.opt)
+                grad_norm = torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
+                self.amp.step(self.opt)
+
+            meta = { 'iter_loss': limit_loss.detach() }
+            total_loss += limit_loss.detach() * B
             cnt += B
 
             if self.jointly:
-                meta['iter_pretrained_loss'] = pre_loss.item()
-                total_pretrained_loss += pre_loss.item() * B
+                meta['iter_pretrained_loss'] = pre_loss.detach()
+                total_pretrained_loss += pre_loss.detach() * B
 
-            self.writer.log_step_info('train', meta)
-            self.step += 1
-            self.writer.step()
+            self.accum_meta(meta)
+            if update:
+                self.writer.log_step_info('train', self.pop_step_meta())
+                self.step += 1
+                self.writer.step()
 
         total_loss /= cnt
         total_pretrained_loss /= cnt
@@ -426,6 +449,8 @@ class Trainer(Solver):
                 total_sisnri += max_sisnri.sum().item()
                 cnt += B
 
+        # sum over ranks
+        total_loss, total_sisnri, cnt = all_reduce_sum([ total_loss, total_sisnri, cnt ])
         total_sisnri = total_sisnri / cnt
         total_loss = total_loss / cnt
 
@@ -443,6 +468,7 @@ class Trainer(Solver):
         model_name = f'{epoch}.pth'
         info_dict = { 'epoch': epoch, 'valid_score': valid_score, 'config': self.config }
         info_dict['optim'] = self.opt.state_dict()
+        info_dict['amp'] = self.amp.state_dict()
 
         self.saver.update(self.model, total_sisnri, model_name, info_dict)
 
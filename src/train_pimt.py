@@ -11,9 +11,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 
-from apex import amp
 from tqdm import tqdm
-from torch.utils.data import DataLoader
 
 from src.solver import Solver
 from src.saver import Saver
@@ -25,6 +23,10 @@ from src.wham import wham, wham_eval
 from src.ranger import Ranger
 from src.dashboard import Dashboard
 from src.pimt_utils import PITMSELoss
+from src.pseudo_label import PseudoLabelStore, build_pseudo_labels
+from src.ema import EMA
+from src.mixed_precision import MixedPrecision
+from src.distributed import is_main_process, broadcast_object, broadcast_model, sync_grads, all_reduce_sum, make_loader, set_epoch
 from src.scheduler import RampScheduler, ConstantScheduler, DANNScheduler
 
 """
@@ -41,6 +43,8 @@ class Trainer(Solver):
 
         ts = time.time()
         st = datetime.datetime.fromtimestamp(ts).strftime('%Y_%m_%d_%H_%M_%S')
+        # same save/log dir on every rank
+        st = broadcast_object(st)
 
         self.resume_model = False
         resume_exp_name = config['solver'].get('resume_exp_name', '')
@@ -68,8 +72,9 @@ class Trainer(Solver):
             self.save_dir = os.path.join(config['solver']['save_dir'], save_name)
             self.safe_mkdir(self.save_dir)
             self.saver = Saver(config['solver']['max_save_num'], self.save_dir, 'max')
-            yaml.dump(config, open(os.path.join(self.save_dir, 'config.yaml'), 'w'),
-                    default_flow_style = False ,indent = 4)
+            if is_main_process():
+                yaml.dump(config, open(os.path.join(self.save_dir, 'config.yaml'), 'w'),
+                        default_flow_style = False ,indent = 4)
 
             log_name = self.exp_name + '-' + st
             self.log_dir = os.path.join(config['solver']['log_dir'], log_name)
@@ -105,10 +110,13 @@ class Trainer(Solver):
             self.algo = 'mt'
             self.use_teacher = True
             self.mt_lambda = self.mt_conf['lambda']
+            self.ema_alpha = self.mt_conf.get('ema_alpha', 0.999)
+            self.ema_every = self.mt_conf.get('ema_every', 1)
         elif self.mbt_conf['use']:
             self.algo = 'mbt'
             self.use_teacher = True
             self.ema_alpha = self.mbt_conf['ema_alpha']
+            self.ema_every = self.mbt_conf.get('ema_every', 1)
             self.sampler = torch.distributions.uniform.Uniform(low=-2.5, high=2.5)
         elif self.pl_conf['use']:
             self.algo = 'pl'
@@ -124,12 +132,15 @@ class Trainer(Solver):
         self.step = 0
         self.valid_times = 0
 
-        self.fp16 = config['solver'].get('fp16', False)
+        # legacy solver.fp16 is mapped to amp: 'fp16'
+        self.amp = MixedPrecision(config['solver'], DEV)
 
         self.load_data()
         self.set_model()
-
-        self.convert_fp16()
+        if self.algo == 'ns' and self.ns_conf.get('offline', False):
+            self.set_pseudo_labels()
+        # after pseudo labels are attached, workers start here
+        self.uns_tr_gen = inf_data_gen(self.uns_tr_loader, self.config['solver'].get('prefetch', 0))
 
         self.script_name = os.path.basename(__file__).split('.')[0].split('_')[-1]
         self.writer.add_tag(self.script_name)
@@ -149,12 +160,6 @@ class Trainer(Solver):
         elif sch_config['function'] == 'constant':
             return ConstantScheduler(sch_config['value'])
 
-    def convert_fp16(self):
-        if self.fp16:
-            print('Use mix-percision speed up')
-            opt_level = 'O1'
-            self.model, self.opt = amp.initialize(self.model, self.opt, opt_level=opt_level)
-
     def load_data(self):
 
         # Set sup&uns dataset
@@ -175,7 +180,6 @@ class Trainer(Solver):
         self.uns_dset = uns_dset
         self.sup_tr_loader, self.sup_cv_loader = self.load_dset(self.sup_dset, seg_len)
         self.uns_tr_loader, self.uns_cv_loader = self.load_dset(self.uns_dset, uns_seg_len)
-        self.uns_tr_gen = inf_data_gen(self.uns_tr_loader)
 
     def load_dset(self, dset, seg_len):
         # root: wsj0_root, vctk_root, libri_root
@@ -191,19 +195,19 @@ class Trainer(Solver):
         trainset = wsj0(tr_list,
                 audio_root = audio_root,
                 seg_len = seg_len,
-                pre_load = False,
+                pre_load = self.pre_load,
                 one_chunk_in_utt = True,
                 mode = 'tr',
                 sp_factors = sp_factors)
-        tr_loader = DataLoader(trainset,
+        tr_loader = make_loader(trainset,
                 batch_size = self.batch_size,
                 shuffle = True,
                 num_workers = self.num_workers)
 
         devset = wsj0_eval(cv_list,
                 audio_root = audio_root,
-                pre_load = False)
-        cv_loader = DataLoader(devset,
+                pre_load = self.pre_load)
+        cv_loader = make_loader(devset,
                 batch_size = self.batch_size,
                 shuffle = False,
                 num_workers = self.num_workers)
@@ -220,26 +224,68 @@ class Trainer(Solver):
         trainset = wham(tr_list,
                 audio_root = audio_root,
                 seg_len = seg_len,
-                pre_load = False,
+                pre_load = self.pre_load,
                 one_chunk_in_utt = True,
                 mode = 'tr',
                 scale = scale)
-        tr_loader = DataLoader(trainset,
+        tr_loader = make_loader(trainset,
                 batch_size = self.batch_size,
                 shuffle = True,
                 num_workers = self.num_workers)
 
         devset = wham_eval(cv_list,
                 audio_root = audio_root,
-                pre_load = False,
+                pre_load = self.pre_load,
                 mode = 'cv',
                 scale = scale)
-        cv_loader = DataLoader(devset,
+        cv_loader = make_loader(devset,
                 batch_size = self.batch_size,
                 shuffle = False,
                 num_workers = self.num_workers)
         return tr_loader, cv_loader
 
+    def load_full_trainset(self, dset):
+        # whole utterances of the train list, input of offline teacher
+        d = 'wsj' if dset == 'wsj0' else dset
+        if 'wham' in dset:
+            scale = read_scale(f'./data/{dset}')
+            return wham_eval(f'./data/wsj0/id_list/tr.pkl',
+                    audio_root = self.config['data']['wsj_root'],
+                    pre_load = False,
+                    mode = 'tr',
+                    scale = scale)
+        return wsj0_eval(f'./data/{dset}/id_list/tr.pkl',
+                audio_root = self.config['data'][f'{d}_root'],
+                pre_load = False)
+
+    def set_pseudo_labels(self):
+        # teacher is frozen, run it once over uns_dset instead of every batch
+        pseudo_dir = self.ns_conf.get('pseudo_dir', '')
+        if pseudo_dir == '':
+            pseudo_dir = os.path.join(self.save_dir, f'pseudo_{self.uns_dset}')
+
+        teacher_path = self.config['solver'].get('pretrained_teacher', '')
+        uids = list(dict.fromkeys(info[0] for info in self.uns_tr_loader.dataset.id_list))
+
+        store = None
+        if PseudoLabelStore.exists(pseudo_dir, teacher_path):
+            print(f'Load pseudo labels from {pseudo_dir}')
+            store = PseudoLabelStore(pseudo_dir)
+            missing = store.missing(uids)
+            if len(missing) > 0:
+                print(f'{len(missing)} utts of {self.uns_dset} have no pseudo label (e.g. {missing[0]}), rebuild')
+                store = None
+
+        if store is None:
+            print(f'Build pseudo labels of {self.uns_dset} by teacher')
+            dataset = self.load_full_trainset(self.uns_dset)
+            store = build_pseudo_labels(self.teacher, dataset, pseudo_dir, self.amp, self.num_workers, teacher_path)
+            missing = store.missing(uids)
+            if len(missing) > 0:
+                print(f'Error: {len(missing)} utts of {self.uns_dset} have no pseudo label after build (e.g. {missing[0]})')
+                exit()
+        self.uns_tr_loader.dataset.pseudo = store
+
     def set_teacher(self):
         tpath = self.config['solver'].get('pretrained_teacher', '')
         tconf = self.config['solver'].get('teacher_config', '')
@@ -265,6 +311,8 @@ class Trainer(Solver):
 
         if self.use_teacher:
             self.set_teacher()
+        if self.algo in [ 'mt', 'mbt' ]:
+            self.ema = EMA(self.model, self.teacher, self.ema_alpha, self.ema_every)
 
         # TODO, get optim_dict from pretrained and resume
         # maybe buggy
@@ -298,8 +346,11 @@ class Trainer(Solver):
                 self.writer.set_epoch(self.start_epoch + 1)
                 self.writer.set_step(self.step + 1)
 
-                if self.fp16 and 'amp' in info_dict:
-                    amp.load_state_dict(info_dict['amp'])
+                if 'amp' in info_dict:
+                    self.amp.load_state_dict(info_dict['amp'])
+
+        # every rank starts from rank 0 weights
+        broadcast_model(self.model)
 
         lr = self.config['optim']['lr']
         weight_decay = self.config['optim']['weight_decay']
@@ -362,12 +413,6 @@ class Trainer(Solver):
         else:
             return None
 
-    def update_ema(self, model, ema_model, alpha, global_step):
-        # TODO, weird alpha
-        alpha = min(1 - 1/(global_step + 1), alpha)
-        for ema_param, param in zip(ema_model.parameters(), model.parameters()):
-            ema_param.data.mul_(alpha).add_(1-alpha, param.data)
-
     def exec(self):
         for epoch in tqdm(range(self.start_epoch, self.epochs), ncols = NCOL):
             if self.algo == 'pi':
@@ -393,7 +438,7 @@ class Trainer(Solver):
 
             self.writer.epoch()
 
-        if self.test_after_finished:
+        if self.test_after_finished and is_main_process():
             conf = self.construct_test_conf(dsets = 'all', sdir = 'chapter5', choose_best = False, compute_sdr = False)
             result = self.run_tester('test_baseline.py', conf)
             result['tt_config'] = conf
@@ -412,6 +457,7 @@ class Trainer(Solver):
         return weight_cl
 
     def train_pi_model(self, epoch, sup_loader, uns_gen):
+        set_epoch(sup_loader, epoch)
         self.model.train()
         total_loss = 0.
         total_pi_sup = 0.
@@ -419,7 +465,9 @@ class Trainer(Solver):
         cnt = 0
 
         for i, sample in enumerate(tqdm(sup_loader, ncols = NCOL)):
-            self.opt.zero_grad()
+            update = self.is_accum_end(i, len(sup_loader))
+            if self.is_accum_start(i):
+                self.opt.zero_grad()
 
             # sup part
             padded_mixture = sample['mix'].to(DEV)
@@ -427,76 +475,68 @@ class Trainer(Solver):
             mixture_lengths = sample['ilens'].to(DEV)
             B = padded_mixture.size(0)
 
-            estimate_source = self.model(padded_mixture)
+            with self.amp.autocast():
+                estimate_source = self.model(padded_mixture)
 
-            sup_loss, max_snr, estimate_source, reorder_estimate_source = \
-                cal_loss(padded_source, estimate_source, mixture_lengths)
+                sup_loss, max_snr, estimate_source, reorder_estimate_source = \
+                    cal_loss(padded_source, estimate_source, mixture_lengths)
             loss = sup_loss
 
-            if self.fp16:
-                with amp.scale_loss(loss, self.opt) as scaled_loss:
-                    scaled_loss.backward()
-            else:
-                loss.backward()
-
-            # pi on sup
-            with torch.no_grad():
-                self.model.eval()
-                estimate_clean_sup, feat_clean_sup = self.model.fetch_forward(padded_mixture, self.locs)
-                self.model.train()
-            estimate_noise_sup, feat_noise_sup = self.model.fetch_forward(padded_mixture, self.locs, self.transform)
-            loss_pi_sup = self.con_loss(estimate_clean_sup, estimate_noise_sup, mixture_lengths, feat_clean_sup, feat_noise_sup)
-
-            # pi on uns
-            if not self.same_dset:
-                uns_sample = uns_gen.__next__()
-                padded_mixture = uns_sample['mix'].to(DEV)
-                mixture_lengths = uns_sample['ilens'].to(DEV)
+            self.amp.backward(self.accum_loss(loss))
 
+            with self.amp.autocast():
+                # pi on sup
                 with torch.no_grad():
                     self.model.eval()
-                    estimate_clean_uns, feat_clean_uns = self.model.fetch_forward(padded_mixture, self.locs)
+                    estimate_clean_sup, feat_clean_sup = self.model.fetch_forward(padded_mixture, self.locs)
                     self.model.train()
-                estimate_noise_uns, feat_noise_uns = self.model.fetch_forward(padded_mixture, self.locs, self.transform)
-                loss_pi_uns = self.con_loss(estimate_clean_uns, estimate_noise_uns, mixture_lengths, feat_clean_uns, feat_noise_uns)
-            else:
-                loss_pi_uns = torch.zeros(1).to(DEV)
+                estimate_noise_sup, feat_noise_sup = self.model.fetch_forward(padded_mixture, self.locs, self.transform)
+                loss_pi_sup = self.con_loss(estimate_clean_sup, estimate_noise_sup, mixture_lengths, feat_clean_sup, feat_noise_sup)
+
+                # pi on uns
+                if not self.same_dset:
+                    uns_sample = uns_gen.__next__()
+                    padded_mixture = uns_sample['mix'].to(DEV)
+                    mixture_lengths = uns_sample['ilens'].to(DEV)
+
+                    with torch.no_grad():
+                        self.model.eval()
+                        estimate_clean_uns, feat_clean_uns = self.model.fetch_forward(padded_mixture, self.locs)
+                        self.model.train()
+                    estimate_noise_uns, feat_noise_uns = self.model.fetch_forward(padded_mixture, self.locs, self.transform)
+                    loss_pi_uns = self.con_loss(estimate_clean_uns, estimate_noise_uns, mixture_lengths, feat_clean_uns, feat_noise_uns)
+                else:
+                    loss_pi_uns = torch.zeros(1).to(DEV)
 
             w_sup = self.cal_consistency_weight(self.step, end_ep = self.warmup_step, init_w = self.sup_init_w, end_w = self.sup_pi_lambda)
             w_uns = self.cal_consistency_weight(self.step, end_ep = self.warmup_step, init_w = self.uns_init_w, end_w = self.uns_pi_lambda)
             loss = w_sup * loss_pi_sup + w_uns * loss_pi_uns
 
-            if self.fp16:
-                with amp.scale_loss(loss, self.opt) as scaled_loss:
-                    scaled_loss.backward()
-            else:
-                loss.backward()
-
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
-            self.opt.step()
+            self.amp.backward(self.accum_loss(loss))
 
-            # forward_hook cause memory leak, need to release(del) them
-            if not self.same_dset:
-                hook_feats = [ feat_clean_sup, feat_noise_sup, feat_clean_uns, feat_noise_uns ]
-            else:
-                hook_feats = [ feat_clean_sup, feat_noise_sup ]
-            for feat in hook_feats:
-                self.model.clean_hook_tensor(feat)
+            if update:
+                self.rescale_tail_grads([ self.model ], i)
+                sync_grads(self.model)
+                self.amp.unscale_(self.opt)
+                torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
+                self.amp.step(self.opt)
 
-            meta = { 'iter_loss': sup_loss.item(),
-                     'iter_pi_sup_loss': loss_pi_sup.item(),
-                     'iter_pi_uns_loss': loss_pi_uns.item(),
+            meta = { 'iter_loss': sup_loss.detach(),
+                     'iter_pi_sup_loss': loss_pi_sup.detach(),
+                     'iter_pi_uns_loss': loss_pi_uns.detach(),
                      'w_sup': w_sup,
                      'w_uns': w_uns }
-            self.writer.log_step_info('train', meta)
+            self.accum_meta(meta)
 
-            total_loss += sup_loss.item() * B
-            total_pi_sup += loss_pi_sup.item() * B
-            total_pi_uns += loss_pi_uns.item() * B
+            total_loss += sup_loss.detach() * B
+            total_pi_sup += loss_pi_sup.detach() * B
+            total_pi_uns += loss_pi_uns.detach() * B
             cnt += B
 
-            self.step += 1
-            self.writer.step()
+            if update:
+                self.writer.log_step_info('train', self.pop_step_meta())
+                self.step += 1
+                self.writer.step()
 
         total_loss = total_loss / cnt
         total_pi_sup = total_pi_sup / cnt
@@ -508,9 +548,84 @@ class Trainer(Solver):
         self.writer.log_epoch_info('train', meta)
 
     def train_mt(self, epoch, sup_loader, uns_gen):
-        pass
+        set_epoch(sup_loader, epoch)
+        self.model.train()
+        self.teacher.train()
+        total_loss = 0.
+        total_uns_loss = 0.
+        cnt = 0
+
+        for i, sample in enumerate(tqdm(sup_loader, ncols = NCOL)):
+
+            # sup part
+            padded_mixture = sample['mix'].to(DEV)
+            padded_source = sample['ref'].to(DEV)
+            mixture_lengths = sample['ilens'].to(DEV)
+            B = padded_mixture.size(0)
+
+            with self.amp.autocast():
+                estimate_source = self.model(padded_mixture)
+
+                sup_loss, max_snr, estimate_source, reorder_estimate_source = \
+                    cal_loss(padded_source, estimate_source, mixture_lengths)
+
+            # consistency between student and ema teacher on uns,
+            # perturbed by input_transform (if set) and dropout
+            uns_sample = uns_gen.__next__()
+            padded_mixture = uns_sample['mix'].to(DEV)
+            mixture_lengths = uns_sample['ilens'].to(DEV)
+
+            with self.amp.autocast():
+                with torch.no_grad():
+                    if self.transform is not None:
+                        teacher_out = self.teacher.noise_forward(padded_mixture, self.transform)
+                    else:
+                        teacher_out = self.teacher(padded_mixture)
+
+                if self.transform is not None:
+                    student_out = self.model.noise_forward(padded_mixture, self.transform)
+                else:
+                    student_out = self.model(padded_mixture)
+
+                uns_loss, max_snr, estimate_source, reorder_estimate_source = \
+                    cal_loss(teacher_out, student_out, mixture_lengths)
+
+            loss = sup_loss + self.mt_lambda * uns_loss
+            update = self.is_accum_end(i, len(sup_loader))
+            if self.is_accum_start(i):
+                self.opt.zero_grad()
+            self.amp.backward(self.accum_loss(loss))
+
+            if update:
+                self.rescale_tail_grads([ self.model ], i)
+                sync_grads(self.model)
+                self.amp.unscale_(self.opt)
+                torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
+                self.amp.step(self.opt)
+                self.ema.update(self.step)
+
+            meta = { 'iter_loss': sup_loss.detach(),
+                     'iter_uns_loss': uns_loss.detach() }
+            self.accum_meta(meta)
+
+            total_loss += sup_loss.detach() * B
+            total_uns_loss += uns_loss.detach() * B
+            cnt += B
+
+            if update:
+                self.writer.log_step_info('train', self.pop_step_meta())
+                self.step += 1
+                self.writer.step()
+
+        total_loss = total_loss / cnt
+        total_uns_loss = total_uns_loss / cnt
+
+        meta = { 'epoch_loss': total_loss,
+                 'epoch_uns_loss': total_uns_loss }
+        self.writer.log_epoch_info('train', meta)
 
     def train_mbt(self, epoch, sup_loader, uns_gen):
+        set_epoch(sup_loader, epoch)
         self.model.train()
         total_loss = 0.
         total_mixup = 0.
@@ -524,10 +639,11 @@ class Trainer(Solver):
             padded_source = sample['ref'].to(DEV)
             mixture_lengths = sample['ilens'].to(DEV)
 
-            estimate_source = self.model(padded_mixture)
+            with self.amp.autocast():
+                estimate_source = self.model(padded_mixture)
 
-            sup_loss, max_snr, estimate_source, reorder_estimate_source = \
-                cal_loss(padded_source, estimate_source, mixture_lengths)
+                sup_loss, max_snr, estimate_source, reorder_estimate_source = \
+                    cal_loss(padded_source, estimate_source, mixture_lengths)
 
             # mixup training
             uns_sample = uns_gen.__next__()
@@ -535,45 +651,55 @@ class Trainer(Solver):
             padded_source = uns_sample['ref'].to(DEV)
             mixture_lengths = uns_sample['ilens'].to(DEV)
 
-            with torch.no_grad():
-                teacher_out = self.teacher(padded_mixture)
-                s1 = teacher_out[:, 0, :]
-                s2 = teacher_out[:, 1, :]
+            with self.amp.autocast():
+                with torch.no_grad():
+                    teacher_out = self.teacher(padded_mixture)
+                    s1 = teacher_out[:, 0, :]
+                    s2 = teacher_out[:, 1, :]
 
-                mlambda = self.sampler.sample((s1.size(0),1)).to(DEV)
-                l1 = 10 ** (mlambda / 20)
-                l2 = 10 ** (-mlambda / 20)
-                teacher_mix = l1 * s1 + l2 * s2
+                    mlambda = self.sampler.sample((s1.size(0),1)).to(DEV)
+                    l1 = 10 ** (mlambda / 20)
+                    l2 = 10 ** (-mlambda / 20)
+                    teacher_mix = l1 * s1 + l2 * s2
 
-            student_out = self.model(teacher_mix)
-            mixup_loss, max_snr, estimate_source, reorder_estimate_source = \
-                cal_loss(teacher_out, student_out, mixture_lengths)
+                student_out = self.model(teacher_mix)
+                mixup_loss, max_snr, estimate_source, reorder_estimate_source = \
+                    cal_loss(teacher_out, student_out, mixture_lengths)
 
             r = np.exp(float(epoch+1)/self.epochs - 1)
             loss = sup_loss + r * mixup_loss
 
             # SGD update
-            self.opt.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
-            self.opt.step()
-            meta = { 'iter_loss': sup_loss.item(),
-                     'iter_mixup': mixup_loss.item() }
-            self.writer.log_step_info('train', meta)
+            update = self.is_accum_end(i, len(sup_loader))
+            if self.is_accum_start(i):
+                self.opt.zero_grad()
+            self.amp.backward(self.accum_loss(loss))
+            if update:
+                self.rescale_tail_grads([ self.model ], i)
+                sync_grads(self.model)
+                self.amp.unscale_(self.opt)
+                torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
+                self.amp.step(self.opt)
+            meta = { 'iter_loss': sup_loss.detach(),
+                     'iter_mixup': mixup_loss.detach() }
+            self.accum_meta(meta)
 
             # EMA update
-            self.update_ema(self.model, self.teacher, self.ema_alpha, self.step)
+            if update:
+                self.ema.update(self.step)
 
             # TODO, esimate uns loss while training?
             # with torch.no_grad():
             # ...
             B = padded_mixture.size(0)
-            total_loss += sup_loss.item() * B
-            total_mixup += mixup_loss.item() * B
+            total_loss += sup_loss.detach() * B
+            total_mixup += mixup_loss.detach() * B
             cnt += B
 
-            self.step += 1
-            self.writer.step()
+            if update:
+                self.writer.log_step_info('train', self.pop_step_meta())
+                self.step += 1
+                self.writer.step()
 
         total_loss = total_loss / cnt
         total_mixup = total_mixup / cnt
@@ -583,13 +709,16 @@ class Trainer(Solver):
         self.writer.log_epoch_info('train', meta)
 
     def train_pseudo_label(self, epoch, sup_loader, uns_gen):
+        set_epoch(sup_loader, epoch)
         self.model.train()
         total_loss = 0.
         total_uns_loss = 0.
         cnt = 0
 
         for i, sample in enumerate(tqdm(sup_loader, ncols = NCOL)):
-            self.opt.zero_grad()
+            update = self.is_accum_end(i, len(sup_loader))
+            if self.is_accum_start(i):
+                self.opt.zero_grad()
 
             # sup part
             padded_mixture = sample['mix'].to(DEV)
@@ -597,41 +726,49 @@ class Trainer(Solver):
             mixture_lengths = sample['ilens'].to(DEV)
             B = padded_mixture.size(0)
 
-            estimate_source = self.model(padded_mixture)
+            with self.amp.autocast():
+                estimate_source = self.model(padded_mixture)
 
-            sup_loss, max_snr, estimate_source, reorder_estimate_source = \
-                cal_loss(padded_source, estimate_source, mixture_lengths)
+                sup_loss, max_snr, estimate_source, reorder_estimate_source = \
+                    cal_loss(padded_source, estimate_source, mixture_lengths)
 
             # pi on uns
             uns_sample = uns_gen.__next__()
             padded_mixture = uns_sample['mix'].to(DEV)
             mixture_lengths = uns_sample['ilens'].to(DEV)
 
-            with torch.no_grad():
-                pseudo_ref = self.model.K_forward(padded_mixture, K = 2, T = 0.5)
+            with self.amp.autocast():
+                with torch.no_grad():
+                    pseudo_ref = self.model.K_forward(padded_mixture, K = 2, T = 0.5)
 
-            estimate_source = self.model(padded_mixture)
+                estimate_source = self.model(padded_mixture)
 
-            uns_loss, max_snr, estimate_source, reorder_estimate_source = \
-                cal_loss(pseudo_ref, estimate_source, mixture_lengths)
+                uns_loss, max_snr, estimate_source, reorder_estimate_source = \
+                    cal_loss(pseudo_ref, estimate_source, mixture_lengths)
 
             l = self.lambda_scheduler.value(epoch)
             loss = sup_loss + l * uns_loss
-            loss.backward()
+            self.amp.backward(self.accum_loss(loss))
 
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
-            self.opt.step()
+            if update:
+                self.rescale_tail_grads([ self.model ], i)
+                sync_grads(self.model)
+                self.amp.unscale_(self.opt)
+                torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
+                self.amp.step(self.opt)
 
-            meta = { 'iter_loss': sup_loss.item(),
-                     'iter_uns_loss': uns_loss.item() }
-            self.writer.log_step_info('train', meta)
+            meta = { 'iter_loss': sup_loss.detach(),
+                     'iter_uns_loss': uns_loss.detach() }
+            self.accum_meta(meta)
 
-            total_loss += sup_loss.item() * B
-            total_uns_loss += uns_loss.item() * B
+            total_loss += sup_loss.detach() * B
+            total_uns_loss += uns_loss.detach() * B
             cnt += B
 
-            self.step += 1
-            self.writer.step()
+            if update:
+                self.writer.log_step_info('train', self.pop_step_meta())
+                self.step += 1
+                self.writer.step()
 
         total_loss = total_loss / cnt
         total_uns_loss = total_uns_loss / cnt
@@ -641,6 +778,7 @@ class Trainer(Solver):
         self.writer.log_epoch_info('train', meta)
 
     def train_noisy_student(self, epoch, sup_loader, uns_gen):
+        set_epoch(sup_loader, epoch)
         self.model.train()
         self.teacher.eval()
         total_loss = 0.
@@ -655,42 +793,55 @@ class Trainer(Solver):
             mixture_lengths = sample['ilens'].to(DEV)
             B = padded_mixture.size(0)
 
-            estimate_source = self.model(padded_mixture)
+            with self.amp.autocast():
+                estimate_source = self.model(padded_mixture)
 
-            sup_loss, max_snr, estimate_source, reorder_estimate_source = \
-                cal_loss(padded_source, estimate_source, mixture_lengths)
+                sup_loss, max_snr, estimate_source, reorder_estimate_source = \
+                    cal_loss(padded_source, estimate_source, mixture_lengths)
 
             # pi on uns
             uns_sample = uns_gen.__next__()
             padded_mixture = uns_sample['mix'].to(DEV)
             mixture_lengths = uns_sample['ilens'].to(DEV)
 
-            with torch.no_grad():
-                pseudo_ref = self.teacher(padded_mixture)
+            with self.amp.autocast():
+                if 'pseudo' in uns_sample:
+                    pseudo_ref = uns_sample['pseudo'].to(DEV)
+                else:
+                    with torch.no_grad():
+                        pseudo_ref = self.teacher(padded_mixture)
 
-            estimate_source = self.model(padded_mixture)
+                estimate_source = self.model(padded_mixture)
 
-            uns_loss, max_snr, estimate_source, reorder_estimate_source = \
-                cal_loss(pseudo_ref, estimate_source, mixture_lengths)
+                uns_loss, max_snr, estimate_source, reorder_estimate_source = \
+                    cal_loss(pseudo_ref, estimate_source, mixture_lengths)
 
             l = self.lambda_scheduler.value(epoch)
             loss = sup_loss + l * uns_loss
-            self.opt.zero_grad()
-            loss.backward()
-
-            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
-            self.opt.step()
-
-            meta = { 'iter_loss': sup_loss.item(),
-                     'iter_uns_loss': uns_loss.item() }
-            self.writer.log_step_info('train', meta)
-
-            total_loss += sup_loss.item() * B
-            total_uns_loss += uns_loss.item() * B
+            update = self.is_accum_end(i, len(sup_loader))
+            if self.is_accum_start(i):
+                self.opt.zero_grad()
+            self.amp.backward(self.accum_loss(loss))
+
+            if update:
+                self.rescale_tail_grads([ self.model ], i)
+                sync_grads(self.model)
+                self.amp.unscale_(self.opt)
+                torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
+                self.amp.step(self.opt)
+
+            meta = { 'iter_loss': sup_loss.detach(),
+                     'iter_uns_loss': uns_loss.detach() }
+            self.accum_meta(meta)
+
+            total_loss += sup_loss.detach() * B
+            total_uns_loss += uns_loss.detach() * B
             cnt += B
 
-            self.step += 1
-            self.writer.step()
+            if update:
+                self.writer.log_step_info('train', self.pop_step_meta())
+                self.step += 1
+                self.writer.step()
 
         total_loss = total_loss / cnt
         total_uns_loss = total_uns_loss / cnt
@@ -729,6 +880,8 @@ class Trainer(Solver):
                 total_sisnri += max_sisnri.sum().item()
                 cnt += B
 
+        # sum over ranks
+        total_loss, total_sisnri, cnt = all_reduce_sum([ total_loss, total_sisnri, cnt ])
         total_loss = total_loss / cnt
         total_sisnri = total_sisnri / cnt
 
@@ -746,8 +899,7 @@ class Trainer(Solver):
         model_name = f'{epoch}.pth'
         info_dict = { 'epoch': epoch, 'step': self.step, 'valid_score': valid_score, 'config': self.config }
         info_dict['optim'] = self.opt.state_dict()
-        if self.fp16:
-            info_dict['amp'] = amp.state_dict()
+        info_dict['amp'] = self.amp.state_dict()
 
         self.saver.update(self.model, total_sisnri, model_name, info_dict)
 
@@ -803,6 +955,9 @@ class Trainer(Solver):
                 total_teacher_loss += loss.item() * B
                 total_teacher_sisnri += max_sisnri.sum().item()
 
+        # sum over ranks
+        total_loss, total_sisnri, total_teacher_loss, total_teacher_sisnri, cnt = \
+                all_reduce_sum([ total_loss, total_sisnri, total_teacher_loss, total_teacher_sisnri, cnt ])
         total_loss = total_loss / cnt
         total_sisnri = total_sisnri / cnt
         total_teacher_loss = total_teacher_loss / cnt
@@ -826,8 +981,7 @@ class Trainer(Solver):
         model_name = f'{epoch}.pth'
         info_dict = { 'epoch': epoch, 'step': self.step, 'valid_score': valid_score, 'config': self.config,
                       'optim': self.opt.state_dict(), 'teacher': self.teacher.state_dict() }
-        if self.fp16:
-            info_dict['amp'] = amp.state_dict()
+        info_dict['amp'] = self.amp.state_dict()
 
         self.saver.update(self.model, total_sisnri, model_name, info_dict)
 
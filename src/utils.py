@@ -38,7 +38,23 @@ def read_scale(path):
 def read_path_conf(local_path = './config/path.yaml'):
     return yaml.load(open(local_path), Loader=yaml.FullLoader)
 
-def inf_data_gen(loader):
+def inf_loop(loader):
+    epoch = 0
     while True:
+        # reshuffle DistributedSampler every pass
+        if hasattr(loader.sampler, 'set_epoch'):
+            loader.sampler.set_epoch(epoch)
         for s in loader:
             yield s
+        epoch += 1
+
+def inf_data_gen(loader, prefetch = 0):
+    """
+    Args:
+        prefetch: > 0, keep `prefetch` batches ready in a background thread,
+                  batches are already on DEV (see src/prefetch.py)
+    """
+    if prefetch > 0:
+        from src.prefetch import Prefetcher
+        return Prefetcher(loader, prefetch)
+    return inf_loop(loader)
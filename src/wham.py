@@ -9,8 +9,10 @@ import soundfile as sf
 import _pickle as cPickle
 
 from io import BytesIO
-from tqdm import tqdm
 from torch.utils.data import Dataset
+from src.sample_cache import read_audio
+from src.preload import preload_audio
+from src.pseudo_label import crop_pseudo
 
 class wham(Dataset):
     def __init__(self, id_list_path, audio_root, seg_len = 4.0, pre_load = True, one_chunk_in_utt = True, mode = 'tr', sp_factors = None, scale = 1.0):
@@ -41,6 +43,10 @@ class wham(Dataset):
             self.seg_len = int(seg_len * self.sr)
 
         self.pre_load = pre_load
+        # shared sample cache, set by make_loader
+        self.cache = None
+        # offline teacher outputs (PseudoLabelStore), returned as 'pseudo'
+        self.pseudo = None
         self.one_chunk = one_chunk_in_utt
 
         if sp_factors != None:
@@ -87,15 +93,20 @@ class wham(Dataset):
 
         if self.pre_load:
             print('Start pre-loading audio')
-            self.audios = {}
-            for uid in tqdm(self.data):
-                self.audios[uid] = {}
-                for speaker in self.data[uid]:
-                    path, _ = self.data[uid][speaker]
-                    path = os.path.join(audio_root, path)
-                    audio, _ = sf.read(path)
-                    audio = audio.astype(np.float32)
-                    self.audios[uid][speaker] = audio
+            # one shared-memory copy for all DataLoader workers, noise included
+            uids = list(dict.fromkeys(info[0] for info in self.id_list))
+            self.audios = preload_audio(self.data, audio_root, uids, self.noise_items(uids))
+
+    def noise_items(self, uids):
+        items = []
+        for uid in uids:
+            npath = self.noise_data[uid]['noise'][0]
+            items.append(((uid, 'noise'), os.path.join(self.audio_root, npath)))
+        return items
+
+    def preloaded_audio(self, uid, key, scale = 1.0):
+        # same values as load_audio (scaled in float64)
+        return (self.audios[uid, key].astype(np.float64) * scale).astype(np.float32)
 
     def pad_audio(self, audio, ilen):
         base = np.zeros(self.seg_len, dtype = np.float32)
@@ -104,7 +115,7 @@ class wham(Dataset):
 
     def load_audio(self, path, factor = 1.0, scale = 1.0):
         if factor == 1.0:
-            audio, _ = sf.read(path)
+            audio = read_audio(path, self.cache)
         else:
             cmd = f'sox {path} -t wav - speed {factor}'.split()
             result = subprocess.Popen(args = cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -125,9 +136,10 @@ class wham(Dataset):
         uid, cid, s, e = self.id_list[idx]
         npath, _, ss, sn, _ = self.noise_data[uid]['noise']
         if self.pre_load:
-            mix_audio = self.audios[uid]['mix']
-            s1_audio = self.audios[uid]['s1']
-            s2_audio = self.audios[uid]['s2']
+            mix_audio = self.preloaded_audio(uid, 'mix', ss)
+            s1_audio = self.preloaded_audio(uid, 's1', ss)
+            s2_audio = self.preloaded_audio(uid, 's2', ss)
+            noise_audio = self.preloaded_audio(uid, 'noise', sn)
         else:
             mix_path = os.path.join(self.audio_root, self.data[uid]['mix'][0])
             s1_path = os.path.join(self.audio_root, self.data[uid]['s1'][0])
@@ -174,6 +186,8 @@ class wham(Dataset):
 
         sample = { 'uid': uid, 'cid': cid, 'ilens': ilen,
                    'mix': mix_audio, 'ref': sep_audio }
+        if self.pseudo is not None:
+            sample['pseudo'] = crop_pseudo(self.pseudo[uid], s, e, self.seg_len)
         return sample
 
 class wham_eval(Dataset):
@@ -201,6 +215,8 @@ class wham_eval(Dataset):
                 self.maxlen = l
 
         self.pre_load = pre_load
+        # shared sample cache, set by make_loader
+        self.cache = None
 
         self.id_list = []
         for uid in self.data:
@@ -215,15 +231,19 @@ class wham_eval(Dataset):
 
         if self.pre_load:
             print('Start pre-loading audio')
-            self.audios = {}
-            for uid in tqdm(self.data):
-                self.audios[uid] = {}
-                for speaker in self.data[uid]:
-                    path, _ = self.data[uid][speaker]
-                    path = os.path.join(audio_root, path)
-                    audio, _ = sf.read(path)
-                    audio = audio.astype(np.float32)
-                    self.audios[uid][speaker] = audio
+            # one shared-memory copy for all DataLoader workers, noise included
+            self.audios = preload_audio(self.data, audio_root, extra = self.noise_items(self.data))
+
+    def noise_items(self, uids):
+        items = []
+        for uid in uids:
+            npath = self.noise_data[uid]['noise'][0]
+            items.append(((uid, 'noise'), os.path.join(self.audio_root, npath)))
+        return items
+
+    def preloaded_audio(self, uid, key, scale = 1.0):
+        # same values as load_audio (scaled in float64)
+        return (self.audios[uid, key].astype(np.float64) * scale).astype(np.float32)
 
     def pad_audio(self, audio, ilen):
         base = np.zeros(self.maxlen, dtype = np.float32)
@@ -231,7 +251,7 @@ class wham_eval(Dataset):
         return base
 
     def load_audio(self, path, scale = 1.0):
-        audio, _ = sf.read(path)
+        audio = read_audio(path, self.cache)
         return audio * scale
 
     def __len__(self):
@@ -244,9 +264,10 @@ class wham_eval(Dataset):
         uid, cid, s, e = self.id_list[idx]
         npath, _, ss, sn, _ = self.noise_data[uid]['noise']
         if self.pre_load:
-            mix_audio = self.audios[uid]['mix']
-            s1_audio = self.audios[uid]['s1']
-            s2_audio = self.audios[uid]['s2']
+            mix_audio = self.preloaded_audio(uid, 'mix', ss)
+            s1_audio = self.preloaded_audio(uid, 's1', ss)
+            s2_audio = self.preloaded_audio(uid, 's2', ss)
+            noise_audio = self.preloaded_audio(uid, 'noise', sn)
         else:
             mix_path = os.path.join(self.audio_root, self.data[uid]['mix'][0])
             s1_path = os.path.join(self.audio_root, self.data[uid]['s1'][0])
@@ -321,9 +342,10 @@ class wham_parallel_eval(wham_eval):
         uid, cid, s, e = self.id_list[idx]
         npath, _, ss, sn, _ = self.noise_data[uid]['noise']
         if self.pre_load:
-            mix_audio = self.audios[uid]['mix']
-            s1_audio = self.audios[uid]['s1']
-            s2_audio = self.audios[uid]['s2']
+            mix_audio = self.preloaded_audio(uid, 'mix', ss)
+            s1_audio = self.preloaded_audio(uid, 's1', ss)
+            s2_audio = self.preloaded_audio(uid, 's2', ss)
+            noise_audio = self.preloaded_audio(uid, 'noise', sn)
         else:
             mix_path = os.path.join(self.audio_root, self.data[uid]['mix'][0])
             s1_path = os.path.join(self.audio_root, self.data[uid]['s1'][0])